@@ -42,14 +42,15 @@ setup(
         'Framework :: IPython',
         'Development Status :: 4 - Beta',
 
-        'Programming Language :: Python :: 2',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
     ],
 
+    # The connector runs on the kernel's asyncio event loop
+    python_requires='>=3.7',
+
     # What does your project relate to?
     keywords='springrts jupyter ipython',
 
@@ -67,7 +68,14 @@ setup(
     },
 
     install_requires=[ "setuptools",
-                   "ipykernel >= 4.0",
+                   "ipykernel >= 6.0",
                    "jupyter-client >= 4.0",
                    "jupyter"],
+
+    # Optional: re-encoding screenshots (e.g. %show -f webp) and faster
+    # decoding of MessagePack messages from Spring
+    extras_require={
+        'images': ["pillow"],
+        'msgpack': ["msgpack"],
+    },
 )
@@ -36,116 +36,247 @@ function __SK.explode(div,str)
 	return arr
 end
 
-function __SK._isarray(t)
-	local i = 0
- 	for _ in pairs(t) do
-    	i = i + 1
-		if t[i] == nil then return false end
-  	end
-  	return true
+__SK._MAX_LEVEL = 3
+__SK._MAX_HEAD = 100 -- entries shown from the start of a large table
+__SK._MIN_TAIL = 10 -- entries shown from the end of a large table
+
+-- Collects a table's entries in a single traversal.
+-- Returns keys and values in traversal order, their count and whether the table is an array.
+function __SK._entries(t)
+	local keys, values, size, maxKey = {}, {}, 0, 0
+	local isArray = true
+	for k, v in pairs(t) do
+		size = size + 1
+		keys[size] = k
+		values[size] = v
+		if isArray then
+			if type(k) == "number" and k >= 1 and k % 1 == 0 then
+				if k > maxKey then
+					maxKey = k
+				end
+			else
+				isArray = false
+			end
+		end
+	end
+	-- distinct positive integer keys up to the entry count are exactly 1..size
+	return keys, values, size, isArray and maxKey == size
 end
-function __SK._size(t)
-	local size = 0
-	for _ in pairs(t) do
-    	size = size + 1
+
+-- Returns the indices of the entries to show: the whole range, or a head and a tail
+function __SK._shownRanges(size)
+	if size > __SK._MAX_HEAD + __SK._MIN_TAIL then
+		return __SK._MAX_HEAD, size - __SK._MIN_TAIL + 1
 	end
-	return size
+	return size, nil
 end
-__SK._MAX_LEVEL = 3
+
+function __SK._writeEntries(buf, t, keys, values, size, isArray, level)
+	local headEnd, tailStart = __SK._shownRanges(size)
+	local i = 1
+	while i <= size do
+		if i == headEnd + 1 then
+			buf[#buf + 1] = " ... "
+			i = tailStart
+		elseif i > 1 then
+			buf[#buf + 1] = ", "
+		end
+		if isArray then
+			__SK._writeValue(buf, t[i], level + 1)
+		else
+			buf[#buf + 1] = tostring(keys[i])
+			buf[#buf + 1] = "="
+			__SK._writeValue(buf, values[i], level + 1)
+		end
+		i = i + 1
+	end
+end
+
+function __SK._writeValue(buf, value, level)
+	if type(value) ~= "table" then
+		buf[#buf + 1] = tostring(value)
+	elseif level >= __SK._MAX_LEVEL then
+		buf[#buf + 1] = "{ ... }"
+	else
+		buf[#buf + 1] = "{"
+		local keys, values, size, isArray = __SK._entries(value)
+		__SK._writeEntries(buf, value, keys, values, size, isArray, level)
+		buf[#buf + 1] = "}"
+	end
+end
+
+-- Converts a value to a string, by writing the pieces into a buffer that's joined once.
+-- With valArg the value is an argument list ({n = count, ...}), written without braces.
 function __SK._tostring(value, valArg, level)
+	local buf = {}
 	level = level or 0
-	if level >= __SK._MAX_LEVEL and type(value) == "table" then
-		return "{ ... }"
+	if valArg then
+		__SK._writeEntries(buf, value, nil, nil, value.n, true, level)
+	else
+		__SK._writeValue(buf, value, level)
 	end
-	local str = ""
-	if type(value) == "table" then
-		if valArg then
-			str = ""
-		else
-			str = "{"
-		end
-		local _start = true
-		local isArray
-		local size
-		if valArg then
-			isArray = true
-			size = value.n
-			value.n = nil
-		else
-			isArray = __SK._isarray(value)
-			size = __SK._size(value)
+	return table.concat(buf)
+end
+
+-- Tables that couldn't be shown in full by _tonode are kept under a handle, so more of them can be
+-- fetched later with the expand command. The least recently used ones are let go.
+__SK.MAX_HANDLES = 1024
+__SK._handles = {} -- handle -> {value = table, used = use count}
+__SK._handleOf = {} -- table -> handle
+__SK._handleCount = 0
+__SK._lastHandle = 0
+__SK._handleUses = 0
+
+-- Returns the handle of a table, keeping it
+function __SK.RetainTable(t)
+	__SK._handleUses = __SK._handleUses + 1
+	local handle = __SK._handleOf[t]
+	if handle then
+		__SK._handles[handle].used = __SK._handleUses
+		return handle
+	end
+	if __SK._handleCount >= __SK.MAX_HANDLES then
+		-- Let go of the least recently used quarter at once
+		local handles = {}
+		for h in pairs(__SK._handles) do
+			handles[#handles + 1] = h
 		end
+		table.sort(handles, function(a, b)
+			return __SK._handles[a].used < __SK._handles[b].used
+		end)
+		for i = 1, math.ceil(#handles / 4) do
+			__SK._handleOf[__SK._handles[handles[i]].value] = nil
+			__SK._handles[handles[i]] = nil
+		end
+		__SK._handleCount = #handles - math.ceil(#handles / 4)
+	end
+	__SK._lastHandle = __SK._lastHandle + 1
+	handle = __SK._lastHandle
+	__SK._handles[handle] = {value = t, used = __SK._handleUses}
+	__SK._handleOf[t] = handle
+	__SK._handleCount = __SK._handleCount + 1
+	return handle
+end
 
-		local indx = 1
+-- Returns the table kept under a handle, or nil if it was let go
+function __SK.RetainedTable(handle)
+	local entry = __SK._handles[handle]
+	if not entry then
+		return nil
+	end
+	__SK._handleUses = __SK._handleUses + 1
+	entry.used = __SK._handleUses
+	return entry.value
+end
 
-		local max_indx_head = 100
-		local min_indx_tail = 10
-		local switch_print = 0
-		if isArray then
-			for indx = 1, size do
-				local v = value[indx]
-				if switch_print == 0 and indx > max_indx_head and size - min_indx_tail > indx then
-					switch_print = 1
-					str = str .. " ... "
-					_start = true
-				elseif switch_print == 1 and indx > size - min_indx_tail then
-					switch_print = 2
-				end
-				if switch_print ~= 1 then
-					if not _start then
-						str = str .. ", "
-					end
-					if isArray then
-						str = str .. __SK._tostring(v, false, level+1)
-					else
-						str = str .. tostring(k) .. "=" .. __SK._tostring(v, false, level+1)
-					end
-					_start = false
-				end
-			end
+-- Converts a value to a typed node ({t = type, v = value}) that can be JSON encoded.
+-- Table nodes contain the shown entries as items ({k = key node, v = value node}, keys
+-- are left out for arrays) and, for large tables, how many entries were skipped after
+-- the first skipAt items. With first and last, only the entries in that range of the
+-- traversal order are shown and offset is the number of entries before them.
+-- Tables that aren't shown in full get a handle (h), see __SK.RetainTable.
+function __SK._tonode(value, level, first, last)
+	level = level or 0
+	local t = type(value)
+	if t == "table" then
+		if level >= __SK._MAX_LEVEL then
+			return {t = "table", truncated = true, h = __SK.RetainTable(value)}
+		end
+		local keys, values, size, isArray = __SK._entries(value)
+		local items = {}
+		local node = {t = "table", n = size, array = isArray, items = items}
+		local headEnd, tailStart
+		if first then
+			node.offset = first - 1
+			headEnd, tailStart = math.min(last, size), nil
 		else
-			for k, v in pairs(value) do
-				indx = indx + 1
-				if switch_print == 0 and indx > max_indx_head and size - min_indx_tail > indx then
-					switch_print = 1
-					str = str .. " ... "
-					_start = true
-				elseif switch_print == 1 and indx > size - min_indx_tail then
-					switch_print = 2
-				end
-				if switch_print ~= 1 then
-					if not _start then
-						str = str .. ", "
-					end
-					if isArray then
-						str = str .. __SK._tostring(v, false, level+1)
-					else
-						str = str .. tostring(k) .. "=" .. __SK._tostring(v, false, level+1)
-					end
-					_start = false
+			first = 1
+			headEnd, tailStart = __SK._shownRanges(size)
+		end
+		local i = first
+		while i <= size do
+			if i == headEnd + 1 then
+				if not tailStart then
+					break
 				end
+				node.skipAt = headEnd
+				node.skipped = tailStart - headEnd - 1
+				i = tailStart
 			end
+			if isArray then
+				items[#items + 1] = {v = __SK._tonode(value[i], level + 1)}
+			else
+				items[#items + 1] = {
+					k = __SK._tonode(keys[i], __SK._MAX_LEVEL),
+					v = __SK._tonode(values[i], level + 1),
+				}
+			end
+			i = i + 1
 		end
-		if not valArg then
-			str = str .. "}"
+		if #items < size then
+			node.h = __SK.RetainTable(value)
 		end
-		return str
+		return node
+	elseif t == "number" or t == "string" or t == "boolean" then
+		return {t = t, v = value}
+	elseif t == "nil" then
+		return {t = t}
 	else
-		return tostring(value)
+		return {t = t, v = tostring(value)}
 	end
 end
 
-__SK._echoOutput = ""
+-- _p output is collected as a list of pieces and, while a request is running, sent to the
+-- kernel as stream events whenever ECHO_CHUNK_SIZE bytes have accumulated
+__SK.ECHO_CHUNK_SIZE = 64 * 1024
+__SK._echoBuffer = {}
+__SK._echoSize = 0
+__SK._echoRequest = nil -- id of the request the output belongs to
+-- With the "tree" format, _p collects a list of typed nodes per call instead of text
+__SK._echoFormat = "text"
+__SK._echoNodes = {}
 function _p(...)
 	local args = { n = select("#", ...); ... }
-	__SK._echoOutput = __SK._echoOutput .. __SK._tostring(args, true) .. "\n"
+	if __SK._echoFormat == "tree" then
+		local nodes = {}
+		for i = 1, args.n do
+			nodes[i] = __SK._tonode(args[i], 1)
+		end
+		__SK._echoNodes[#__SK._echoNodes + 1] = nodes
+		return
+	end
+	local str = __SK._tostring(args, true) .. "\n"
+	local buffer = __SK._echoBuffer
+	buffer[#buffer + 1] = str
+	__SK._echoSize = __SK._echoSize + #str
+	if __SK._echoRequest and __SK._echoSize >= __SK.ECHO_CHUNK_SIZE then
+		__SK.flushEchoOutput()
+	end
 	--Spring.Echo(...)
 end
 function __SK.getEchoOutput()
-	local output = __SK._echoOutput
-	__SK._echoOutput = ""
+	local output = table.concat(__SK._echoBuffer)
+	__SK._echoBuffer = {}
+	__SK._echoSize = 0
 	return output
 end
+-- Sends the collected output in pieces of ECHO_CHUNK_SIZE, keeping what's left for the reply
+function __SK.flushEchoOutput()
+	local output = __SK.getEchoOutput()
+	local size = __SK.ECHO_CHUNK_SIZE
+	local sent = #output - #output % size
+	for i = 1, sent, size do
+		__SK.SendToKernel({
+			id = __SK._echoRequest,
+			event = "stream",
+			data = output:sub(i, i + size - 1),
+		})
+	end
+	if sent < #output then
+		__SK._echoBuffer[1] = output:sub(sent + 1)
+		__SK._echoSize = #output - sent
+	end
+end
 
 
 function __SK.ExecuteLuaCommand(luaCommandStr)
@@ -174,39 +305,922 @@ function __SK.ExecuteLuaCommand(luaCommandStr)
 	return true
 end
 
-function __SK.autocomplete(str)
-    local matches = {}
+-- Chunked transfers between Lua states.
+-- Messages sent with Spring.SendLuaRulesMsg go through the network and are all handled in a sim
+-- frame, so large payloads are cut into chunks and a sender only sends a limited number of bytes
+-- each frame. Every chunk starts with "<transfer>:<index>:<count>:" and the payload itself is never
+-- parsed, so it can contain any characters.
+__SK.CHUNK_SIZE = 8 * 1024
+__SK.CHUNK_FRAME_BUDGET = 32 * 1024 -- bytes of chunks sent per frame, at least one chunk is always sent
+
+-- Returns a sender that sends chunks with send(chunk)
+function __SK.NewChunkSender(send)
+	return {send = send, queue = {}, nextTransfer = 1}
+end
+
+-- Queues a payload to be sent by FlushChunks
+function __SK.QueueChunks(sender, payload)
+	table.insert(sender.queue, {
+		payload = payload,
+		id = sender.nextTransfer,
+		index = 1,
+		count = math.max(1, math.ceil(#payload / __SK.CHUNK_SIZE)),
+	})
+	sender.nextTransfer = sender.nextTransfer + 1
+end
+
+-- Sends queued chunks until the frame's budget is used up, called once per frame
+function __SK.FlushChunks(sender)
+	local budget = __SK.CHUNK_FRAME_BUDGET
+	local queue = sender.queue
+	while budget > 0 and #queue > 0 do
+		local transfer = queue[1]
+		local first = (transfer.index - 1) * __SK.CHUNK_SIZE + 1
+		local piece = transfer.payload:sub(first, first + __SK.CHUNK_SIZE - 1)
+		sender.send(transfer.id .. ":" .. transfer.index .. ":" .. transfer.count .. ":" .. piece)
+		budget = budget - #piece
+		if transfer.index == transfer.count then
+			table.remove(queue, 1)
+		else
+			transfer.index = transfer.index + 1
+		end
+	end
+end
+
+-- Returns a receiver that reassembles the transfers of any number of sources, one at a time each
+function __SK.NewChunkReceiver()
+	return {transfers = {}}
+end
+
+-- Adds a chunk received from source, returns the payload once all of its chunks arrived
+function __SK.ReceiveChunk(receiver, chunk, source)
+	local _, headerEnd, id, index, count = chunk:find("^(%d+):(%d+):(%d+):")
+	if not headerEnd then
+		Spring.Log(__SK.LOG_SECTION, LOG.ERROR, "Dropping chunk without header")
+		return nil
+	end
+	index, count = tonumber(index), tonumber(count)
+	local piece = chunk:sub(headerEnd + 1)
+	if count == 1 then
+		return piece
+	end
+	local transfer = receiver.transfers[source]
+	if index == 1 then
+		transfer = {id = id, pieces = {}}
+		receiver.transfers[source] = transfer
+	elseif not transfer or transfer.id ~= id or #transfer.pieces ~= index - 1 then
+		Spring.Log(__SK.LOG_SECTION, LOG.ERROR, "Dropping chunk " .. index .. " of transfer " .. id .. ", received out of sequence")
+		receiver.transfers[source] = nil
+		return nil
+	end
+	transfer.pieces[index] = piece
+	if index < count then
+		return nil
+	end
+	receiver.transfers[source] = nil
+	return table.concat(transfer.pieces)
+end
+
+-- Incremented by every cell run in this state. Completions the kernel cached for an older
+-- generation are stale.
+__SK.generation = 0
+__SK._MAX_INDEX_DEPTH = 8 -- __index tables followed when listing keys
+
+-- Returns the value at path, a list of keys starting from the globals, or nil if a table on the
+-- way is missing. Errors raised by __index metamethods are propagated.
+function __SK.resolvePath(path)
+	local value = getfenv()
+	for _, key in ipairs(path) do
+		if type(value) ~= "table" then
+			return nil
+		end
+		value = value[key]
+	end
+	return value
+end
+
+-- Adds the identifier-like string keys produced by an iterator to keys, once each
+local function addKeys(keys, seen, ...)
+	for k in ... do
+		if type(k) == "string" and not seen[k] and k:find("^[%a_][%w_]*$") then
+			seen[k] = true
+			keys[#keys + 1] = k
+		end
+	end
+end
+
+-- Returns the names of the fields of the table at path, a list of keys starting from the globals.
+-- Fields inherited through __index tables are included, as are the fields of Spring's def
+-- proxies (e.g. UnitDefs[1]), which are only listed by their pairs method.
+function __SK.completions(path)
+	local keys, seen = {}, {}
+	pcall(function()
+		local tbl = __SK.resolvePath(path)
+		if type(tbl) ~= "table" then
+			return
+		end
+		if type(tbl.pairs) == "function" then
+			addKeys(keys, seen, tbl:pairs())
+		end
+		local depth = 0
+		while type(tbl) == "table" and depth < __SK._MAX_INDEX_DEPTH do
+			addKeys(keys, seen, pairs(tbl))
+			local mt = getmetatable(tbl)
+			tbl = type(mt) == "table" and rawget(mt, "__index") or nil
+			depth = depth + 1
+		end
+	end)
+	return keys
+end
+
+-- Commands run inside the Lua state targeted by a request, each called with the request data and id
+-- and returning the reply result. Commands that return nil send their reply themselves, later.
+-- The addon sets __SK.SendToKernel, which delivers a message from this state to the kernel.
+__SK.stateCommands = {}
+
+function __SK.stateCommands.execute(data, id)
+	local msg = {}
+	__SK.generation = __SK.generation + 1
+	if data.task then
+		return __SK.StartTask(data, id)
+	end
+	__SK._echoRequest = id
+	__SK._echoFormat = data.format or "text"
+	local success, error = __SK.ExecuteLuaCommand(data.code)
+	__SK._echoRequest = nil
+	__SK._echoFormat = "text"
+	if not success then
+		table.insert(msg, {error, "error"})
+	end
+	table.insert(msg, {__SK.getEchoOutput(), "output"})
+	if #__SK._echoNodes > 0 then
+		table.insert(msg, {__SK._echoNodes, "tree"})
+		__SK._echoNodes = {}
+	end
+	return msg
+end
+
+-- Cells run with %async are coroutines, resumed every frame for up to their time slice in ms. They
+-- call _yield() often enough to let the frame go on, and _progress() to report how far they are.
+-- Without a clock (synced LuaRules) every yieldEvery-th call of _yield yields instead.
+__SK.tasks = {} -- running async cells, by the number the kernel gave them
+__SK.task = nil -- the task being resumed
+
+function _yield()
+	local task = __SK.task
+	if not task or coroutine.running() ~= task.co then
+		return
+	end
+	task.calls = task.calls + 1
+	if task.calls % task.checkEvery ~= 0 then
+		return
+	end
+	if task.since then
+		if task.since(task.resumed) * 1000 < task.slice then
+			return
+		end
+		-- Calls can be too cheap to read the clock on each, it's read about 16 times per slice
+		task.checkEvery = math.max(1, math.floor(task.calls / 16))
+	elseif task.calls < task.yieldEvery then
+		return
+	end
+	task.calls = 0
+	coroutine.yield()
+end
+
+-- Reports the progress of an async cell, it's sent to the kernel once per frame
+function _progress(done, total, message)
+	local task = __SK.task
+	if task then
+		task.progress = {done = done, total = total, message = message and tostring(message)}
+	end
+	_yield()
+end
+
+-- Sends what the task printed and its progress so far
+local function sendTaskOutput(task)
+	__SK.flushEchoOutput()
+	local output = __SK.getEchoOutput()
+	if output ~= "" then
+		__SK.SendToKernel({id = task.id, event = "stream", data = output})
+	end
+	if task.progress then
+		__SK.SendToKernel({id = task.id, event = "progress", data = task.progress})
+		task.progress = nil
+	end
+end
+
+-- Resumes a task for a frame and returns its reply once it's done or cancelled
+local function resumeTask(task)
+	local success, err = true, nil
+	if task.cancelled then
+		success, err = false, "Cancelled after " .. task.frames .. " frames"
+	else
+		__SK.task = task
+		__SK._echoRequest = task.id
+		__SK._echoFormat = task.format
+		__SK._echoNodes = task.nodes
+		task.resumed = task.now and task.now()
+		success, err = coroutine.resume(task.co)
+		task.frames = task.frames + 1
+		task.nodes = __SK._echoNodes
+		__SK.task = nil
+		__SK._echoRequest = nil
+		__SK._echoFormat = "text"
+		__SK._echoNodes = {}
+		if success and coroutine.status(task.co) ~= "dead" then
+			sendTaskOutput(task)
+			return nil
+		end
+	end
+	__SK.tasks[task.number] = nil
+	local msg = {}
+	if not success then
+		table.insert(msg, {tostring(err), "error"})
+	end
+	table.insert(msg, {__SK.getEchoOutput(), "output"})
+	if #task.nodes > 0 then
+		table.insert(msg, {task.nodes, "tree"})
+	end
+	if task.frames > 1 and not task.cancelled then
+		table.insert(msg, {"Ran over " .. task.frames .. " frames", "state-info"})
+	end
+	return msg
+end
+
+-- Starts an async cell, it's resumed right away and the reply is sent once it's done
+function __SK.StartTask(data, id)
+	if not coroutine then
+		return {{"Coroutines are not available in this state", "error"}}
+	end
+	local f, err = loadstring(data.code)
+	if not f then
+		return {{err, "error"}}
+	end
+	setfenv(f, getfenv())
+	local _, now, since = __SK.Clock()
+	local task = {
+		id = id,
+		number = data.task,
+		co = coroutine.create(f),
+		format = data.format or "text",
+		nodes = {},
+		slice = data.slice or 4,
+		yieldEvery = data.yieldEvery or 1000,
+		calls = 0, -- calls of _yield since the last yield
+		checkEvery = 1, -- calls of _yield between reading the clock
+		frames = 0,
+		now = now,
+		since = since,
+	}
+	if __SK.tasks[task.number] then
+		__SK.tasks[task.number].cancelled = true
+	end
+	__SK.tasks[task.number] = task
+	local msg = resumeTask(task)
+	if msg then
+		return msg
+	end
+	__SK.AddTicker(function()
+		if task.dropped then
+			return true
+		end
+		msg = resumeTask(task)
+		if msg then
+			__SK.SendReply(id, msg)
+			return true
+		end
+	end)
+end
+
+-- Cancels an async cell, its reply is sent in the next frame
+function __SK.stateCommands.cancel(data)
+	local task = __SK.tasks[data.task]
+	if task then
+		task.cancelled = true
+	end
+	return {{"cancelled", task ~= nil}}
+end
+
+-- Stops the watches and async cells of this state without answering them, once the kernel that
+-- started them is gone. The widget runs it when the connection drops, and sends the gadget's states
+-- the disconnect command.
+function __SK.DropKernelWork()
+	__SK.watches = {}
+	for _, task in pairs(__SK.tasks) do
+		task.dropped = true
+	end
+	__SK.tasks = {}
+end
+
+function __SK.stateCommands.disconnect()
+	__SK.DropKernelWork()
+end
+
+function __SK.stateCommands.autocomplete(data)
+	return {{"keys", __SK.completions(data.path)}, {"generation", __SK.generation}}
+end
+
+-- Returns a page of the table kept under data.handle: data.count entries from data.start, with
+-- data.depth levels of nested tables
+function __SK.stateCommands.expand(data)
+	local value = __SK.RetainedTable(data.handle)
+	if not value then
+		return {{"error", "The table is no longer kept, run the cell again to see it"}}
+	end
+	local first = math.max(1, data.start or 1)
+	local last = first + (data.count or __SK._MAX_HEAD) - 1
+	local level = __SK._MAX_LEVEL - math.max(1, data.depth or 2)
+	return {{"node", __SK._tonode(value, level, first, last)}}
+end
+
+-- Describes the value at data.path. Functions are identified by their address and definition, the
+-- source code of the ones listed in data.known is already cached by the kernel and isn't sent.
+function __SK.stateCommands.inspect(data)
+	local success, value = pcall(__SK.resolvePath, data.path)
+	if not success or value == nil then
+		return {{"found", false}}
+	end
+	if type(value) ~= "function" then
+		return {{"found", true}, {"type", type(value)}, {"value", __SK._tostring(value, nil, __SK._MAX_LEVEL - 1)}}
+	end
+	local info = debug and debug.getinfo(value, "S")
+	local id = tostring(value)
+	if info then
+		id = id .. "@" .. tostring(info.source) .. ":" .. tostring(info.linedefined)
+	end
+	local result = {{"found", true}, {"type", "function"}, {"id", id}}
+	for _, known in ipairs(data.known or {}) do
+		if known == id then
+			return result
+		end
+	end
+	if info and info.what ~= "C" then
+		table.insert(result, {"location", tostring(info.source):gsub("^@", "") .. ":" .. tostring(info.linedefined)})
+	end
+	table.insert(result, {"source", _source(value)})
+	return result
+end
+
+-- Returns the name of the clock available in this state, a function returning the current time and
+-- one returning the seconds since such a time, or nil if there's no clock. Synced code has no Spring
+-- timer, os.clock is used there when it's available.
+function __SK.Clock()
+	if Spring.GetTimer then
+		local GetTimer, DiffTimers = Spring.GetTimer, Spring.DiffTimers
+		return "Spring.GetTimer", GetTimer, function(start)
+			return DiffTimers(GetTimer(), start)
+		end
+	elseif os and os.clock then
+		local clock = os.clock
+		return "os.clock", clock, function(start)
+			return clock() - start
+		end
+	end
+end
 
+-- Benchmarking for %timeit
+__SK.TIMEIT_MIN_TIME = 0.2 -- seconds a repeat takes at least when the number of loops is picked
+__SK.TIMEIT_MAX_NUMBER = 10 ^ 9
+__SK.TIMEIT_MEMORY_NUMBER = 1000 -- most runs measured with the garbage collector stopped
+
+-- Returns the name of the clock and a function that runs f number times and returns how many
+-- seconds it took, or nil if there's no clock
+function __SK.LoopTimer()
+	local name, now, since = __SK.Clock()
+	if not name then
+		return nil
+	end
+	return name, function(f, number)
+		local start = now()
+		for _ = 1, number do
+			f()
+		end
+		return since(start)
+	end
+end
+
+-- Runs the code of a cell data.repeat times in loops of data.number runs, picking the number of
+-- runs like IPython does when it isn't given. The code is compiled once.
+-- With data.memory, every repeat also runs the code up to TIMEIT_MEMORY_NUMBER more times with the
+-- garbage collector stopped, and returns how much Lua memory (KB) these runs allocated.
+function __SK.stateCommands.timeit(data)
+	local timerName, timeLoops = __SK.LoopTimer()
+	if not timeLoops then
+		return {{"error", "No timer is available in this state"}}
+	end
+	local f, err = loadstring(data.code)
+	if not f then
+		return {{"error", err}}
+	end
+	setfenv(f, getfenv())
+	__SK.generation = __SK.generation + 1
+	local number = data.number
+	local memoryNumber
+	local times, memory = {}, {}
 	local success, err = pcall(function()
-	    local tbl = getfenv()
-	    while true do
-	        local dotStart, dotEnd = str:find(".", 1, true)
-	        if dotStart ~= dotEnd then
-	            return matches
-	        end
-	        if dotStart then
-	            local left = str:sub(1, dotStart-1)
-	            local right = str:sub(dotStart+1)
-
-	            tbl = tbl[left]
-	            if tbl == nil or type(tbl) ~= "table" then
-	                return
-	            end
-	            str = right
-	        else
-	            break
-	        end
-	    end
-
-	    for k, v in pairs(tbl) do
-	        local startIndx = k:find(str, 1, true)
-	        if startIndx == 1 then
-	            table.insert(matches, k)
-	        end
-	    end
-    	return
+		if not number then
+			number = 1
+			while number < __SK.TIMEIT_MAX_NUMBER do
+				if timeLoops(f, number) >= __SK.TIMEIT_MIN_TIME then
+					break
+				end
+				number = number * 10
+			end
+		end
+		memoryNumber = math.min(number, __SK.TIMEIT_MEMORY_NUMBER)
+		for i = 1, data["repeat"] or 7 do
+			times[i] = timeLoops(f, number)
+			if data.memory then
+				collectgarbage("collect")
+				collectgarbage("stop")
+				local before = collectgarbage("count")
+				for _ = 1, memoryNumber do
+					f()
+				end
+				memory[i] = collectgarbage("count") - before
+				collectgarbage("restart")
+			end
+		end
+	end)
+	-- Output printed by the cell isn't shown
+	__SK.getEchoOutput()
+	__SK._echoNodes = {}
+	if not success then
+		collectgarbage("restart")
+		return {{"error", tostring(err)}}
+	end
+	local result = {{"timer", timerName}, {"number", number}, {"times", times}}
+	if data.memory then
+		table.insert(result, {"memoryNumber", memoryNumber})
+		table.insert(result, {"memory", memory})
+	end
+	return result
+end
+
+-- Functions called on every Update of this state until they return true, for commands that span
+-- several frames. The addon calls __SK.RunTickers.
+__SK.tickers = {}
+
+function __SK.AddTicker(f)
+	table.insert(__SK.tickers, f)
+end
+
+function __SK.RunTickers()
+	for i = #__SK.tickers, 1, -1 do
+		local success, done = pcall(__SK.tickers[i])
+		if not success then
+			Spring.Log(__SK.LOG_SECTION, LOG.ERROR, "Ticker failed: " .. tostring(done))
+		end
+		if done or not success then
+			table.remove(__SK.tickers, i)
+		end
+	end
+end
+
+-- Sampling profiler for %profile, available where the debug library is
+__SK.PROFILE_MAX_DEPTH = 64 -- frames kept from the innermost one
+__SK.PROFILE_MAX_STACKS = 5000 -- samples in stacks beyond these are counted as "[other]"
+__SK.profiler = nil -- the running profiler
+
+-- Returns a profiler sampling the stack every interval VM instructions. Samples are aggregated into
+-- folded stacks: frames from the outermost to the innermost, separated by ";", mapped to how many
+-- samples were taken in them. Frames outside root, when given, are left out and root is named "cell".
+function __SK.NewProfiler(interval, root)
+	local getinfo, concat = debug.getinfo, table.concat
+	local maxDepth, maxStacks = __SK.PROFILE_MAX_DEPTH, __SK.PROFILE_MAX_STACKS
+	local profiler = {interval = interval, stacks = {}, stackCount = 0, samples = 0}
+	local frames = {}
+	profiler.hook = function()
+		-- level 1 is the hook itself
+		local level, depth = 2, 0
+		while true do
+			local info = getinfo(level, "Snf")
+			if not info then
+				break
+			end
+			depth = depth + 1
+			if depth > maxDepth then
+				frames[depth - 1] = "..."
+				depth = depth - 1
+				break
+			end
+			if info.func == root then
+				frames[depth] = "cell"
+				break
+			elseif info.what == "C" then
+				frames[depth] = (info.name or "?") .. " [C]"
+			else
+				local source = info.source
+				local prefix = source:sub(1, 1)
+				source = (prefix == "@" or prefix == "=") and source:sub(2) or info.short_src
+				frames[depth] = (info.name or "?") .. " " .. source .. ":" .. info.linedefined
+			end
+			level = level + 1
+		end
+		-- outermost first
+		for i = 1, math.floor(depth / 2) do
+			frames[i], frames[depth - i + 1] = frames[depth - i + 1], frames[i]
+		end
+		local stack = concat(frames, ";", 1, depth)
+		local stacks = profiler.stacks
+		if not stacks[stack] then
+			if profiler.stackCount >= maxStacks then
+				stack = "[other]"
+			else
+				profiler.stackCount = profiler.stackCount + 1
+			end
+		end
+		stacks[stack] = (stacks[stack] or 0) + 1
+		profiler.samples = profiler.samples + 1
+	end
+	return profiler
+end
+
+function __SK.StartProfiler(profiler)
+	profiler.previousHook = {debug.gethook()}
+	profiler.start = __SK.GetTimer()
+	__SK.profiler = profiler
+	debug.sethook(profiler.hook, "", profiler.interval)
+end
+
+-- Stops the profiler and returns its result. The hook that was set before is restored.
+function __SK.StopProfiler(profiler)
+	debug.sethook()
+	if type(profiler.previousHook[1]) == "function" then
+		debug.sethook(unpack(profiler.previousHook))
+	end
+	__SK.profiler = nil
+	return {
+		{"stacks", profiler.stacks},
+		{"samples", profiler.samples},
+		{"interval", profiler.interval},
+		{"duration", __SK.Elapsed(profiler.start)},
+	}
+end
+
+-- Profiles the code of a cell when there's any, else everything that runs in the state for the next
+-- data.frames frames. The reply for frames is sent once they have passed.
+function __SK.stateCommands.profile(data, id)
+	if not (debug and debug.sethook) then
+		return {{"error", "Cannot profile in this state: " .. tostring(Script.GetName()) .. ", synced: " .. tostring(Script.GetSynced())}}
+	end
+	if __SK.profiler then
+		return {{"error", "A profile is already being taken in this state"}}
+	end
+	local interval = data.interval or 10000
+	if data.code and data.code:find("%S") then
+		local f, err = loadstring(data.code, "=cell")
+		if not f then
+			return {{"error", err}}
+		end
+		setfenv(f, getfenv())
+		__SK.generation = __SK.generation + 1
+		local profiler = __SK.NewProfiler(interval, f)
+		__SK.StartProfiler(profiler)
+		local success, err = pcall(f)
+		local result = __SK.StopProfiler(profiler)
+		-- Output printed by the cell isn't shown
+		__SK.getEchoOutput()
+		__SK._echoNodes = {}
+		if not success then
+			table.insert(result, {"error", tostring(err)})
+		end
+		return result
+	end
+	local frames = data.frames or 30
+	local profiler = __SK.NewProfiler(interval)
+	__SK.StartProfiler(profiler)
+	__SK.AddTicker(function()
+		frames = frames - 1
+		if frames > 0 then
+			return false
+		end
+		local result = __SK.StopProfiler(profiler)
+		table.insert(result, {"frames", data.frames or 30})
+		__SK.SendReply(id, result)
+		return true
+	end)
+end
+
+-- Live expressions for %watch, by the number the kernel gave them. A watch is evaluated every few
+-- frames and only the scalars that changed since the last push are sent, as events of its request.
+__SK.watches = {}
+__SK.WATCH_MAX_ENTRIES = 1000 -- scalars of a value that are watched
+__SK.WATCH_MAX_DEPTH = 4
+
+-- Adds the scalars in value to values by path, e.g. values["units[1].x"] = 5, and returns how many
+-- there are. Tables deeper than WATCH_MAX_DEPTH and entries beyond WATCH_MAX_ENTRIES are left out.
+function __SK.FlattenValue(values, value, path, depth, count)
+	if count >= __SK.WATCH_MAX_ENTRIES then
+		return count
+	end
+	local t = type(value)
+	if t ~= "table" then
+		if t == "number" or t == "string" or t == "boolean" then
+			values[path] = value
+		else
+			values[path] = tostring(value)
+		end
+		return count + 1
+	end
+	if depth >= __SK.WATCH_MAX_DEPTH then
+		values[path] = "{ ... }"
+		return count + 1
+	end
+	for k, v in pairs(value) do
+		local child
+		if type(k) == "number" then
+			child = path .. "[" .. k .. "]"
+		elseif type(k) == "string" and k:find("^[%a_][%w_]*$") then
+			child = path == "" and k or path .. "." .. k
+		else
+			child = path .. "[" .. string.format("%q", tostring(k)) .. "]"
+		end
+		count = __SK.FlattenValue(values, v, child, depth + 1, count)
+		if count >= __SK.WATCH_MAX_ENTRIES then
+			break
+		end
+	end
+	return count
+end
+
+-- Returns the scalars that were set and the paths that were removed since last, or nil if nothing changed
+local function watchDelta(last, values)
+	local set, removed, changed = {}, {}, false
+	for path, v in pairs(values) do
+		if last[path] ~= v then
+			set[path] = v
+			changed = true
+		end
+	end
+	for path in pairs(last) do
+		if values[path] == nil then
+			removed[#removed + 1] = path
+			changed = true
+		end
+	end
+	return changed and set, removed
+end
+
+-- Evaluates the expression (or code returning a value) data.code every data.every frames: Updates, or
+-- game frames in synced code. Changes are pushed at most every data.minInterval seconds where there's a
+-- clock. The reply is only sent when the watch is stopped with unwatch.
+function __SK.stateCommands.watch(data, id)
+	local f, err = loadstring("return " .. data.code)
+	if not f then
+		f, err = loadstring(data.code)
+	end
+	if not f then
+		return {{"error", err}}
+	end
+	setfenv(f, getfenv())
+	local number = data.watch
+	local watch = {id = id, last = {}}
+	if __SK.watches[number] then
+		__SK.SendReply(__SK.watches[number].id, {{"stopped", true}})
+	end
+	__SK.watches[number] = watch
+	local _, now, since = __SK.Clock()
+	local every = math.max(1, data.every or 1)
+	local minInterval = data.minInterval or 0
+	local frame = 0
+	__SK.AddTicker(function()
+		if __SK.watches[number] ~= watch then
+			return true
+		end
+		frame = frame + 1
+		if frame % every ~= 0 or (watch.pushed and since(watch.pushed) < minInterval) then
+			return false
+		end
+		local success, value = pcall(f)
+		if not success then
+			value = tostring(value)
+			if value ~= watch.error then
+				watch.error = value
+				__SK.SendToKernel({id = id, event = "watch", data = {error = value}})
+			end
+			return false
+		end
+		watch.error = nil
+		local values = {}
+		__SK.FlattenValue(values, value, "", 0, 0)
+		local set, removed = watchDelta(watch.last, values)
+		if set then
+			__SK.SendToKernel({id = id, event = "watch", data = {set = set, removed = removed}})
+			watch.last = values
+			watch.pushed = now and now()
+		end
+		return false
 	end)
-	return matches
+end
+
+-- Stops the watches listed in data.watches, their requests are answered
+function __SK.stateCommands.unwatch(data)
+	local stopped = {}
+	for _, number in ipairs(data.watches or {}) do
+		local watch = __SK.watches[number]
+		if watch then
+			__SK.watches[number] = nil
+			__SK.SendReply(watch.id, {{"stopped", true}})
+			stopped[#stopped + 1] = number
+		end
+	end
+	return {{"stopped", stopped}}
+end
+
+-- Call-in cost monitor for %callins. Every call-in of every addon registered with the widget or
+-- gadget handler is wrapped with a timer for a number of frames.
+__SK.callinMonitor = nil -- the running monitor
+
+-- Returns the name of an addon, as given by its GetInfo
+function __SK.AddonName(addon)
+	local info = addon.whInfo or addon.ghInfo
+	if not info and type(addon.GetInfo) == "function" then
+		local success, result = pcall(addon.GetInfo, addon)
+		info = success and result
+	end
+	return type(info) == "table" and info.name or tostring(addon)
+end
+
+-- Wraps the call-ins of the addons in the handler's lists (e.g. widgetHandler.UpdateList) with
+-- timers. Returns the monitor, which collects the calls, total and max seconds of each call-in by
+-- addon.
+function __SK.StartCallinMonitor(handler)
+	local clockName, now, since = __SK.Clock()
+	local monitor = {clock = clockName, stats = {}, wrapped = {}}
+	local function finish(stat, start, ...)
+		local seconds = since(start)
+		stat.calls = stat.calls + 1
+		stat.total = stat.total + seconds
+		if seconds > stat.max then
+			stat.max = seconds
+		end
+		return ...
+	end
+	for listName, list in pairs(handler) do
+		if type(listName) == "string" and listName:sub(-4) == "List" and type(list) == "table" then
+			local callin = listName:sub(1, -5)
+			for _, addon in ipairs(list) do
+				local f = type(addon) == "table" and addon[callin]
+				if type(f) == "function" then
+					local stat = {addon = __SK.AddonName(addon), callin = callin, calls = 0, total = 0, max = 0}
+					local wrapper = function(...)
+						return finish(stat, now(), f(...))
+					end
+					table.insert(monitor.stats, stat)
+					table.insert(monitor.wrapped, {addon, callin, rawget(addon, callin), wrapper})
+					rawset(addon, callin, wrapper)
+				end
+			end
+		end
+	end
+	__SK.callinMonitor = monitor
+	return monitor
+end
+
+-- Restores the call-ins wrapped by the monitor and returns its statistics, in milliseconds
+function __SK.StopCallinMonitor(monitor)
+	for _, wrapped in ipairs(monitor.wrapped) do
+		local addon, callin, original, wrapper = unpack(wrapped, 1, 4)
+		-- Unless the addon replaced it in the meantime
+		if rawget(addon, callin) == wrapper then
+			rawset(addon, callin, original)
+		end
+	end
+	__SK.callinMonitor = nil
+	local rows = {}
+	for _, stat in ipairs(monitor.stats) do
+		if stat.calls > 0 then
+			table.insert(rows, {stat.addon, stat.callin, stat.calls, stat.total * 1000, stat.max * 1000})
+		end
+	end
+	return rows
+end
+
+-- Monitors the call-ins of the addons of this state for data.frames frames: Updates, or game frames
+-- in synced code. The reply is sent once they have passed.
+function __SK.stateCommands.callins(data, id)
+	local handler = widgetHandler or gadgetHandler
+	if type(handler) ~= "table" then
+		return {{"error", "No widget or gadget handler in this state"}}
+	end
+	if not __SK.Clock() then
+		return {{"error", "No timer is available in this state"}}
+	end
+	if __SK.callinMonitor then
+		return {{"error", "Call-ins are already being monitored in this state"}}
+	end
+	local frames = data.frames or 100
+	local monitor = __SK.StartCallinMonitor(handler)
+	local left = frames
+	__SK.AddTicker(function()
+		left = left - 1
+		if left > 0 then
+			return false
+		end
+		__SK.SendReply(id, {
+			{"rows", __SK.StopCallinMonitor(monitor)},
+			{"frames", frames},
+			{"clock", monitor.clock},
+		})
+		return true
+	end)
+end
+
+-- How long the stages of each request took in this state, in milliseconds. They are sent to the
+-- kernel right before the reply, see %timing.
+__SK.timings = {}
+
+-- Timers aren't available in synced code, where these return nil
+function __SK.GetTimer()
+	return Spring.GetTimer and Spring.GetTimer()
+end
+
+function __SK.Elapsed(start)
+	return start and Spring.DiffTimers(Spring.GetTimer(), start) * 1000
+end
+
+function __SK.AddTiming(id, stage, ms)
+	if id and ms then
+		local timing = __SK.timings[id] or {}
+		timing[stage] = (timing[stage] or 0) + ms
+		__SK.timings[id] = timing
+	end
+end
+
+-- Replies are tagged with the id of the request they answer.
+-- Binary blobs (strings) can only be sent from the widget.
+function __SK.SendReply(id, result, blobs)
+	__SK.SendToKernel({id = id, result = result}, blobs)
+end
+
+-- Describes this Lua state for the kernel: whether the debug library (%profile) and coroutines
+-- (%async) are there, the clock it times with and the commands it runs
+function __SK.StateInfo(state)
+	local commands = {}
+	for name in pairs(__SK.stateCommands) do
+		table.insert(commands, name)
+	end
+	table.sort(commands)
+	return {
+		state = state,
+		synced = Script.GetSynced and Script.GetSynced() or false,
+		debug = debug ~= nil and debug.sethook ~= nil,
+		coroutines = coroutine ~= nil,
+		clock = (__SK.Clock()) or false,
+		commands = commands,
+	}
+end
+
+-- Sent by the widget once it's connected, the gadget's states announce themselves with a state event
+function __SK.stateCommands.hello(data)
+	__SK.SendToKernel({event = "state", data = __SK.StateInfo(data.state)})
+end
+
+function __SK.RunStateCommand(request)
+	local f = __SK.stateCommands[request.command]
+	if not f then
+		__SK.SendReply(request.id, {{"No such command found: " .. tostring(request.command), "error"}})
+		return
+	end
+	local start = __SK.GetTimer()
+	local result = f(request.data, request.id)
+	__SK.AddTiming(request.id, "run", __SK.Elapsed(start))
+	if result ~= nil then
+		__SK.SendReply(request.id, result)
+	end
+end
+
+__SK._MAX_SOURCE_FILES = 32 -- source files kept loaded for _source
+__SK._sourceFiles = {}
+__SK._sourceFileCount = 0
+
+-- Returns a source file's text and the offsets at which each of its lines start, or nil if it can't
+-- be loaded. Files are only loaded and scanned once, lines are then cut out of the text directly.
+function __SK.SourceFile(name)
+	local file = __SK._sourceFiles[name]
+	if file then
+		return file
+	end
+	local text = VFS.LoadFile(name, nil, VFS.DEF)
+	if not text then
+		return nil
+	end
+	local offsets = {1}
+	local pos = text:find("\n", 1, true)
+	while pos do
+		offsets[#offsets + 1] = pos + 1
+		pos = text:find("\n", pos + 1, true)
+	end
+	if __SK._sourceFileCount >= __SK._MAX_SOURCE_FILES then
+		__SK._sourceFiles = {}
+		__SK._sourceFileCount = 0
+	end
+	file = {text = text, offsets = offsets}
+	__SK._sourceFiles[name] = file
+	__SK._sourceFileCount = __SK._sourceFileCount + 1
+	return file
 end
 
 -- returns information about a function
@@ -217,18 +1231,18 @@ function _source(f)
 	if not debug then
 		return "Cannot get function information in this state: " .. tostring(Script.GetName()) .. ", synced: " .. tostring(Script.GetSynced())
 	end
-    local info = debug.getinfo(f)
+    local info = debug.getinfo(f, "S")
     if info.what == 'Lua' then
-        local f = VFS.LoadFile(info.source, nil, VFS.DEF)
-		if not f then
+        local file = __SK.SourceFile(info.source)
+		if not file or info.linedefined < 1 or not file.offsets[info.linedefined] then
 			return "No code available for Lua function."
 		end
-        local lines = __SK.explode('\n', f)
-        local code = ""
-        for i = info.linedefined, info.lastlinedefined do
-            code = code .. lines[i] .. "\n"
-        end
-        return code
+		local last = file.offsets[info.lastlinedefined + 1] or #file.text + 1
+		local code = file.text:sub(file.offsets[info.linedefined], last - 1)
+		if code:sub(-1) ~= "\n" then
+			code = code .. "\n"
+		end
+		return code
     else
         return "No code preview available for engine function"
     end
@@ -240,20 +1254,35 @@ end
 
 __SK.WRITE_DATA_DIR = nil
 -- extremely ugly way to find our data dir absolute path
+-- The directory Spring writes files to, such as screenshots, ending with a separator.
+-- infolog.txt is always there; older engines without VFS.GetFileAbsolutePath log the directory near
+-- the start of it, only that part is read.
+__SK.INFOLOG_SCAN_LINES = 200
 function __SK.GetWriteDataDir()
 	if __SK.WRITE_DATA_DIR then
 		return __SK.WRITE_DATA_DIR
 	end
-
-	local dataDirStr = "write data directory: "
-	lines = __SK.explode("\n", VFS.LoadFile("infolog.txt", nil, VFS.RAW))
-	dataDir = ""
-	for i, line in pairs(lines) do
-	    if line:find(dataDirStr) then
-	        dataDir = line:sub(line:find(dataDirStr) + #dataDirStr)
-	        break
-	    end
+	local dataDir
+	if VFS.GetFileAbsolutePath then
+		local path = VFS.GetFileAbsolutePath("infolog.txt")
+		dataDir = path and path:match("^(.*[/\\])")
+	end
+	if not dataDir and io and io.open then
+		local f = io.open("infolog.txt", "r")
+		if f then
+			for _ = 1, __SK.INFOLOG_SCAN_LINES do
+				local line = f:read("*l")
+				if not line then
+					break
+				end
+				dataDir = line:match("write data directory: ([^\r]*)")
+				if dataDir then
+					break
+				end
+			end
+			f:close()
+		end
 	end
-	__SK.WRITE_DATA_DIR = dataDir
+	__SK.WRITE_DATA_DIR = dataDir or ""
 	return __SK.WRITE_DATA_DIR
 end
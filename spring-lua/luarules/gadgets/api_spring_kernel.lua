@@ -23,79 +23,65 @@ function gadget:Initialize()
 	end
 end
 
-function __SK.ExecuteLua(args)
-	msg = {}
-	if args.state == "sluarules" then
-		local success, error = __SK.ExecuteLuaCommand(args.code)
-		if not success then
-			table.insert(msg, {error, "error"})
-		end
-		table.insert(msg, {__SK.getEchoOutput(), "output"})
-		SendToUnsynced("kernelSendToUnsynced", __SK.json.encode(msg))
-	elseif args.state == "uluarules" then
-		SendToUnsynced("kernelExecuteUnsynced", __SK.json.encode(args))
-	end
+-- Synced code has no Update, tickers run every game frame
+function gadget:GameFrame()
+	__SK.RunTickers()
 end
 
-function __SK.Autocomplete(args)
-	msg = {}
-	if args.state == "sluarules" then
-		local matches = __SK.autocomplete(args.code)
-		table.insert(msg, {"matches", matches})
-		SendToUnsynced("kernelSendToUnsynced", __SK.json.encode(msg))
-	elseif args.state == "uluarules" then
-		SendToUnsynced("kernelAutocompleteUnsynced", __SK.json.encode(args))
-	end
+-- Replies carry their request id, so the widget can time the gadget's part of the request
+function __SK.SendToKernel(msg)
+	SendToUnsynced("kernelSendToUnsynced", __SK.json.encode(msg), msg.result ~= nil and msg.id or nil)
 end
 
-function gadget:RecvLuaMsg(msg)
-	local msg_table = __SK.explode('|', msg)
-	if msg_table[1] == "spring_kernel_ex" then
-		local success, obj = pcall(__SK.json.decode, msg_table[2])
-		if not success then
-			Spring.Log(__SK.LOG_SECTION, LOG.ERROR, "Failed to parse JSON: " .. tostring(msg_table[2]))
-			Spring.Log(__SK.LOG_SECTION, LOG.ERROR, debug.traceback())
-			return
-		end
-		__SK.ExecuteLua(obj)
-	elseif msg_table[1] == "spring_kernel_autocomplete" then
-		local success, obj = pcall(__SK.json.decode, msg_table[2])
-		if not success then
-			Spring.Log(__SK.LOG_SECTION, LOG.ERROR, "Failed to parse JSON: " .. tostring(msg_table[2]))
-			Spring.Log(__SK.LOG_SECTION, LOG.ERROR, debug.traceback())
-			return
-		end
-		__SK.Autocomplete(obj)
+__SK.MSG_PREFIX = "spring_kernel|"
+__SK.requestChunks = __SK.NewChunkReceiver()
+
+-- Requests from the widget arrive in chunks, see __SK.DoGadget
+function gadget:RecvLuaMsg(msg, playerID)
+	if msg:sub(1, #__SK.MSG_PREFIX) ~= __SK.MSG_PREFIX then
+		return
+	end
+	local payload = __SK.ReceiveChunk(__SK.requestChunks, msg:sub(#__SK.MSG_PREFIX + 1), playerID)
+	if not payload then
+		return
+	end
+	local success, obj = pcall(__SK.json.decode, payload)
+	if not success then
+		Spring.Log(__SK.LOG_SECTION, LOG.ERROR, "Failed to parse JSON: " .. tostring(payload))
+		Spring.Log(__SK.LOG_SECTION, LOG.ERROR, debug.traceback())
+		return
+	end
+	if obj.data.state == "sluarules" then
+		__SK.RunStateCommand(obj)
+	elseif obj.data.state == "uluarules" then
+		SendToUnsynced("kernelRunUnsynced", payload)
 	end
 end
 
 -- UNSYNCED
 else
 
-function __SK.UnsyncedToWidget(_, data)
+-- Messages are encoded once, in the state they come from, and sent to the kernel by the widget as they are.
+-- Replies come with their request id and how long the unsynced gadget ran and encoded them.
+function __SK.UnsyncedToWidget(_, data, replyId, run, encode)
     if Script.LuaUI('SK_RecieveGadgetMessage') then
-        Script.LuaUI.SK_RecieveGadgetMessage(data)
+        Script.LuaUI.SK_RecieveGadgetMessage(data, replyId, run, encode)
     end
 end
 
-function __SK.ExecuteInUnsynced(_, data)
-	local success, obj = pcall(__SK.json.decode, data)
-	if not success then
-		Spring.Log(__SK.LOG_SECTION, LOG.ERROR, "Failed to parse JSON: " .. tostring(data))
-		Spring.Log(__SK.LOG_SECTION, LOG.ERROR, debug.traceback())
+function __SK.SendToKernel(msg)
+	local start = __SK.GetTimer()
+	local encoded = __SK.json.encode(msg)
+	if msg.result == nil then
+		__SK.UnsyncedToWidget(nil, encoded)
 		return
 	end
-
-	local success, error = __SK.ExecuteLuaCommand(obj.code)
-	local msg = {}
-	if not success then
-		table.insert(msg, {error, "error"})
-	end
-	table.insert(msg, {__SK.getEchoOutput(), "output"})
-	__SK.UnsyncedToWidget(nil, __SK.json.encode(msg))
+	local timing = __SK.timings[msg.id] or {}
+	__SK.timings[msg.id] = nil
+	__SK.UnsyncedToWidget(nil, encoded, msg.id, timing.run, __SK.Elapsed(start))
 end
 
-function __SK.AutocompleteInUnsynced(_, data)
+function __SK.RunInUnsynced(_, data)
 	local success, obj = pcall(__SK.json.decode, data)
 	if not success then
 		Spring.Log(__SK.LOG_SECTION, LOG.ERROR, "Failed to parse JSON: " .. tostring(data))
@@ -103,10 +89,11 @@ function __SK.AutocompleteInUnsynced(_, data)
 		return
 	end
 
-	local matches = __SK.autocomplete(args.code)
-	table.insert(msg, {"matches", matches})
-	local msg = {}
-	__SK.UnsyncedToWidget(nil, __SK.json.encode(msg))
+	__SK.RunStateCommand(obj)
+end
+
+function gadget:Update()
+	__SK.RunTickers()
 end
 
 function gadget:Initialize()
@@ -117,8 +104,7 @@ function gadget:Initialize()
 		return
 	end
 
-	gadgetHandler:AddSyncAction('kernelExecuteUnsynced', __SK.ExecuteInUnsynced)
-	gadgetHandler:AddSyncAction('kernelAutocompleteUnsynced', __SK.AutocompleteInUnsynced)
+	gadgetHandler:AddSyncAction('kernelRunUnsynced', __SK.RunInUnsynced)
 	gadgetHandler:AddSyncAction('kernelSendToUnsynced', __SK.UnsyncedToWidget)
 end
 
@@ -1,4 +1,5 @@
 VFS.Include(KERNEL_FOLDER .. "kernel_utils.lua")
+__SK.msgpack = VFS.Include(KERNEL_FOLDER .. "msgpack.lua")
 
 function widget:GetInfo()
 	return {
@@ -18,116 +19,385 @@ __SK.socket = socket
 
 __SK.host, __SK.port = nil, nil
 __SK.client = nil
-__SK.buffer = ""
 __SK.commands = {} -- table with possible commands
+__SK.requestStarts = {} -- when requests were received, by id
 __SK.isConnected = false
+__SK.connectStart = nil -- when the pending connection attempt started
+__SK.RECONNECT_MIN_DELAY = 0.5 -- seconds before reconnecting, doubled after every failed attempt
+__SK.RECONNECT_MAX_DELAY = 30
+__SK.CONNECT_TIMEOUT = 5 -- seconds a connection attempt may take
+__SK.reconnectDelay = __SK.RECONNECT_MIN_DELAY
+__SK.reconnectAt = nil -- when the connection was lost
+__SK.reconnectWait = 0 -- seconds to wait after that before reconnecting
+__SK.CODECS = {"msgpack", "json"} -- offered to the kernel, which picks the one to use
+__SK.codec = "json" -- codec messages are encoded with, until the kernel picks another
+
+-- framing related
+__SK.FRAME_HEADER_SIZE = 4
+__SK.recvPieces = {} -- received data not yet split into frames
+__SK.recvSize = 0 -- total size of recvPieces
+__SK.frameSize = nil -- size of the frame being received, once its header is read
+__SK.sendQueue = {} -- outgoing data that the socket hasn't accepted yet
+__SK.sendOffset = 0 -- bytes of sendQueue[1] already sent
+__SK.RECV_FRAME_BUDGET = 256 * 1024 -- bytes read from the socket per frame
+__SK.COMMAND_FRAME_BUDGET = 2 -- milliseconds spent running received commands per frame, at least one runs
+__SK.commandQueue = {} -- received frames waiting to be run, with when they were read
 
 -- drawing related
 __SK.screenTex = nil
 __SK.vsx, __SK.vsy = 0, 0
-__SK.draw_requested = false
+__SK.drawRequests = {} -- show requests waiting for the next draw frame
+__SK.captureCount = 0 -- used to give each screenshot a unique file name
+-- Tells apart the screenshots of engines sharing a write dir, they all count from 1
+__SK.captureToken = string.format("%x%04x", os.time(), math.random(0, 65535))
+__SK.recordings = {} -- active %record captures
+__SK.RECORD_MAX_QUEUE = 8 -- recorded frames are dropped while more pieces than this wait to be sent
+__SK.scaledTex = nil
+__SK.scaledTexW, __SK.scaledTexH = 0, 0
 
 --------------------------------------------------------------------------------
 --------------------------------------------------------------------------------
 -- Connectivity and sending
 
+-- Name the kernel knows this engine by, several engines can be connected to one kernel
+function __SK.GetEngineName()
+	local name = Spring.GetConfigString and Spring.GetConfigString("SpringKernelName", "") or ""
+	if name ~= "" then
+		return name
+	end
+	if Spring.GetMyPlayerID and Spring.GetPlayerInfo then
+		name = Spring.GetPlayerInfo(Spring.GetMyPlayerID())
+		if name and name ~= "" then
+			return name
+		end
+	end
+	return "spring"
+end
+
+-- The hello message tells the kernel about the engine, so it doesn't need to ask
+function __SK.HelloData()
+	local state = Script.GetName() == "LuaMenu" and "luamenu" or "luaui"
+	local capabilities = {}
+	for name in pairs(__SK.commands) do
+		table.insert(capabilities, name)
+	end
+	table.sort(capabilities)
+	return {
+		name = __SK.GetEngineName(),
+		codecs = __SK.CODECS,
+		version = Engine and Engine.version or Game.version,
+		game = Game.gameName and (Game.gameName .. " " .. tostring(Game.gameVersion)) or nil,
+		writeDir = __SK.GetWriteDataDir(),
+		capabilities = capabilities,
+		states = {[state] = __SK.StateInfo(state)},
+	}
+end
+
+-- Asks the gadget's states to announce themselves, nothing answers without the gadget
+function __SK.AnnounceStates()
+	if Script.GetName() == "LuaMenu" then
+		return
+	end
+	for _, state in ipairs({"sluarules", "uluarules"}) do
+		__SK.QueueChunks(__SK.luaRulesChunks, __SK.json.encode({command = "hello", data = {state = state}}))
+	end
+end
+
+-- Stops what the kernel left running once it's gone: watches, async cells and recordings would keep
+-- running for nobody, and the gadget's states are told to stop theirs
+function __SK.DropKernelRequests()
+	__SK.DropKernelWork()
+	__SK.recordings = {}
+	__SK.drawRequests = {}
+	if Script.GetName() == "LuaMenu" then
+		return
+	end
+	for _, state in ipairs({"sluarules", "uluarules"}) do
+		__SK.QueueChunks(__SK.luaRulesChunks, __SK.json.encode({command = "disconnect", data = {state = state}}))
+	end
+end
+
+-- Starts connecting without blocking, widget:Update notices when the connection is established
 function __SK.SocketConnect(host, port)
-	__SK.client=socket.tcp()
+	__SK.ResetFraming()
+	__SK.client = socket.tcp()
 	__SK.client:settimeout(0)
-	res, err = __SK.client:connect(host, port)
-	if not res and not res=="timeout" then
-		widgetHandler:RemoveWidget(self)
-		Spring.Log(__SK.LOG_SECTION, LOG.ERROR, "Error in connecting: " .. err)
+	__SK.connectStart = Spring.GetTimer()
+	__SK.codec = "json"
+	-- Queued until the connection is established
+	__SK.SendToKernel({event = "hello", data = __SK.HelloData()})
+	local res, err = __SK.client:connect(host, port)
+	if res then
+		__SK.Connected()
+	elseif err ~= "timeout" then
+		__SK.Disconnect("Error in connecting: " .. tostring(err))
 		return false
-	elseif not res=="timeout" then
-		Spring.Log(__SK.LOG_SECTION, LOG.NOTICE, "Successfully connected to host.")
 	end
 	return true
 end
 
-__SK.SpringKernel = {}
---------------------------------------------------------------------------------
---------------------------------------------------------------------------------
--- Callin Functions
+function __SK.Connected()
+	__SK.isConnected = true
+	__SK.connectStart = nil
+	__SK.reconnectDelay = __SK.RECONNECT_MIN_DELAY
+	Spring.Log(__SK.LOG_SECTION, LOG.NOTICE, "Connected to " .. tostring(__SK.host) .. ":" .. tostring(__SK.port))
+	__SK.FlushSend()
+	__SK.AnnounceStates()
+end
 
-function __SK.DoGadget(cmd)
-	local msg = "spring_kernel_ex|" .. __SK.json.encode(cmd)
-	Spring.SendLuaRulesMsg(msg)
+-- Drops the connection. Reconnecting waits longer after every attempt that fails, so a kernel
+-- that isn't running costs nothing but a timer check per frame.
+function __SK.Disconnect(reason)
+	if __SK.client then
+		__SK.client:close()
+		__SK.client = nil
+	end
+	if __SK.isConnected then
+		Spring.Log(__SK.LOG_SECTION, LOG.NOTICE, reason or "Connection closed")
+		__SK.DropKernelRequests()
+	elseif reason then
+		Spring.Log(__SK.LOG_SECTION, LOG.DEBUG, reason)
+	end
+	__SK.isConnected = false
+	__SK.connectStart = nil
+	__SK.ResetFraming()
+	__SK.commandQueue = {}
+	__SK.reconnectAt = Spring.GetTimer()
+	__SK.reconnectWait = __SK.reconnectDelay
+	__SK.reconnectDelay = math.min(__SK.reconnectDelay * 2, __SK.RECONNECT_MAX_DELAY)
 end
 
-function __SK.AutocompleteGadget(cmd)
-	local msg = "spring_kernel_autocomplete|" .. __SK.json.encode(cmd)
-	Spring.SendLuaRulesMsg(msg)
+-- Every message is sent as a frame: 4 byte big-endian payload size followed by the payload
+function __SK.EncodeFrameHeader(size)
+	return string.char(
+		math.floor(size / 16777216) % 256,
+		math.floor(size / 65536) % 256,
+		math.floor(size / 256) % 256,
+		size % 256)
 end
 
-function __SK.ExecuteLua(args)
-	local msg = {}
-	if args.state == "luaui" or args.state == "luamenu" then
-		local success, error = __SK.ExecuteLuaCommand(args.code)
-		if not success then
-			table.insert(msg, {error, "error"})
+function __SK.DecodeFrameHeader(header)
+	local b1, b2, b3, b4 = header:byte(1, 4)
+	return ((b1 * 256 + b2) * 256 + b3) * 256 + b4
+end
+
+-- Adds received data and returns the payloads of all frames completed by it.
+-- Pieces are only joined once a whole header or frame is available, then the frames
+-- are taken out by walking an offset through them and only the unread tail is kept.
+function __SK.ReceiveData(data)
+	__SK.recvPieces[#__SK.recvPieces + 1] = data
+	__SK.recvSize = __SK.recvSize + #data
+	local needed = __SK.frameSize or __SK.FRAME_HEADER_SIZE
+	local frames = {}
+	if __SK.recvSize < needed then
+		return frames
+	end
+	local buffer = table.concat(__SK.recvPieces)
+	local offset = 0 -- bytes of buffer already taken out
+	while #buffer - offset >= needed do
+		if __SK.frameSize then
+			frames[#frames + 1] = buffer:sub(offset + 1, offset + needed)
+			__SK.frameSize = nil
+		else
+			__SK.frameSize = __SK.DecodeFrameHeader(buffer:sub(offset + 1, offset + needed))
 		end
-		table.insert(msg, {__SK.getEchoOutput(), "output"})
-		__SK.SpringKernel.WriteOutput(msg)
-	elseif args.state == "sluarules" or args.state == "uluarules" then
-		__SK.DoGadget(args)
-	else
-		table.insert(msg, {"Invalid state: " .. tostring(args.state), "error"})
-		__SK.SpringKernel.WriteOutput(msg)
+		offset = offset + needed
+		needed = __SK.frameSize or __SK.FRAME_HEADER_SIZE
 	end
+	local rest = buffer:sub(offset + 1)
+	__SK.recvPieces = { rest }
+	__SK.recvSize = #rest
+	return frames
 end
 
-function __SK.Autocomplete(args)
-	local msg = {}
-	if args.state == "luaui" or args.state == "luamenu" then
-		local matches = __SK.autocomplete(args.code)
-		table.insert(msg, {"matches", matches})
-		__SK.SpringKernel.WriteOutput(msg)
-	elseif args.state == "sluarules" or args.state == "uluarules" then
-		__SK.AutocompleteGadget(args)
+function __SK.ResetFraming()
+	__SK.recvPieces = {}
+	__SK.recvSize = 0
+	__SK.frameSize = nil
+	__SK.sendQueue = {}
+	__SK.sendOffset = 0
+end
+
+-- Sends as much of the queued data as the socket accepts without blocking
+function __SK.FlushSend()
+	local queue = __SK.sendQueue
+	while #queue > 0 and __SK.client do
+		local data = queue[1]
+		local last, err, partial = __SK.client:send(data, __SK.sendOffset + 1)
+		last = last or partial or __SK.sendOffset
+		if last >= #data then
+			table.remove(queue, 1)
+			__SK.sendOffset = 0
+		else
+			__SK.sendOffset = last
+			if err == "closed" then
+				__SK.Disconnect("Connection closed while sending")
+			end
+			return
+		end
+	end
+end
+
+-- Messages are only queued while connected or connecting, the ones sent in between are dropped
+function __SK.SendFrame(payload)
+	if not __SK.client then
+		return
+	end
+	table.insert(__SK.sendQueue, __SK.EncodeFrameHeader(#payload))
+	table.insert(__SK.sendQueue, payload)
+	if __SK.isConnected then
+		__SK.FlushSend()
+	end
+end
+
+__SK.SpringKernel = {}
+--------------------------------------------------------------------------------
+--------------------------------------------------------------------------------
+-- Callin Functions
+
+__SK.gadgetRequests = {} -- when requests were passed on to the gadget, by id
+__SK.luaRulesChunks = __SK.NewChunkSender(function(chunk)
+	Spring.SendLuaRulesMsg("spring_kernel|" .. chunk)
+end)
+
+-- Sends a request to the gadget, as it was received from the kernel when raw is given.
+-- It's sent in chunks over the next frames, see __SK.FlushChunks.
+function __SK.DoGadget(request, raw)
+	__SK.gadgetRequests[request.id] = __SK.GetTimer()
+	__SK.QueueChunks(__SK.luaRulesChunks, raw or __SK.json.encode(request))
+end
+
+-- Runs a command in the Lua state it targets, LuaRules states are handled by the gadget
+function __SK.RunInState(request, raw)
+	local state = request.data and request.data.state
+	if state == "luaui" or state == "luamenu" then
+		__SK.RunStateCommand(request)
+	elseif state == "sluarules" or state == "uluarules" then
+		__SK.DoGadget(request, raw)
 	else
-		table.insert(msg, {"Invalid state: " .. tostring(args.state), "error"})
-		__SK.SpringKernel.WriteOutput(msg)
+		__SK.SendReply(request.id, {{"Invalid state: " .. tostring(state), "error"}})
 	end
 end
 
-function __SK.ShowScreen()
-	__SK.draw_requested = true
+function __SK.ShowScreen(request)
+	table.insert(__SK.drawRequests, request)
 	-- It will be drawn in the next opengl frame
 end
 
--- Callin from gadgets
-function __SK.RecieveGadgetMessage(msg)
-	local success, obj = pcall(__SK.json.decode, msg)
-	if not success then
-		Spring.Log(__SK.LOG_SECTION, LOG.ERROR, "Failed to parse JSON: " .. tostring(msg))
-		Spring.Log(__SK.LOG_SECTION, LOG.ERROR, debug.traceback())
-		return
-	end
+function __SK.StartRecording(request)
+	local data = request.data or {}
+	table.insert(__SK.recordings, {
+		id = request.id,
+		every = math.max(1, data.every or 1),
+		duration = data.duration or 3,
+		maxFrames = data.maxFrames or 300,
+		scale = data.scale,
+		frame = 0,
+		count = 0,
+		dropped = 0,
+		start = Spring.GetTimer(),
+	})
+end
 
-	__SK.SpringKernel.WriteOutput(obj)
+-- Callin from gadgets, msg is already encoded for the kernel.
+-- Replies come with their request id and the time the unsynced gadget spent running and encoding them.
+function __SK.RecieveGadgetMessage(msg, replyId, run, encode)
+	if replyId then
+		local hop = __SK.Elapsed(__SK.gadgetRequests[replyId])
+		__SK.gadgetRequests[replyId] = nil
+		__SK.AddTiming(replyId, "run", run)
+		__SK.AddTiming(replyId, "encode", encode)
+		__SK.AddTiming(replyId, "luarules", hop and hop - (run or 0) - (encode or 0))
+		__SK.SendTiming(replyId)
+	end
+	__SK.SendFrame(msg or "{}")
 end
 
-__SK.commands["execute"] = __SK.ExecuteLua
-__SK.commands["autocomplete"] = __SK.Autocomplete
+__SK.commands["execute"] = __SK.RunInState
+__SK.commands["autocomplete"] = __SK.RunInState
+__SK.commands["inspect"] = __SK.RunInState
+__SK.commands["expand"] = __SK.RunInState
+__SK.commands["timeit"] = __SK.RunInState
+__SK.commands["profile"] = __SK.RunInState
+__SK.commands["callins"] = __SK.RunInState
+__SK.commands["watch"] = __SK.RunInState
+__SK.commands["unwatch"] = __SK.RunInState
+__SK.commands["cancel"] = __SK.RunInState
 __SK.commands["show"] = __SK.ShowScreen
+__SK.commands["record"] = __SK.StartRecording
 --------------------------------------------------------------------------------
 --------------------------------------------------------------------------------
 -- Callout Functions
 
 
 
-function __SK.SpringKernel.WriteOutput(msg)
-	-- NOTICE: The gsub part fixes an issue with incorrectly formatted json
-	local encoded = __SK.json.encode(msg)
+-- Encodes a message with the codec the kernel picked, returns nil if it can't be encoded
+function __SK.EncodeMessage(msg)
+	if __SK.codec ~= "msgpack" then
+		local encoded = __SK.json.encode(msg)
+		Spring.Log(__SK.LOG_SECTION, LOG.DEBUG, encoded)
+		return encoded
+	end
+	local success, encoded = pcall(__SK.msgpack.encode, msg)
+	if not success then
+		Spring.Log(__SK.LOG_SECTION, LOG.ERROR, "Error encoding message: " .. tostring(encoded))
+		return nil
+	end
+	return encoded
+end
+
+-- Returns the size of the encoding of value and the milliseconds each encoding takes on average, by codec
+function __SK.BenchmarkCodecs(value, repeats)
+	repeats = repeats or 10
+	local results = {}
+	for name, encode in pairs({json = __SK.json.encode, msgpack = __SK.msgpack.encode}) do
+		local start = Spring.GetTimer()
+		local encoded
+		for _ = 1, repeats do
+			encoded = encode(value)
+		end
+		local elapsed = Spring.DiffTimers(Spring.GetTimer(), start, true)
+		results[name] = {size = encoded and #encoded, ms = elapsed / repeats}
+	end
+	return results
+end
+
+-- Sends the timing of a request as an event, right before its reply
+function __SK.SendTiming(id)
+	local timing = __SK.timings[id]
+	if not timing then
+		return
+	end
+	timing.total = __SK.Elapsed(__SK.requestStarts[id])
+	__SK.timings[id] = nil
+	__SK.requestStarts[id] = nil
+	__SK.SendFrame(__SK.EncodeMessage({id = id, event = "timing", data = timing}))
+end
+
+-- Sends a message to the kernel. Binary blobs are sent as raw frames right after it,
+-- the message tells the kernel how many follow.
+function __SK.SpringKernel.WriteOutput(msg, blobs)
+	if blobs then
+		msg.blobs = #blobs
+	end
+	local start = __SK.GetTimer()
+	local encoded = __SK.EncodeMessage(msg)
 	if not encoded then
-		__SK.client:send("{} \n")
+		__SK.SendFrame("{}")
 		return
 	end
-	Spring.Log(__SK.LOG_SECTION, LOG.DEBUG, encoded)
-	__SK.client:send(encoded .. "\n")
+	if msg.result ~= nil then
+		__SK.AddTiming(msg.id, "encode", __SK.Elapsed(start))
+		__SK.SendTiming(msg.id)
+	end
+	__SK.SendFrame(encoded)
+	for _, blob in ipairs(blobs or {}) do
+		__SK.SendFrame(blob)
+	end
 end
 
+__SK.SendToKernel = __SK.SpringKernel.WriteOutput
+
 --------------------------------------------------------------------------------
 --------------------------------------------------------------------------------
 -- Widget Interface
@@ -159,12 +429,21 @@ function widget:Initialize()
 	widget:ViewResize()
 end
 
--- pocesses raw string line and executes command
-function __SK.CommandReceived(command)
+-- pocesses raw string line and executes command, received is when it was read from the socket
+function __SK.CommandReceived(command, received)
+	local start = __SK.GetTimer()
 	local success, obj = pcall(__SK.json.decode, command)
+	if success and type(obj) == "table" and obj.id then
+		__SK.requestStarts[obj.id] = received or start
+		__SK.AddTiming(obj.id, "queue", received and __SK.Elapsed(received) - __SK.Elapsed(start))
+		__SK.AddTiming(obj.id, "decode", __SK.Elapsed(start))
+	end
 	if not success then
 		Spring.Log(__SK.LOG_SECTION, LOG.ERROR, "Failed to parse JSON: " .. tostring(command))
 		Spring.Log(__SK.LOG_SECTION, LOG.ERROR, debug.traceback())
+	elseif obj.event == "hello" then
+		__SK.codec = obj.data.codec or "json"
+		Spring.Log(__SK.LOG_SECTION, LOG.NOTICE, "Sending messages as " .. __SK.codec)
 	else
 		local cmdName = obj.command
 		if not cmdName then
@@ -176,44 +455,77 @@ function __SK.CommandReceived(command)
 			Spring.Log(__SK.LOG_SECTION, LOG.ERROR, "No such command found: " .. tostring(cmdName))
 			return
 		end
-		f(obj.data)
+		f(obj, command)
 	end
 end
 
--- update socket - receive data and split into lines
-function widget:Update()
-	local isConnectedOrig = __SK.isConnected
-	__SK.isConnected = false
-	if __SK.client then
-		if __SK.client:getpeername() then
-			__SK.isConnected = true
-			if not isConnectedOrig then
-				Spring.Log(__SK.LOG_SECTION, LOG.NOTICE, "Connected to " .. __SK.client:getpeername())
-			end
-		end
-	elseif __SK.client == nil then
-		__SK.SocketConnect(__SK.host, __SK.port)
+-- Runs received commands until the frame's budget is spent, at least one runs every frame
+function __SK.RunCommands()
+	if #__SK.commandQueue == 0 then
 		return
 	end
+	local start = Spring.GetTimer()
+	repeat
+		-- A command can drop the connection, and the queue with it
+		local command = table.remove(__SK.commandQueue, 1)
+		__SK.CommandReceived(command[1], command[2])
+	until #__SK.commandQueue == 0 or __SK.Elapsed(start) >= __SK.COMMAND_FRAME_BUDGET
+end
 
-	if isConnectedOrig and not __SK.isConnected then
-		Spring.Log(__SK.LOG_SECTION, LOG.NOTICE, "Connection closed")
+-- Reads what arrived, up to the frame's byte budget, and queues the commands it completes.
+-- Nothing is read while commands are still queued, the kernel waits for them instead.
+function __SK.ReceiveCommands()
+	if #__SK.commandQueue > 0 then
+		return
+	end
+	local readable = __SK.socket.select({__SK.client}, nil, 0)
+	if not readable or #readable == 0 then
+		return
+	end
+	local s, status, partial = __SK.client:receive(__SK.RECV_FRAME_BUDGET)
+	local data = s or partial
+	if data and data ~= "" then
+		local received = Spring.GetTimer()
+		for _, frame in ipairs(__SK.ReceiveData(data)) do
+			table.insert(__SK.commandQueue, {frame, received})
+		end
+	end
+	if status == "closed" then
+		__SK.Disconnect()
 	end
+end
+
+-- update socket - connect, send queued data, receive commands and run them within the frame's budget
+function widget:Update()
+	__SK.RunTickers()
+	__SK.FlushChunks(__SK.luaRulesChunks)
 
-	local readable, writeable, err = __SK.socket.select({__SK.client}, {__SK.client}, 0)
-	if err ~= nil then
-		--Spring.Log(LOG_SECTION, "error", "SpringKernel error in select", err)
-		--Echo("Error in select: " .. err)
+	if not __SK.client then
+		if Spring.DiffTimers(Spring.GetTimer(), __SK.reconnectAt) >= __SK.reconnectWait then
+			__SK.SocketConnect(__SK.host, __SK.port)
+		end
+		return
 	end
-	for _, input in ipairs(readable) do
-		local s, status, str = input:receive('*a') --try to read all data
-		if (status == "timeout" or status == nil) and str ~= nil and str ~= "" then
-			__SK.CommandReceived(str)
-		elseif status == "closed" then
-			input:close()
-			__SK.client = nil
+
+	if not __SK.isConnected then
+		-- The socket becomes writable once connecting finished, whether it succeeded or not
+		local _, writable = __SK.socket.select(nil, {__SK.client}, 0)
+		if writable and #writable > 0 and __SK.client:getpeername() then
+			__SK.Connected()
+		elseif (writable and #writable > 0) or
+				Spring.DiffTimers(Spring.GetTimer(), __SK.connectStart) >= __SK.CONNECT_TIMEOUT then
+			__SK.Disconnect("Failed connecting to " .. tostring(__SK.host) .. ":" .. tostring(__SK.port))
+			return
+		else
+			return
 		end
 	end
+
+	if #__SK.sendQueue > 0 then
+		__SK.FlushSend()
+	end
+	__SK.ReceiveCommands()
+	__SK.RunCommands()
 end
 
 function __SK.CleanTextures()
@@ -221,6 +533,10 @@ function __SK.CleanTextures()
 		gl.DeleteTexture(__SK.screenTex)
 		__SK.screenTex = nil
 	end
+	if __SK.scaledTex then
+		gl.DeleteTexture(__SK.scaledTex)
+		__SK.scaledTex = nil
+	end
 end
 
 function __SK.CreateTextures()
@@ -235,19 +551,119 @@ function __SK.CreateTextures()
 	end
 end
 
+-- Texture used to downscale screenshots, recreated when a different size is requested
+function __SK.GetScaledTexture(w, h)
+	if __SK.scaledTex and __SK.scaledTexW == w and __SK.scaledTexH == h then
+		return __SK.scaledTex
+	end
+	if __SK.scaledTex then
+		gl.DeleteTexture(__SK.scaledTex)
+	end
+	__SK.scaledTex = gl.CreateTexture(w, h, {
+		fbo = true, min_filter = GL.LINEAR, mag_filter = GL.LINEAR,
+		wrap_s = GL.CLAMP, wrap_t = GL.CLAMP,
+	})
+	__SK.scaledTexW, __SK.scaledTexH = w, h
+	return __SK.scaledTex
+end
+
+-- Saves the screen, optionally downscaled, to a uniquely named image file.
+-- The format follows the file extension (png or jpg). Returns the file name and image size.
+function __SK.CaptureScreen(scale, format)
+	__SK.captureCount = __SK.captureCount + 1
+	local imgName = "spring_kernel_capture_" .. __SK.captureToken .. "_" .. __SK.captureCount .. "." .. format
+	local w, h = __SK.vsx, __SK.vsy
+	local tex = __SK.screenTex
+	gl.CopyToTexture(__SK.screenTex, 0, 0, 0, 0, __SK.vsx, __SK.vsy)
+	if scale and scale < 1 then
+		w = math.max(1, math.floor(w * scale))
+		h = math.max(1, math.floor(h * scale))
+		tex = __SK.GetScaledTexture(w, h)
+		gl.RenderToTexture(tex, function()
+			gl.Texture(0, __SK.screenTex)
+			gl.TexRect(-1, -1, 1, 1)
+			gl.Texture(0, false)
+		end)
+	end
+	gl.RenderToTexture(tex, gl.SaveImage, 0, 0, w, h, imgName)
+	gl.Texture(0, false)
+	return imgName, w, h
+end
+
+-- Captures the screen and returns the image data, its width and height
+function __SK.ReadScreen(scale, format)
+	local imgName, w, h = __SK.CaptureScreen(scale, format)
+	local image = VFS.LoadFile(imgName, nil, VFS.RAW)
+	os.remove(imgName)
+	if not image then
+		return nil, "Failed to read the screenshot " .. imgName
+	end
+	return image, w, h
+end
+
+-- Answers a show request. The image is sent in-band, or with transfer = "file"
+-- only its path is sent and the kernel (on the same host) reads and removes it.
+function __SK.SendScreen(request)
+	local data = request.data or {}
+	local format = data.format == "jpg" and "jpg" or "png"
+	if data.transfer == "file" then
+		local imgName, w, h = __SK.CaptureScreen(data.scale, format)
+		__SK.SendReply(request.id, {format = format, width = w, height = h,
+			path = __SK.GetWriteDataDir() .. imgName})
+		return
+	end
+	local image, w, h = __SK.ReadScreen(data.scale, format)
+	if not image then
+		__SK.SendReply(request.id, {error = w})
+		return
+	end
+	__SK.SendReply(request.id, {format = format, width = w, height = h}, {image})
+end
+
+-- Sends every n-th draw frame of a recording as a frame event, returns false once it's done.
+-- Frames are dropped rather than queued while the socket can't keep up.
+function __SK.RecordFrame(recording)
+	local elapsed = Spring.DiffTimers(Spring.GetTimer(), recording.start)
+	if elapsed >= recording.duration or recording.count >= recording.maxFrames then
+		__SK.SendReply(recording.id, {frames = recording.count, dropped = recording.dropped, duration = elapsed})
+		return false
+	end
+	recording.frame = recording.frame + 1
+	if (recording.frame - 1) % recording.every ~= 0 then
+		return true
+	end
+	if #__SK.sendQueue > __SK.RECORD_MAX_QUEUE then
+		recording.dropped = recording.dropped + 1
+		return true
+	end
+	local image, w, h = __SK.ReadScreen(recording.scale, "png")
+	if image then
+		recording.count = recording.count + 1
+		__SK.SendToKernel({
+			id = recording.id,
+			event = "frame",
+			data = {index = recording.count, t = elapsed, width = w, height = h, format = "png"},
+		}, {image})
+	end
+	return true
+end
+
 function __SK.PerformDraw()
-	local imgName = "screen.png"
-	if __SK.draw_requested then
-		if VFS.FileExists(imgName, nil, VFS.RAW) then
-		    os.remove(imgName)
+	if #__SK.drawRequests > 0 then
+		local requests = __SK.drawRequests
+		__SK.drawRequests = {}
+		for _, request in ipairs(requests) do
+			__SK.SendScreen(request)
+		end
+	end
+	if #__SK.recordings > 0 then
+		local recordings = {}
+		for _, recording in ipairs(__SK.recordings) do
+			if __SK.RecordFrame(recording) then
+				table.insert(recordings, recording)
+			end
 		end
-		__SK.draw_requested = false
-		gl.CopyToTexture(__SK.screenTex, 0, 0, 0, 0, __SK.vsx, __SK.vsy)
-		--gl.Texture(0, screenTex)
-		--gl.TexRect(0, vsy, vsx, 0)
-		gl.RenderToTexture(__SK.screenTex, gl.SaveImage, 0, 0, __SK.vsx, __SK.vsy, imgName)
-		gl.Texture(0, false)
-		__SK.SpringKernel.WriteOutput({imgPath = __SK.GetWriteDataDir() .. imgName})
+		__SK.recordings = recordings
 	end
 end
 
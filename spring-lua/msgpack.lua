@@ -0,0 +1,174 @@
+-- Encoder for the subset of MessagePack the kernel decodes (spring_kernel/codec.py).
+-- Messages decode to the same values as their JSON encoding: tables with only positive integer
+-- keys are arrays (empty tables included) unless most of their entries would be nil, other tables are
+-- maps with their keys converted to strings.
+
+local msgpack = {}
+
+local char, floor, frexp = string.char, math.floor, math.frexp
+local concat = table.concat
+local huge = math.huge
+
+msgpack.MAX_DEPTH = 100 -- deeper tables are taken for cycles
+msgpack.MAX_SPARSENESS = 2 -- integer keyed tables are maps when their largest key is more times their size
+
+local buf, n
+
+local function put(s)
+	n = n + 1
+	buf[n] = s
+end
+
+-- Big-endian bytes of a non-negative integer below 2^32
+local function uint32(v)
+	return char(floor(v / 16777216) % 256, floor(v / 65536) % 256, floor(v / 256) % 256, v % 256)
+end
+
+local function encodeDouble(v)
+	local sign = 0
+	if v < 0 or (v == 0 and 1 / v < 0) then
+		sign = 128
+		v = -v
+	end
+	if v ~= v then
+		put(char(0xcb, 0x7f, 0xf8, 0, 0, 0, 0, 0, 0))
+		return
+	elseif v == huge then
+		put(char(0xcb, sign + 0x7f, 0xf0, 0, 0, 0, 0, 0, 0))
+		return
+	elseif v == 0 then
+		put(char(0xcb, sign, 0, 0, 0, 0, 0, 0, 0))
+		return
+	end
+	local mantissa, exponent = frexp(v)
+	exponent = exponent + 1022
+	local fraction
+	if exponent <= 0 then
+		-- subnormal
+		fraction = mantissa * 2 ^ (exponent + 52)
+		exponent = 0
+	else
+		fraction = (mantissa * 2 - 1) * 2 ^ 52
+	end
+	local high = floor(fraction / 4294967296)
+	put(char(0xcb, sign + floor(exponent / 16), (exponent % 16) * 16 + floor(high / 65536),
+		floor(high / 256) % 256, high % 256) .. uint32(fraction % 4294967296))
+end
+
+local function encodeNumber(v)
+	if v ~= floor(v) or v >= 2 ^ 53 or v <= -2 ^ 53 then
+		encodeDouble(v)
+	elseif v >= 0 then
+		if v < 128 then
+			put(char(v))
+		elseif v < 256 then
+			put(char(0xcc, v))
+		elseif v < 65536 then
+			put(char(0xcd, floor(v / 256), v % 256))
+		elseif v < 4294967296 then
+			put(char(0xce) .. uint32(v))
+		else
+			put(char(0xcf) .. uint32(floor(v / 4294967296)) .. uint32(v % 4294967296))
+		end
+	elseif v >= -32 then
+		put(char(256 + v))
+	elseif v >= -128 then
+		put(char(0xd0, 256 + v))
+	elseif v >= -32768 then
+		v = 65536 + v
+		put(char(0xd1, floor(v / 256), v % 256))
+	elseif v >= -2147483648 then
+		put(char(0xd2) .. uint32(4294967296 + v))
+	else
+		local high = floor(v / 4294967296)
+		put(char(0xd3) .. uint32(4294967296 + high) .. uint32(v - high * 4294967296))
+	end
+end
+
+local function encodeString(s)
+	local size = #s
+	if size < 32 then
+		put(char(0xa0 + size))
+	elseif size < 256 then
+		put(char(0xd9, size))
+	elseif size < 65536 then
+		put(char(0xda, floor(size / 256), size % 256))
+	else
+		put(char(0xdb) .. uint32(size))
+	end
+	put(s)
+end
+
+local function header(size, fix, code16, code32)
+	if size < 16 then
+		put(char(fix + size))
+	elseif size < 65536 then
+		put(char(code16, floor(size / 256), size % 256))
+	else
+		put(char(code32) .. uint32(size))
+	end
+end
+
+local encodeValue
+
+local function encodeTable(t, depth)
+	if depth > msgpack.MAX_DEPTH then
+		error("Table nesting too deep, it may contain a cycle")
+	end
+	local count, maxIndex, isArray = 0, 0, true
+	for k in pairs(t) do
+		count = count + 1
+		if isArray then
+			if type(k) == "number" and k > 0 and k < huge and k == floor(k) then
+				if k > maxIndex then
+					maxIndex = k
+				end
+			else
+				isArray = false
+			end
+		end
+	end
+	if isArray and maxIndex <= count * msgpack.MAX_SPARSENESS then
+		-- Like JSON, missing entries of sparse arrays are nil
+		header(maxIndex, 0x90, 0xdc, 0xdd)
+		for i = 1, maxIndex do
+			encodeValue(t[i], depth)
+		end
+	else
+		header(count, 0x80, 0xde, 0xdf)
+		for k, v in pairs(t) do
+			encodeString(type(k) == "string" and k or tostring(k))
+			encodeValue(v, depth)
+		end
+	end
+end
+
+encodeValue = function(v, depth)
+	local t = type(v)
+	if t == "string" then
+		encodeString(v)
+	elseif t == "number" then
+		encodeNumber(v)
+	elseif t == "table" then
+		encodeTable(v, depth + 1)
+	elseif t == "boolean" then
+		put(v and "\195" or "\194")
+	elseif v == nil then
+		put("\192")
+	else
+		error("Cannot encode a value of type " .. t)
+	end
+end
+
+function msgpack.encode(value)
+	buf, n = {}, 0
+	local success, err = pcall(encodeValue, value, 0)
+	local encoded = success and concat(buf, "", 1, n) or nil
+	buf = nil
+	if not success then
+		error(err, 0)
+	end
+	return encoded
+end
+
+return msgpack
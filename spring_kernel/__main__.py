@@ -1,5 +1,7 @@
 from __future__ import absolute_import
 
+import logging
+
 from ipykernel.kernelapp import IPKernelApp
 from traitlets import Dict
 
@@ -28,6 +30,9 @@ def main():
     """
     This is the installed entry point
     """
+    # Only the kernel Jupyter launches logs to a file, not the ones the
+    # batch runner, benchmarks and tests create
+    logging.basicConfig(filename='kernlog.log',level=logging.DEBUG)
     SpringRTSApp.launch_instance()
 
 if __name__ == '__main__':
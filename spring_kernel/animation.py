@@ -0,0 +1,127 @@
+"""
+Assembling frames captured with %record into animations
+"""
+from __future__ import absolute_import, division, print_function
+
+import base64
+import io
+import struct
+import zlib
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def png_chunks(data):
+    """
+    Iterate over the (type, data) chunks of a PNG file
+    """
+    if not data.startswith(PNG_SIGNATURE):
+        raise ValueError('Not a PNG image')
+    pos = len(PNG_SIGNATURE)
+    while pos + 8 <= len(data):
+        length, = struct.unpack_from('>I', data, pos)
+        ctype = data[pos + 4:pos + 8]
+        yield ctype, data[pos + 8:pos + 8 + length]
+        pos += 12 + length
+
+
+def _chunk(ctype, data):
+    return (struct.pack('>I', len(data)) + ctype + data +
+            struct.pack('>I', zlib.crc32(ctype + data) & 0xffffffff))
+
+
+class PngFrame(object):
+    """
+    The parts of a PNG image needed to use it as an APNG frame
+    """
+    def __init__(self, data):
+        self.header = None
+        self.extra = []     # ancillary chunks before the image data, e.g. PLTE
+        self.idat = []
+        for ctype, chunk in png_chunks(data):
+            if ctype == b'IHDR':
+                self.header = chunk
+            elif ctype == b'IDAT':
+                self.idat.append(chunk)
+            elif ctype != b'IEND' and not self.idat:
+                self.extra.append((ctype, chunk))
+        if self.header is None or not self.idat:
+            raise ValueError('Incomplete PNG image')
+        self.width, self.height = struct.unpack_from('>II', self.header)
+
+
+def _delays(times, count):
+    """
+    Frame delays in milliseconds from the capture times (in seconds)
+    """
+    delays = [max(1, int(round((b - a) * 1000))) for a, b in zip(times, times[1:])]
+    last = sum(delays) // len(delays) if delays else 100
+    return (delays + [last] * count)[:count]
+
+
+def assemble_apng(frames, times, plays=0):
+    """
+    Join PNG frames into an animated PNG without decoding them: the image
+    data of every frame is copied into the animation as is.
+      @param frames (list): PngFrame objects, all with the same header
+      @param times (list): capture time of every frame, in seconds
+      @param plays (int): number of loops, 0 for infinite
+    """
+    first = frames[0]
+    # Frames of another size, after the window was resized, are left out along with their times
+    kept = [(frame, t) for frame, t in zip(frames, times) if frame.header == first.header]
+    frames = [frame for frame, _ in kept]
+    times = [t for _, t in kept]
+    out = [PNG_SIGNATURE, _chunk(b'IHDR', first.header)]
+    out.append(_chunk(b'acTL', struct.pack('>II', len(frames), plays)))
+    out.extend(_chunk(ctype, chunk) for ctype, chunk in first.extra)
+    seq = 0
+    for index, (frame, delay) in enumerate(zip(frames, _delays(times, len(frames)))):
+        out.append(_chunk(b'fcTL', struct.pack('>IIIIIHHBB', seq, frame.width, frame.height,
+                                               0, 0, delay, 1000, 0, 0)))
+        seq += 1
+        for data in frame.idat:
+            if index == 0:
+                out.append(_chunk(b'IDAT', data))
+            else:
+                out.append(_chunk(b'fdAT', struct.pack('>I', seq) + data))
+                seq += 1
+    out.append(_chunk(b'IEND', b''))
+    return b''.join(out)
+
+
+def decode_frame(data):
+    """
+    Decode a frame for GIF encoding. Needs Pillow.
+    """
+    if Image is None:
+        raise RuntimeError('Recording GIFs requires Pillow (pip install pillow)')
+    image = Image.open(io.BytesIO(data))
+    return image.convert('RGB').quantize()
+
+
+def assemble_gif(images, times):
+    """
+    Join decoded frames into an animated GIF
+    """
+    out = io.BytesIO()
+    images[0].save(out, format='GIF', save_all=True, append_images=images[1:],
+                   duration=_delays(times, len(images)), loop=0)
+    return out.getvalue()
+
+
+def frame_strip(frames, height=120):
+    """
+    Return HTML showing PNG frames side by side in a scrollable strip
+    """
+    parts = ['<div style="white-space:nowrap;overflow-x:auto">']
+    for data in frames:
+        parts.append('<img style="height:{}px;margin-right:2px" src="data:image/png;base64,{}"/>'.format(
+            height, base64.b64encode(data).decode('ascii')))
+    parts.append('</div>')
+    return ''.join(parts)
@@ -0,0 +1,307 @@
+"""
+Run Lua notebooks and scripts against engines without Jupyter
+
+    python -m spring_kernel.batch tests/ smoke.ipynb -e all --junit report.xml
+
+Listens for Spring like the kernel does and, once the engines connected,
+executes each notebook (its code cells in order) and each .lua file (as
+one cell) given, directories are searched for both. Cells are executed
+by SpringRTSKernel itself, so magics work like in a notebook, but their
+output is collected instead of sent to a frontend.
+
+Files are independent of each other: up to --jobs of them run at once,
+each with its own state magic and engine selection, sharing the
+connection to the engines. Cells of a file run one after the other, and
+the first failing one skips the rest unless --keep-going is given.
+
+The exit code is 0 when every cell succeeded, 1 when some failed and 2
+when the files couldn't be read or no engine connected.
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from xml.etree import ElementTree
+
+from .kernel import SpringRTSKernel, parse_engines
+from .spring_connector import SpringConnector, HOST, PORT
+
+# Extensions of the files that are run, notebooks and single Lua cells
+EXTENSIONS = ('.ipynb', '.lua')
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_ERROR = 2
+
+
+def display_text(data):
+    """
+    Return the text of display data, or its mimetypes for images
+    """
+    text = data.get('text/plain')
+    if text is not None:
+        return text if text.endswith('\n') else text + '\n'
+    return ''.join('<{}>\n'.format(mimetype) for mimetype in data)
+
+
+class BatchKernel(SpringRTSKernel):
+    """
+    Kernel whose messages to the frontend are collected as the output of
+    the cell being executed, along with the errors it reported. Updated
+    displays, like progress and watches, replace their earlier output.
+    """
+
+    def __init__(self, connector, engines=None):
+        super(BatchKernel, self).__init__(connector=connector)
+        self.engines = engines
+        self.output = []
+        self.errors = []
+        # The output list and index of each display, by display id
+        self._displays = {}
+
+    def send_response(self, stream, msg_type, content=None, *args, **kwargs):
+        if msg_type == 'stream':
+            self.output.append(content['text'])
+            return
+        if msg_type not in ('display_data', 'update_display_data'):
+            return
+        text = display_text(content['data'])
+        displayId = content.get('transient', {}).get('display_id')
+        if msg_type == 'update_display_data' and displayId in self._displays:
+            output, index = self._displays[displayId]
+            output[index] = text
+            return
+        if displayId is not None:
+            self._displays[displayId] = (self.output, len(self.output))
+        self.output.append(text)
+
+    def _send(self, data, status='ok', silent=False):
+        # Spring reports errors of the Lua code as output, the cell still succeeds
+        if data is not None:
+            self.errors.extend(text for text, css in data if css == 'error')
+        return super(BatchKernel, self)._send(data, status, silent)
+
+    async def run_cell(self, code):
+        """
+        Execute a cell and return its result: status (ok or error),
+        output, errors and duration in seconds
+        """
+        self.output = []
+        self.errors = []
+        start = time.perf_counter()
+        reply = await self.do_execute(code, False)
+        duration = time.perf_counter() - start
+        self.execution_count += 1
+        status = 'error' if reply['status'] == 'error' or self.errors else 'ok'
+        return {
+            'status' : status,
+            'output' : ''.join(self.output),
+            'errors' : self.errors,
+            'duration' : duration,
+            'timing' : self._timing,
+        }
+
+    async def close(self):
+        """
+        Stop the watches the cells started
+        """
+        if self._watches:
+            await self._unwatch(list(self._watches))
+
+
+def find_files(paths):
+    """
+    Return the notebooks and Lua files to run, directories are searched
+    recursively in name order
+    """
+    files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append(path)
+            continue
+        for root, dirs, names in os.walk(path):
+            dirs.sort()
+            files.extend(os.path.join(root, name) for name in sorted(names)
+                         if name.endswith(EXTENSIONS) and not name.startswith('.'))
+    return files
+
+
+def read_cells(path):
+    """
+    Return the code cells of a notebook, or the content of a Lua file as a
+    single cell
+    """
+    with open(path, encoding='utf-8') as f:
+        if not path.endswith('.ipynb'):
+            return [f.read()]
+        notebook = json.load(f)
+    cells = []
+    for cell in notebook.get('cells', []):
+        if cell.get('cell_type') != 'code':
+            continue
+        source = cell.get('source', '')
+        if isinstance(source, list):
+            source = ''.join(source)
+        if source.strip():
+            cells.append(source)
+    return cells
+
+
+async def run_file(connector, path, cells, engines, keepGoing):
+    """
+    Execute the cells of a file in order with a kernel of its own
+    """
+    kernel = BatchKernel(connector, engines)
+    results = []
+    start = time.perf_counter()
+    try:
+        for code in cells:
+            if results and results[-1]['status'] != 'ok' and not keepGoing:
+                results.append({'status' : 'skipped', 'output' : '', 'errors' : [], 'duration' : 0,
+                                'timing' : None, 'code' : code})
+                continue
+            try:
+                result = await kernel.run_cell(code)
+            except Exception as ex:
+                result = {'status' : 'error', 'output' : ''.join(kernel.output),
+                          'errors' : [str(ex) or type(ex).__name__], 'duration' : 0, 'timing' : None}
+            result['code'] = code
+            results.append(result)
+    finally:
+        await kernel.close()
+    return {
+        'path' : path,
+        'cells' : results,
+        'duration' : time.perf_counter() - start,
+        'status' : 'ok' if all(cell['status'] == 'ok' for cell in results) else 'error',
+    }
+
+
+def junit_report(files):
+    """
+    Return a JUnit XML report with a test suite per file and a test case
+    per cell
+    """
+    suites = ElementTree.Element('testsuites')
+    for result in files:
+        cells = result['cells']
+        suite = ElementTree.SubElement(suites, 'testsuite', {
+            'name' : result['path'],
+            'tests' : str(len(cells)),
+            'failures' : str(sum(cell['status'] == 'error' for cell in cells)),
+            'skipped' : str(sum(cell['status'] == 'skipped' for cell in cells)),
+            'time' : '{:.3f}'.format(result['duration']),
+        })
+        for index, cell in enumerate(cells, 1):
+            case = ElementTree.SubElement(suite, 'testcase', {
+                'classname' : result['path'],
+                'name' : 'cell {}'.format(index),
+                'time' : '{:.3f}'.format(cell['duration']),
+            })
+            if cell['status'] == 'error':
+                failure = ElementTree.SubElement(case, 'failure', {
+                    'message' : (cell['errors'] or ['cell failed'])[0].split('\n')[0]})
+                failure.text = '\n'.join(cell['errors'])
+            elif cell['status'] == 'skipped':
+                ElementTree.SubElement(case, 'skipped', {'message' : 'an earlier cell failed'})
+            if cell['output']:
+                ElementTree.SubElement(case, 'system-out').text = cell['output']
+    return ElementTree.tostring(suites, encoding='unicode')
+
+
+async def wait_for_engines(connector, engines, count, timeout):
+    """
+    Wait until the named engines, or count of them, are connected
+    """
+    deadline = time.perf_counter() + timeout
+    while True:
+        names = connector.engineNames()
+        if isinstance(engines, list):
+            if all(engine in names for engine in engines):
+                return True
+        elif len(names) >= count:
+            return True
+        if time.perf_counter() >= deadline:
+            return False
+        await asyncio.sleep(0.1)
+
+
+async def run(args):
+    files = find_files(args.paths)
+    try:
+        cells = [read_cells(path) for path in files]
+    except (OSError, ValueError) as ex:
+        print('Cannot read {}: {}'.format(getattr(ex, 'filename', None) or 'file', ex), file=sys.stderr)
+        return EXIT_ERROR
+    if not files:
+        print('No notebooks or Lua files found', file=sys.stderr)
+        return EXIT_ERROR
+
+    engines = parse_engines(' '.join(args.engines))
+    connector = SpringConnector(args.host, args.port)
+    await connector.start()
+    try:
+        print('Waiting for Spring on port {}'.format(connector.port), file=sys.stderr)
+        if not await wait_for_engines(connector, engines, args.count, args.wait):
+            print('Engines not connected after {} seconds, connected: {}'.format(
+                args.wait, ', '.join(connector.engineNames()) or 'none'), file=sys.stderr)
+            return EXIT_ERROR
+
+        jobs = asyncio.Semaphore(max(1, args.jobs))
+
+        async def job(path, fileCells):
+            async with jobs:
+                result = await run_file(connector, path, fileCells, engines, args.keep_going)
+            failed = [index for index, cell in enumerate(result['cells'], 1) if cell['status'] == 'error']
+            if failed or not args.quiet:
+                print('{} {} ({} cells, {:.2f} s)'.format(
+                    'FAIL' if failed else 'ok  ', path, len(result['cells']), result['duration']))
+                for index in failed:
+                    for error in result['cells'][index - 1]['errors']:
+                        print('    cell {}: {}'.format(index, error))
+            return result
+
+        results = await asyncio.gather(*[job(path, fileCells) for path, fileCells in zip(files, cells)])
+    finally:
+        connector.server.close()
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'files' : results}, f, indent=1)
+    if args.junit:
+        with open(args.junit, 'w', encoding='utf-8') as f:
+            f.write(junit_report(results))
+    failed = sum(result['status'] != 'ok' for result in results)
+    if not args.quiet:
+        print('{} of {} files failed'.format(failed, len(results)))
+    return EXIT_FAILED if failed else EXIT_OK
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m spring_kernel.batch',
+                                     description='Run Lua notebooks and scripts against Spring engines')
+    parser.add_argument('paths', nargs='+', help='notebooks, Lua files or directories of them')
+    parser.add_argument('-e', '--engines', nargs='*', default=[],
+                        help='engines cells run on, "all" or names, the first connected one by default')
+    parser.add_argument('-n', '--count', type=int, default=1,
+                        help='engines to wait for when they are not named')
+    parser.add_argument('-w', '--wait', type=float, default=60,
+                        help='seconds to wait for the engines to connect')
+    parser.add_argument('-j', '--jobs', type=int, default=4, help='files run at once')
+    parser.add_argument('-k', '--keep-going', action='store_true',
+                        help='run the remaining cells of a file after one failed')
+    parser.add_argument('--json', help='write the results to this JSON file')
+    parser.add_argument('--junit', help='write a JUnit XML report to this file')
+    parser.add_argument('-q', '--quiet', action='store_true', help='only report errors')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+"""
+Benchmarks of the kernel side of the Spring connection
+
+    python -m spring_kernel.benchmark [codecs|kernel]
+
+The codecs suite compares the size and decoding throughput of typical
+Spring messages encoded as JSON and as MessagePack. The encoding cost
+inside Spring can be measured from a notebook with
+__SK.BenchmarkCodecs(value, repeats).
+
+The kernel suite runs cells end to end through SpringRTSKernel.do_execute
+against a FakeEngine, from 1 KB to 20 MB of output per cell, and reports
+round trip latency percentiles and sustained cells per second.
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import asyncio
+import json
+import time
+import timeit
+
+from . import codec
+from .fake_engine import FakeEngine
+
+
+def execute_result(lines=200):
+    """
+    Reply to an execute request that printed a few hundred lines
+    """
+    output = ''.join('unit {} at {:.2f}, {:.2f}\n'.format(i, i * 1.5, i * 0.25)
+                     for i in range(lines))
+    return {'id' : 1, 'result' : [['', 'output'], [output, 'output']]}
+
+
+def _node(value):
+    if isinstance(value, dict):
+        return {
+            't' : 'table',
+            'n' : len(value),
+            'array' : False,
+            'items' : [{'k' : _node(k), 'v' : _node(v)} for k, v in value.items()],
+        }
+    return {'t' : type(value).__name__, 'v' : value}
+
+
+def table_dump(size=100):
+    """
+    Reply to an execute request that printed a table of unit definitions
+    in tree mode, e.g. _p(UnitDefs)
+    """
+    defs = {
+        'unit{}'.format(i) : {
+            'name' : 'unit{}'.format(i),
+            'health' : 1000 + i,
+            'speed' : 1.5 + i / 7,
+            'canFly' : i % 2 == 0,
+            'buildCostMetal' : 150 * i,
+        }
+        for i in range(size)
+    }
+    return {'id' : 2, 'result' : [['', 'output'], [[_node(defs)], 'tree']]}
+
+
+def stream_event(size=64 * 1024):
+    """
+    Chunk of output streamed while a cell runs
+    """
+    return {'id' : 3, 'event' : 'stream', 'data' : 'x' * (size - 1) + '\n'}
+
+
+MESSAGES = {
+    'execute result' : execute_result,
+    'table dump' : table_dump,
+    'stream event' : stream_event,
+}
+
+
+def _rate(decode, payload, number):
+    seconds = min(timeit.repeat(lambda: decode(payload), number=number, repeat=3))
+    return len(payload) * number / seconds / 1e6
+
+
+def run_codecs(number):
+    """
+    Print the payload size and decoding throughput of each message with
+    each codec
+    """
+    decoders = [('json', lambda payload: json.loads(payload.decode('utf-8')))]
+    if codec.msgpack is not None:
+        decoders.append(('msgpack', codec.msgpack.unpackb))
+    decoders.append(('msgpack (pure Python)', lambda payload: codec._unpack(payload, 0)))
+    print('{:<16} {:<22} {:>10} {:>10}'.format('message', 'codec', 'bytes', 'MB/s'))
+    for name, make in MESSAGES.items():
+        message = make()
+        payloads = {
+            'json' : json.dumps(message, separators=(',', ':')).encode('utf-8'),
+            'msgpack' : codec.pack(message),
+        }
+        for decoder, decode in decoders:
+            payload = payloads[decoder.split()[0]]
+            assert codec.decode_message(payload) == message
+            print('{:<16} {:<22} {:>10} {:>10.1f}'.format(
+                name, decoder, len(payload), _rate(decode, payload, number)))
+
+
+# Suites that can be run, all of them when none is named
+SUITES = ['codecs', 'kernel']
+
+# Output sizes of the cells run by the kernel suite
+KERNEL_SIZES = [1024, 10 * 1024, 100 * 1024, 1024 * 1024, 5 * 1024 * 1024, 20 * 1024 * 1024]
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+async def _run_kernel(sizes, cells, codecs):
+    # Imported here so the codecs suite runs without ipykernel
+    from .kernel import SpringRTSKernel
+    from .spring_connector import SpringConnector
+
+    class BenchmarkKernel(SpringRTSKernel):
+        """
+        Kernel whose messages to the frontend are counted instead of sent
+        """
+        responses = 0
+
+        def send_response(self, stream, msg_type, content=None, *args, **kwargs):
+            self.responses += 1
+
+    kernel = BenchmarkKernel(connector=SpringConnector('127.0.0.1', 0, capture=None))
+    await kernel.sc.start()
+    engine = FakeEngine('127.0.0.1', kernel.sc.port, codecs=codecs)
+    await engine.connect()
+    serving = asyncio.ensure_future(engine.run())
+    await kernel.sc.connected.wait()
+    print('{:>10} {:>6} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+        'size', 'cells', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'cells/s', 'MB/s'))
+    try:
+        for size in sizes:
+            engine.size = size
+            # Fewer cells for large outputs, the suite should finish in minutes
+            count = max(3, min(cells, cells * 1024 * 1024 // (size * 10)))
+            latencies = []
+            start = time.perf_counter()
+            for _ in range(count):
+                began = time.perf_counter()
+                reply = await kernel.do_execute('_p(x)', False)
+                latencies.append(time.perf_counter() - began)
+                if reply['status'] != 'ok':
+                    raise RuntimeError('Cell failed at {} bytes'.format(size))
+            total = time.perf_counter() - start
+            print('{:>10} {:>6} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.1f} {:>9.1f}'.format(
+                size, count, *[1000 * _percentile(latencies, f) for f in (0.5, 0.9, 0.99, 1)],
+                count / total, size * count / total / 1e6))
+    finally:
+        engine.close()
+        serving.cancel()
+        kernel.sc.server.close()
+
+
+def run_kernel(sizes, cells, codecs):
+    """
+    Print the latency percentiles and throughput of cells run through the
+    kernel for each output size
+    """
+    asyncio.run(_run_kernel(sizes, cells, codecs))
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m spring_kernel.benchmark',
+                                     description='Benchmark the kernel side of the Spring connection')
+    parser.add_argument('suites', nargs='*', metavar='SUITE',
+                        help='suites to run, {} (all by default)'.format(' or '.join(SUITES)))
+    parser.add_argument('-n', '--number', type=int, default=50,
+                        help='decodes timed per measurement of the codecs suite')
+    parser.add_argument('-c', '--cells', type=int, default=200,
+                        help='cells run for each output size of the kernel suite')
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', default=KERNEL_SIZES,
+                        help='output sizes in bytes of the kernel suite')
+    parser.add_argument('--codec', choices=codec.CODECS,
+                        help='codec the fake engine offers, all by default')
+    args = parser.parse_args()
+    # Not checked with choices, which rejects the empty default on some Python versions
+    unknown = [suite for suite in args.suites if suite not in SUITES]
+    if unknown:
+        parser.error('unknown suite: {} (choose from {})'.format(', '.join(unknown), ', '.join(SUITES)))
+    suites = args.suites or SUITES
+    if 'codecs' in suites:
+        run_codecs(args.number)
+    if 'kernel' in suites:
+        if 'codecs' in suites:
+            print()
+        run_kernel(args.sizes, args.cells, [args.codec] if args.codec else codec.CODECS)
+
+
+if __name__ == '__main__':
+    main()
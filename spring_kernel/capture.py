@@ -0,0 +1,157 @@
+"""
+Capture files of the traffic between the kernel and Spring
+
+SpringConnector appends every frame it sends or receives to a capture file
+when it's given one, see CAPTURE in spring_connector. A capture starts
+with CAPTURE_MAGIC followed by records: a RECORD header (time.time() of
+the frame, its kind, the number of the connection and the payload size)
+and the frame payload exactly as it went over the socket. Records are
+only ever appended, so a capture can span several kernel sessions, each
+starting with a SESSION record.
+
+load_session reads a capture back as requests with the frames answering
+them, which spring_kernel.replay plays back.
+"""
+from __future__ import absolute_import, division, print_function
+
+import itertools
+import struct
+import time
+
+from .codec import decode_message
+
+CAPTURE_MAGIC = b'SKCAP2\n'
+RECORD = struct.Struct('>dBII')
+
+# Kinds of frames: requests sent by the kernel, messages sent by Spring and
+# the binary blobs that follow some of them. A SESSION record, without
+# payload, is written whenever a kernel opens the capture, as connection
+# numbers start over.
+REQUEST = 0
+MESSAGE = 1
+BLOB = 2
+SESSION = 3
+
+
+class CaptureWriter(object):
+    """
+    Appends frames to a capture file, each is flushed right away so a
+    capture survives the kernel being killed
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(CAPTURE_MAGIC)
+        self.record(time.time(), SESSION, 0, b'')
+
+    def record(self, t, kind, connection, payload):
+        self.file.write(RECORD.pack(t, kind, connection, len(payload)))
+        self.file.write(payload)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_capture(path):
+    """
+    Yield the (t, kind, connection, payload) records of a capture, a
+    record cut short at the end of the file is left out
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError('{} is not a capture file'.format(path))
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            t, kind, connection, size = RECORD.unpack(header)
+            payload = f.read(size)
+            if len(payload) < size:
+                return
+            yield t, kind, connection, payload
+
+
+class CapturedRequest(object):
+    """
+    A request of a capture with the frames Spring sent for it: events,
+    the reply and their blobs, as (t, kind, payload)
+    """
+
+    def __init__(self, t, connection, msg, size):
+        self.sent = t
+        self.connection = connection
+        self.msg = msg
+        self.size = size
+        self.frames = []
+        # When the reply arrived, None if it never did
+        self.replied = None
+
+    @property
+    def command(self):
+        return self.msg.get('command')
+
+    @property
+    def latency(self):
+        return None if self.replied is None else self.replied - self.sent
+
+    def received(self):
+        """
+        Return the bytes Spring sent for the request
+        """
+        return sum(len(payload) for _, _, payload in self.frames)
+
+
+def load_session(path):
+    """
+    Read a capture and return (hellos, requests): the hello payload each
+    connection started with by connection number, and the requests in the
+    order they were sent. Connections are numbered across the sessions of
+    the capture.
+    """
+    hellos = {}
+    requests = []
+    # Requests by (connection, id) and the request whose blobs follow, by connection
+    byId = {}
+    blobsFor = {}
+    # Connection numbers of the capture by the ones of the session
+    numbers = {}
+    nextNumber = itertools.count(1)
+    for t, kind, connection, payload in read_capture(path):
+        if kind == SESSION:
+            numbers = {}
+            continue
+        if connection not in numbers:
+            numbers[connection] = next(nextNumber)
+        connection = numbers[connection]
+        if kind == REQUEST:
+            msg = decode_message(payload)
+            if 'id' not in msg:
+                continue
+            request = CapturedRequest(t, connection, msg, len(payload))
+            byId[connection, msg['id']] = request
+            requests.append(request)
+            continue
+        if kind == BLOB:
+            request = blobsFor.get(connection)
+            if request is not None:
+                request.frames.append((t, kind, payload))
+            continue
+        try:
+            msg = decode_message(payload)
+        except (ValueError, IndexError, struct.error):
+            continue
+        if msg.get('event') == 'hello':
+            hellos[connection] = payload
+            continue
+        request = byId.get((connection, msg.get('id')))
+        blobsFor[connection] = request if msg.get('blobs') else None
+        if request is None:
+            continue
+        request.frames.append((t, kind, payload))
+        if 'event' not in msg:
+            request.replied = t
+    return hellos, requests
+
@@ -0,0 +1,203 @@
+"""
+Message codecs used by Spring when sending messages to the kernel
+
+Spring lists the codecs it can encode in its hello message and the kernel
+answers with the one to use. Besides JSON there is a compact binary codec,
+the MessagePack subset produced by spring-lua/msgpack.lua. Every frame can
+be decoded on its own, so messages sent before the switch are still read.
+"""
+from __future__ import absolute_import, division, print_function
+
+import json
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Codecs the kernel can decode
+CODECS = ('msgpack', 'json')
+
+# Codecs the kernel picks from, in order of preference. MessagePack is only
+# preferred when the C extension of the msgpack package decodes it: the pure
+# Python decoders are several times slower than json.
+if msgpack is not None and msgpack.Unpacker.__module__ != 'msgpack.fallback':
+    PREFERRED = ('msgpack', 'json')
+else:
+    PREFERRED = ('json',)
+
+# Fixed size MessagePack types by their first byte
+_FIXED = {
+    0xca : struct.Struct('>f'),
+    0xcb : struct.Struct('>d'),
+    0xcc : struct.Struct('>B'),
+    0xcd : struct.Struct('>H'),
+    0xce : struct.Struct('>I'),
+    0xcf : struct.Struct('>Q'),
+    0xd0 : struct.Struct('>b'),
+    0xd1 : struct.Struct('>h'),
+    0xd2 : struct.Struct('>i'),
+    0xd3 : struct.Struct('>q'),
+}
+# Sizes of the length fields of str, bin, array and map types
+_LENGTHS = {
+    0xc4 : _FIXED[0xcc], 0xc5 : _FIXED[0xcd], 0xc6 : _FIXED[0xce],
+    0xd9 : _FIXED[0xcc], 0xda : _FIXED[0xcd], 0xdb : _FIXED[0xce],
+    0xdc : _FIXED[0xcd], 0xdd : _FIXED[0xce],
+    0xde : _FIXED[0xcd], 0xdf : _FIXED[0xce],
+}
+
+
+def choose_codec(offered):
+    """
+    Return the preferred codec out of the ones offered by Spring
+    """
+    for codec in PREFERRED:
+        if codec in (offered or ()):
+            return codec
+    return 'json'
+
+
+def is_msgpack(payload):
+    """
+    Tell MessagePack frames from JSON ones: messages are maps, which start
+    with a byte JSON text never starts with
+    """
+    first = payload[0] if payload else 0
+    return 0x80 <= first <= 0x8f or first in (0xde, 0xdf)
+
+
+def decode_message(payload):
+    """
+    Decode a message frame, whichever codec it was encoded with
+    """
+    if is_msgpack(payload):
+        return unpack(payload)
+    return json.loads(payload.decode('utf-8'))
+
+
+def _unpack(data, pos):
+    code = data[pos]
+    pos += 1
+    if code <= 0x7f:
+        return code, pos
+    if code >= 0xe0:
+        return code - 0x100, pos
+    if 0xa0 <= code <= 0xbf:
+        end = pos + (code & 0x1f)
+        return data[pos:end].decode('utf-8', 'replace'), end
+    if 0x90 <= code <= 0x9f:
+        return _unpack_array(data, pos, code & 0x0f)
+    if 0x80 <= code <= 0x8f:
+        return _unpack_map(data, pos, code & 0x0f)
+    if code == 0xc0:
+        return None, pos
+    if code == 0xc2:
+        return False, pos
+    if code == 0xc3:
+        return True, pos
+    fixed = _FIXED.get(code)
+    if fixed is not None:
+        return fixed.unpack_from(data, pos)[0], pos + fixed.size
+    length = _LENGTHS.get(code)
+    if length is None:
+        raise ValueError('Unsupported MessagePack type 0x{:02x}'.format(code))
+    size, = length.unpack_from(data, pos)
+    pos += length.size
+    if code >= 0xde:
+        return _unpack_map(data, pos, size)
+    if code >= 0xdc:
+        return _unpack_array(data, pos, size)
+    if code >= 0xd9:
+        return data[pos:pos + size].decode('utf-8', 'replace'), pos + size
+    return bytes(data[pos:pos + size]), pos + size
+
+
+def _unpack_array(data, pos, size):
+    items = []
+    append = items.append
+    for _ in range(size):
+        item, pos = _unpack(data, pos)
+        append(item)
+    return items, pos
+
+
+def _unpack_map(data, pos, size):
+    items = {}
+    for _ in range(size):
+        code = data[pos]
+        # Keys are nearly always short strings
+        if 0xa0 <= code <= 0xbf:
+            end = pos + 1 + (code & 0x1f)
+            key = data[pos + 1:end].decode('utf-8', 'replace')
+            pos = end
+        else:
+            key, pos = _unpack(data, pos)
+        items[key], pos = _unpack(data, pos)
+    return items, pos
+
+
+def unpack(payload):
+    """
+    Decode a MessagePack message, with the msgpack package if it's installed
+    """
+    if msgpack is not None:
+        return msgpack.unpackb(payload, raw=False, strict_map_key=False,
+                               unicode_errors='replace')
+    value, pos = _unpack(payload, 0)
+    if pos != len(payload):
+        raise ValueError('Trailing data after MessagePack message')
+    return value
+
+
+def _pack(value, out):
+    if value is None:
+        out.append(b'\xc0')
+    elif value is True:
+        out.append(b'\xc3')
+    elif value is False:
+        out.append(b'\xc2')
+    elif isinstance(value, int):
+        if 0 <= value <= 0x7f or -32 <= value < 0:
+            out.append(struct.pack('>b' if value < 0 else '>B', value))
+        elif 0 < value <= 0xffffffff:
+            out.append(b'\xce' + struct.pack('>I', value))
+        elif -0x80000000 <= value < 0:
+            out.append(b'\xd2' + struct.pack('>i', value))
+        elif value > 0:
+            out.append(b'\xcf' + struct.pack('>Q', value))
+        else:
+            out.append(b'\xd3' + struct.pack('>q', value))
+    elif isinstance(value, float):
+        out.append(b'\xcb' + struct.pack('>d', value))
+    elif isinstance(value, str):
+        data = value.encode('utf-8')
+        if len(data) < 32:
+            out.append(bytes((0xa0 | len(data),)))
+        else:
+            out.append(b'\xdb' + struct.pack('>I', len(data)))
+        out.append(data)
+    elif isinstance(value, (bytes, bytearray)):
+        out.append(b'\xc6' + struct.pack('>I', len(value)))
+        out.append(bytes(value))
+    elif isinstance(value, dict):
+        out.append(b'\xdf' + struct.pack('>I', len(value)))
+        for key, item in value.items():
+            _pack(str(key), out)
+            _pack(item, out)
+    elif isinstance(value, (list, tuple)):
+        out.append(b'\xdd' + struct.pack('>I', len(value)))
+        for item in value:
+            _pack(item, out)
+    else:
+        raise TypeError('Cannot encode {} as MessagePack'.format(type(value).__name__))
+
+
+def pack(value):
+    """
+    Encode a value the way Spring does, e.g. for fake engines and benchmarks
+    """
+    out = []
+    _pack(value, out)
+    return b''.join(out)
@@ -0,0 +1,274 @@
+"""
+Stand-in for Spring that speaks the widget's protocol
+
+    python -m spring_kernel.fake_engine --size 4096 --delay 0.01
+
+Connects to the kernel like the widget does and answers its requests with
+generated results of a configurable size after a configurable delay, so
+the kernel can be exercised and benchmarked without launching Spring.
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import asyncio
+import json
+import logging
+import struct
+import time
+import zlib
+
+from . import codec
+from .protocol import encode_frame, FrameDecoder, RECV_CHUNK_SIZE
+from .spring_connector import HOST, PORT
+
+# Output larger than this is streamed while the cell runs, like _p does
+ECHO_CHUNK_SIZE = 64 * 1024
+
+
+def png_image(width, height):
+    """
+    Return a gray PNG image of the given size
+    """
+    def chunk(ctype, data):
+        return (struct.pack('>I', len(data)) + ctype + data +
+                struct.pack('>I', zlib.crc32(ctype + data) & 0xffffffff))
+    rows = b''.join(b'\x00' + b'\x80' * (width * 3) for _ in range(height))
+    return b''.join([
+        b'\x89PNG\r\n\x1a\n',
+        chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)),
+        chunk(b'IDAT', zlib.compress(rows)),
+        chunk(b'IEND', b''),
+    ])
+
+
+class FakeEngine(object):
+    """
+    A fake Spring instance.
+
+    Cells produce `size` bytes of output, the part beyond whole chunks of
+    ECHO_CHUNK_SIZE is streamed before the reply. Every reply is sent
+    `delay` seconds after its request arrives, requests are handled
+    concurrently like they are in Spring.
+    """
+
+    def __init__(self, host=HOST, port=PORT, name='fake', size=1024, delay=0.0,
+                 codecs=codec.CODECS, keys=1000, image_size=(320, 240)):
+        self.logger = logging.getLogger(__name__)
+        self.host = host
+        self.port = port
+        self.name = name
+        self.size = size
+        self.delay = delay
+        self.codecs = list(codecs)
+        self.keys = ['key{}'.format(i) for i in range(keys)]
+        self.image_size = image_size
+        # Picked by the kernel in its answer to the hello message
+        self.codec = 'json'
+        self.requests = 0
+        self.reader = None
+        self.writer = None
+        self.handlers = {
+            'execute' : self.execute,
+            'autocomplete' : self.autocomplete,
+            'inspect' : self.inspect,
+            'timeit' : self.timeit,
+            'profile' : self.profile,
+            'callins' : self.callins,
+            'show' : self.show,
+            'record' : self.record,
+            'watch' : self.watch,
+            'unwatch' : self.unwatch,
+            'cancel' : self.cancel,
+        }
+        # Events stopping the running watches, by watch number
+        self.watches = {}
+        # Events cancelling the running async cells, by task number
+        self.tasks = {}
+
+    async def connect(self):
+        """
+        Connect to the kernel and introduce this engine
+        """
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.send({'event' : 'hello', 'data' : {
+            'name' : self.name, 'codecs' : self.codecs, 'version' : 'fake', 'game' : 'Fake Game',
+            'writeDir' : '', 'capabilities' : sorted(self.handlers),
+            'states' : {'luaui' : {'state' : 'luaui', 'synced' : False, 'debug' : True,
+                                   'coroutines' : True, 'clock' : 'fake'}}}})
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def send(self, msg, blobs=()):
+        if blobs:
+            msg['blobs'] = len(blobs)
+        if self.codec == 'msgpack':
+            payload = codec.pack(msg)
+        else:
+            payload = json.dumps(msg).encode('utf-8')
+        self.writer.write(encode_frame(payload))
+        for blob in blobs:
+            self.writer.write(encode_frame(blob))
+
+    async def run(self):
+        """
+        Answer requests until the kernel closes the connection
+        """
+        if self.writer is None:
+            await self.connect()
+        decoder = FrameDecoder()
+        while True:
+            data = await self.reader.read(RECV_CHUNK_SIZE)
+            if not data:
+                return
+            decoder.feed(data)
+            for payload in decoder.frames():
+                msg = json.loads(payload.decode('utf-8'))
+                if msg.get('event') == 'hello':
+                    self.codec = msg['data'].get('codec', 'json')
+                    continue
+                asyncio.ensure_future(self.handle(msg))
+
+    async def handle(self, msg):
+        self.requests += 1
+        start = time.perf_counter()
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        handler = self.handlers.get(msg.get('command'))
+        if handler is None:
+            result = [["No such command found: {}".format(msg.get('command')), 'error']]
+        else:
+            result = await handler(msg['id'], msg.get('data') or {})
+        if result is not None:
+            # The timing of the request is sent right before its reply, like the widget does
+            run = 1000 * (time.perf_counter() - start)
+            self.send({'id' : msg['id'], 'event' : 'timing',
+                       'data' : {'run' : run, 'total' : run}})
+            self.send({'id' : msg['id'], 'result' : result})
+        await self.writer.drain()
+
+    async def execute(self, msgId, data):
+        if data.get('task'):
+            return await self.execute_task(msgId, data)
+        output = ('x' * 79 + '\n') * (self.size // 80) + 'x' * (self.size % 80)
+        streamed = len(output) - len(output) % ECHO_CHUNK_SIZE
+        for start in range(0, streamed, ECHO_CHUNK_SIZE):
+            self.send({'id' : msgId, 'event' : 'stream',
+                       'data' : output[start:start + ECHO_CHUNK_SIZE]})
+        return [[output[streamed:], 'output']]
+
+    async def execute_task(self, msgId, data):
+        # An async cell printing and reporting progress over 10 frames
+        cancel = self.tasks[data['task']] = asyncio.Event()
+        for frame in range(1, 11):
+            if cancel.is_set():
+                del self.tasks[data['task']]
+                return [['Cancelled after {} frames'.format(frame - 1), 'error']]
+            await asyncio.sleep(1 / 60)
+            self.send({'id' : msgId, 'event' : 'stream', 'data' : 'frame {}\n'.format(frame)})
+            self.send({'id' : msgId, 'event' : 'progress', 'data' : {'done' : frame, 'total' : 10}})
+        del self.tasks[data['task']]
+        return [['', 'output'], ['Ran over 10 frames', 'state-info']]
+
+    async def cancel(self, msgId, data):
+        cancel = self.tasks.get(data.get('task'))
+        if cancel is not None:
+            cancel.set()
+        return [['cancelled', cancel is not None]]
+
+    async def autocomplete(self, msgId, data):
+        return [['keys', self.keys], ['generation', 0]]
+
+    async def inspect(self, msgId, data):
+        return [['found', True], ['type', 'function'], ['id', '.'.join(map(str, data['path']))],
+                ['location', 'fake.lua:1'], ['source', 'function f()\nend\n']]
+
+    async def timeit(self, msgId, data):
+        number = data.get('number') or 1000
+        result = [['timer', 'fake'], ['number', number],
+                  ['times', [number * 1e-6 * (1 + i / 10) for i in range(data.get('repeat', 7))]]]
+        if data.get('memory'):
+            result.append(['memoryNumber', min(number, 1000)])
+            result.append(['memory', [min(number, 1000) * 0.5] * data.get('repeat', 7)])
+        return result
+
+    async def profile(self, msgId, data):
+        result = [['stacks', {'cell;update fake.lua:1' : 30, 'cell;update fake.lua:1;draw fake.lua:9' : 70,
+                              'cell;load fake.lua:20' : 12}],
+                  ['samples', 112], ['interval', data.get('interval')], ['duration', 5.0]]
+        if data.get('frames'):
+            # Frames pass at 60 per second
+            await asyncio.sleep(data['frames'] / 60)
+            result.append(['frames', data['frames']])
+        return result
+
+    async def callins(self, msgId, data):
+        frames = data.get('frames', 100)
+        await asyncio.sleep(frames / 60)
+        rows = [['Widget {}'.format(i), callin, frames, frames * 0.1 * i, 0.3 * i]
+                for i in range(1, 6) for callin in ('Update', 'DrawWorld')]
+        return [['rows', rows], ['frames', frames], ['clock', 'fake']]
+
+    async def show(self, msgId, data):
+        width, height = [max(1, int(side * (data.get('scale') or 1))) for side in self.image_size]
+        self.send({'id' : msgId, 'result' : {'format' : 'png', 'width' : width, 'height' : height}},
+                  [png_image(width, height)])
+
+    async def record(self, msgId, data):
+        width, height = [max(1, int(side * (data.get('scale') or 1))) for side in self.image_size]
+        image = png_image(width, height)
+        count = min(data.get('maxFrames', 300), int(data.get('duration', 1) * 30))
+        for index in range(count):
+            self.send({'id' : msgId, 'event' : 'frame',
+                       'data' : {'index' : index + 1, 't' : index / 30, 'width' : width,
+                                 'height' : height, 'format' : 'png'}},
+                      [image])
+        return {'frames' : count, 'dropped' : 0, 'duration' : count / 30}
+
+    async def watch(self, msgId, data):
+        # A watch replaces the one with the same number, like in Spring
+        if data.get('watch') in self.watches:
+            self.watches[data['watch']].set()
+        stop = self.watches[data.get('watch')] = asyncio.Event()
+        values = {}
+        frame = 0
+        while not stop.is_set():
+            frame += data.get('every', 30)
+            changed = {'frame' : frame, 'key{}'.format(frame % 7) : frame}
+            changed = {path : value for path, value in changed.items() if values.get(path) != value}
+            values.update(changed)
+            self.send({'id' : msgId, 'event' : 'watch', 'data' : {'set' : changed, 'removed' : []}})
+            try:
+                await asyncio.wait_for(stop.wait(), max(data.get('minInterval', 0), data.get('every', 30) / 60))
+            except asyncio.TimeoutError:
+                pass
+        if self.watches.get(data.get('watch')) is stop:
+            del self.watches[data['watch']]
+        return [['stopped', True]]
+
+    async def unwatch(self, msgId, data):
+        stopped = [number for number in data.get('watches', []) if number in self.watches]
+        for number in stopped:
+            self.watches[number].set()
+        return [['stopped', stopped]]
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m spring_kernel.fake_engine',
+                                     description='Connect a fake Spring instance to the kernel')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--name', default='fake')
+    parser.add_argument('--size', type=int, default=1024, help='bytes of output of every cell')
+    parser.add_argument('--delay', type=float, default=0.0, help='seconds before every reply')
+    parser.add_argument('--codec', choices=codec.CODECS, help='only offer this codec')
+    args = parser.parse_args()
+    engine = FakeEngine(args.host, args.port, args.name, args.size, args.delay,
+                        [args.codec] if args.codec else codec.CODECS)
+    asyncio.run(engine.run())
+
+
+if __name__ == '__main__':
+    main()
@@ -34,7 +34,9 @@ kernel_json = {
 	     "-m", PKGNAME,
 	     "-f", "{connection_file}"],
     "display_name": DISPLAY_NAME,
-    "name": KERNEL_NAME
+    "name": KERNEL_NAME,
+    # Interrupts are sent as messages, so they can cancel waiting on Spring
+    "interrupt_mode": "message"
 }
 
 
@@ -1,25 +1,64 @@
 from ipykernel.kernelbase import Kernel
 
+import argparse
+import asyncio
 import base64
+import bisect
+import collections
+import functools
 import os
 import logging
+import re
+import shlex
+import statistics
+import time
+import uuid
 
-from .utils import data_msg
-from .spring_connector import SpringConnector
+from .utils import data_msg, convert_image, payload_summary, progress_msg, shorten, watch_msg, HTML_LIMIT, IMAGE_MIMETYPES
+from .spring_connector import SpringConnector, SpringError, config, TIMEOUT
+from .animation import PngFrame, assemble_apng, assemble_gif, decode_frame, frame_strip
+from .profiling import callin_table, flame_graph, folded_text, profile_table
 
 # The list of implemented magics with their help, as a pair [param,help-text]
 magics = {
     '%lsmagics' : [ '', 'list all magics'],
     '%help' : [ '', 'show general help' ],
-    '%show' : [ '', 'show the current screen' ],
+    '%show' : [ '[-s SCALE] [-f png|jpg|webp] [-q QUALITY] [--file] [engines]',
+                'show the current screen, optionally downscaled (0 < SCALE <= 1) and in another format. With --file the image is handed over through a file instead of the socket, for engines on the same host'],
+    '%record' : [ '[-n EVERY] [-d SECONDS] [-s SCALE] [-o apng|gif|strip] [--max-frames N] [engines]',
+                  'capture every n-th draw frame for a duration and show it as an animation or a strip of frames'],
+    '%timeit' : [ '[-n NUMBER] [-r REPEAT] [-m] [--state STATE] [engines]',
+                  'time the Lua code of the cell, run in loops of NUMBER runs (picked automatically by default) REPEAT times in the last set state or STATE. With -m, the Lua memory allocated by each run is measured as well, in up to 1000 extra runs per repeat with the garbage collector stopped'],
+    '%profile' : [ '[-f FRAMES] [-i INSTRUCTIONS] [-o flame|table] [--sort self|total] [--state STATE] [engines]',
+                   'sample the Lua stack every INSTRUCTIONS VM instructions while the code of the cell runs or, for a cell without code, during the next FRAMES frames, and show a flame graph or a table of functions. Needs the debug library, which synced LuaRules lacks'],
+    '%callins' : [ '[-f FRAMES] [--sort total|mean|max|calls] [-n ROWS] [--state STATE] [engines]',
+                   'time every call-in of every widget or gadget of a state during the next FRAMES frames (game frames in synced LuaRules) and show the costliest ones'],
+    '%expand' : [ 'HANDLE [-s START] [-n COUNT] [-d DEPTH]',
+                  'show COUNT entries from START of a table that _p output in tree format only showed in part, with DEPTH levels of nested tables. The handle is shown where entries were left out'],
+    '%output' : [ '[N] [-o FILE] [--limit CHARS] [--html-limit CHARS]',
+                  'show or save to a file output N, the part of the output of a cell left out because it was longer than the output limit. --limit sets the limit, 0 for none. --html-limit sets the length of output above which it is only shown as plain text, 0 for none'],
+    '%watch' : [ '[-e EVERY] [-i SECONDS] [--state STATE] [engines]',
+                 'evaluate the Lua expression of the cell every EVERY frames (game frames in synced LuaRules) and keep its values up to date in the output of the cell, sending the changes at most every SECONDS. Without an expression, list the watches'],
+    '%unwatch' : [ '[N|all]', 'stop watch N, or all watches'],
+    '%async' : [ '[-t MS] [-y CALLS] [--state STATE] [engines]',
+                 'run the code of the cell as a coroutine resumed every frame for up to MS milliseconds, so long cells don\'t freeze the game. The code calls _yield() to let the frame go on once its time is up (without a clock, as in synced LuaRules, every CALLS-th call yields) and _progress(done, total, message) to report its progress. _p output is shown as it\'s printed and interrupting the kernel cancels the cell'],
+    '%timing' : [ '[on|off]', 'show how long each stage of a cell took under it, the timing is always in the execute reply metadata'],
+    '%engine' : [ '[engines]', 'select the engines cells are executed on, or list the connected engines' ],
+    '%status' : [ '[engines]', 'show what the connected engines announced when they connected: engine and game version, write directory, the Lua states reached and what they support' ],
+    '%format' : [ 'text|tree', 'print _p output as text, or as collapsible trees of typed values' ],
     '%luaui' : [ 'LuaUI', 'execute code in LuaMenu/LuaUI state, whichever is present.'],
     '%luamenu' : [ 'LuaMenu', 'execute code in LuaMenu/LuaUI state, whichever is present.'],
     '%uluarules' : [ 'LuaRules Unsynced', 'execute code in unsynced LuaRules state'],
     '%sluarules' : [ 'LuaRules Synced', 'execute code in synced LuaRules state'],
     '_p' : [ '', 'Lua helper function to print data to the notebook'],
     '_s' : [ '', 'Lua helper function to print the function source code'],
+    '_yield' : [ '', 'Lua helper function that lets the frame go on in %async cells once their time slice is spent'],
+    '_progress' : [ '', 'Lua helper function that reports the progress of %async cells, _progress(done, total, message)'],
 }
 
+# Magics that select the Lua state code is executed in
+STATE_MAGICS = ("luaui", "uluarules", "sluarules", "luamenu")
+
 
 # The full list of all magics
 magic_help = ('Available magics:\n' +
@@ -35,11 +74,219 @@ Additional things to note:
 - In case there is no state magic in the code block, the last set state will be used.
 - There can only be one state-magic per code block, and it must be at the beginning of the code block.
 - Non-state magics such as %lsmagic, %help and similar shouldn't appear along with Lua code.
+- When several engines are connected, %engine selects the ones cells are executed on: a name, a comma separated list of names, or "all". State magics and %show accept the same list to target engines for a single cell, e.g. %sluarules all. By default the first connected engine is used.
 - Don't use local variables if you want to access them in consequitive runs. They will be out of scope.
 - Variable scope is shared between different notebooks.
 """
 
 
+def split_magic(line):
+    """
+    Split a magic line into the magic name and its arguments
+    """
+    parts = line[1:].split(None, 1)
+    if not parts:
+        return '', ''
+    return parts[0].lower(), parts[1].strip() if len(parts) > 1 else ''
+
+
+def parse_engines(args):
+    """
+    Parse an engine selection: None when empty, 'all', or a list of names
+    """
+    if not args:
+        return None
+    if args.lower() in ('all', '*'):
+        return 'all'
+    return [name for name in re.split(r'[\s,]+', args) if name]
+
+
+class MagicArgumentParser(argparse.ArgumentParser):
+    """
+    Parser for magic arguments, which reports errors instead of exiting
+    """
+    def __init__(self, prog):
+        super(MagicArgumentParser, self).__init__(prog=prog, add_help=False)
+
+    def error(self, message):
+        raise ValueError('{}: {}'.format(self.prog, message))
+
+    def parse(self, args):
+        return self.parse_args(shlex.split(args))
+
+
+show_parser = MagicArgumentParser('%show')
+show_parser.add_argument('-s', '--scale', type=float, default=1.0)
+show_parser.add_argument('-f', '--format', choices=sorted(IMAGE_MIMETYPES), default='png')
+show_parser.add_argument('-q', '--quality', type=int)
+show_parser.add_argument('--file', action='store_true')
+show_parser.add_argument('engines', nargs='*')
+
+# Table path in front of the name being completed, e.g. `UnitDefs[1].` or `Spring.`
+COMPLETION_PATH = re.compile(
+    r'(?:[A-Za-z_]\w*(?:\s*(?:\.\s*[A-Za-z_]\w*|\[\s*(?:\d+|"[^"]*"|\'[^\']*\')\s*\]))*\s*[.:]\s*)?$')
+PATH_KEY = re.compile(r'([A-Za-z_]\w*)|\[\s*(?:(\d+)|"([^"]*)"|\'([^\']*)\')\s*\]')
+# Stages of a request to an engine in the order they happen, in the timing
+# shown by %timing
+TIMING_STAGES = (
+    ('connect', 'waiting for Spring and sending'),
+    ('transfer', 'socket and waiting for widget:Update'),
+    ('queue', 'waiting for earlier commands to run'),
+    ('decode', 'decoding the request in Spring'),
+    ('luarules', 'passing it on to the LuaRules gadget'),
+    ('run', 'running the command'),
+    ('encode', 'encoding the reply'),
+    ('reply', 'decoding the reply'),
+)
+
+
+def request_timing(timing):
+    """
+    Return the durations, in milliseconds, of the stages of a request from
+    the timing filled in by SpringConnector.executeLua
+    """
+    stages = {}
+    if 'sent' in timing:
+        stages['connect'] = 1000 * (timing['sent'] - timing['queued'])
+    engine = timing.get('engine') or {}
+    for stage in ('queue', 'decode', 'luarules', 'run', 'encode'):
+        if engine.get(stage) is not None:
+            stages[stage] = engine[stage]
+    if 'received' in timing:
+        stages['reply'] = 1000 * timing['decode']
+        # Whatever the engine didn't account for
+        if engine.get('total') is not None:
+            stages['transfer'] = max(0, 1000 * (timing['received'] - timing['sent']) - engine['total'])
+    return stages
+
+
+def timing_lines(timing):
+    """
+    Describe the timing of a cell, as stored in the execute reply metadata,
+    with a line for the cell and one for each engine
+    """
+    lines = ['{:.1f} ms in total, {:.1f} ms preparing and {:.1f} ms rendering the output'.format(
+        timing['total'], timing['prepare'], timing['render'])]
+    for engine, stages in timing['engines'].items():
+        lines.append('{}: '.format(engine) + ', '.join(
+            '{} {:.1f} ms'.format(description, stages[stage])
+            for stage, description in TIMING_STAGES if stage in stages))
+    return lines
+
+
+# Seconds to wait for Spring to list completions or inspect a name
+COMPLETE_TIMEOUT = 5
+# Handles of tables kept by Spring that the kernel remembers
+MAX_HANDLES = 1024
+# Characters of output shown for a cell, the rest is kept for %output
+OUTPUT_LIMIT = config.get("outputLimit", 1024 * 1024)
+# Outputs kept for %output
+MAX_KEPT_OUTPUTS = 8
+# Function sources kept by the kernel for each state
+MAX_INSPECTED = 256
+# Lines of source shown when inspecting with detail level 0
+INSPECT_PREVIEW_LINES = 30
+
+
+def completion_path(code):
+    """
+    Split the code in front of the cursor into the path of the table being
+    indexed and the start of the name being completed.
+    Return (path, prefix) where path is a tuple of keys from the globals.
+    """
+    prefix = re.search(r'\w*$', code).group()
+    before = code[:len(code) - len(prefix)]
+    path = []
+    for name, index, dquoted, squoted in PATH_KEY.findall(COMPLETION_PATH.search(before).group()):
+        if index:
+            path.append(int(index))
+        else:
+            path.append(name or dquoted or squoted)
+    return tuple(path), prefix
+
+
+record_parser = MagicArgumentParser('%record')
+record_parser.add_argument('-n', '--every', type=int, default=2)
+record_parser.add_argument('-d', '--duration', type=float, default=3.0)
+record_parser.add_argument('-s', '--scale', type=float, default=0.5)
+record_parser.add_argument('-o', '--output', choices=['apng', 'gif', 'strip'], default='apng')
+record_parser.add_argument('--max-frames', type=int, default=300)
+record_parser.add_argument('engines', nargs='*')
+
+timeit_parser = MagicArgumentParser('%timeit')
+timeit_parser.add_argument('-n', '--number', type=int)
+timeit_parser.add_argument('-r', '--repeat', type=int, default=7)
+timeit_parser.add_argument('-m', '--memory', action='store_true')
+timeit_parser.add_argument('--state', choices=STATE_MAGICS)
+timeit_parser.add_argument('engines', nargs='*')
+
+profile_parser = MagicArgumentParser('%profile')
+profile_parser.add_argument('-f', '--frames', type=int)
+profile_parser.add_argument('-i', '--interval', type=int, default=10000)
+profile_parser.add_argument('-o', '--output', choices=['flame', 'table'], default='flame')
+profile_parser.add_argument('--sort', choices=['self', 'total'], default='self')
+profile_parser.add_argument('--state', choices=STATE_MAGICS)
+profile_parser.add_argument('engines', nargs='*')
+
+callins_parser = MagicArgumentParser('%callins')
+callins_parser.add_argument('-f', '--frames', type=int, default=100)
+callins_parser.add_argument('--sort', choices=['total', 'mean', 'max', 'calls'], default='total')
+callins_parser.add_argument('-n', '--rows', type=int, default=30)
+callins_parser.add_argument('--state', choices=STATE_MAGICS)
+callins_parser.add_argument('engines', nargs='*')
+
+expand_parser = MagicArgumentParser('%expand')
+expand_parser.add_argument('handle', type=int)
+expand_parser.add_argument('-s', '--start', type=int, default=1)
+expand_parser.add_argument('-n', '--count', type=int, default=100)
+expand_parser.add_argument('-d', '--depth', type=int, default=2)
+
+output_parser = MagicArgumentParser('%output')
+output_parser.add_argument('output', type=int, nargs='?')
+output_parser.add_argument('-o', '--file')
+output_parser.add_argument('--limit', type=int)
+output_parser.add_argument('--html-limit', type=int)
+
+watch_parser = MagicArgumentParser('%watch')
+watch_parser.add_argument('-e', '--every', type=int, default=30)
+watch_parser.add_argument('-i', '--interval', type=float, default=0.5)
+watch_parser.add_argument('--state', choices=STATE_MAGICS)
+watch_parser.add_argument('engines', nargs='*')
+
+async_parser = MagicArgumentParser('%async')
+async_parser.add_argument('-t', '--slice', type=float, default=4.0)
+async_parser.add_argument('-y', '--yield-every', type=int, default=1000)
+async_parser.add_argument('--state', choices=STATE_MAGICS)
+async_parser.add_argument('engines', nargs='*')
+
+
+def format_duration(seconds):
+    """
+    Format a duration with 3 significant digits in the most fitting unit
+    """
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('µs', 1e-6)):
+        if seconds >= scale:
+            return '{:.3g} {}'.format(seconds / scale, unit)
+    return '{:.3g} ns'.format(seconds / 1e-9)
+
+
+def timeit_lines(result):
+    """
+    Describe the result of a timeit command: the min, median and standard
+    deviation of the time per loop, and the Lua memory it allocated
+    """
+    number = result['number']
+    times = [t / number for t in result['times']]
+    lines = ['min {}, median {} ± {} std. dev. per loop ({} runs, {} loops each, {})'.format(
+        format_duration(min(times)), format_duration(statistics.median(times)),
+        format_duration(statistics.pstdev(times)), len(times), number, result.get('timer'))]
+    if result.get('memory'):
+        memory = [kb / result['memoryNumber'] for kb in result['memory']]
+        lines.append('Lua memory: min {:.3g} KB, median {:.3g} KB allocated per loop'.format(
+            min(memory), statistics.median(memory)))
+    return lines
+
+
 class SpringRTSKernel(Kernel):
     implementation = 'SpringRTS'
     implementation_version = '1.0'
@@ -53,6 +300,21 @@ class SpringRTSKernel(Kernel):
     banner = "SpringRTS kernel - experimentation made easy"
 
 
+    def cell_state(self, code):
+        """
+        Return the state a cell would be executed in: the one set by its state
+        magic, or the last set state
+        """
+        for line in code.splitlines():
+            line = line.strip()
+            if line != "":
+                if line[0] == '%':
+                    magic = split_magic(line)[0]
+                    if magic in STATE_MAGICS:
+                        return magic
+                break
+        return self.state
+
     def maybe_magic(self, code):
         """
         Process code and execute magic. If code should still be executed afterwards, return it.
@@ -66,7 +328,7 @@ class SpringRTSKernel(Kernel):
             line = line.strip()
             if line != "":
                 if line[0] == '%':
-                    magic = line[1:].lower()
+                    magic, args = split_magic(line)
                     indx = i
                 break
         # Magic wasn't found in the first non-whitespace line
@@ -88,13 +350,217 @@ class SpringRTSKernel(Kernel):
                 'outputType' : 'help'
             }
         elif magic == 'show':
+            try:
+                options = show_parser.parse(args)
+                if not 0 < options.scale <= 1:
+                    raise ValueError('%show: scale must be between 0 and 1')
+            except ValueError as ex:
+                return {
+                    'output' : str(ex),
+                    'outputType' : 'error'
+                }
+            return {
+                'show' : options, # uglish
+                'engines' : parse_engines(' '.join(options.engines)),
+            }
+        elif magic == 'record':
+            try:
+                options = record_parser.parse(args)
+                if not 0 < options.scale <= 1:
+                    raise ValueError('%record: scale must be between 0 and 1')
+            except ValueError as ex:
+                return {
+                    'output' : str(ex),
+                    'outputType' : 'error'
+                }
+            return {
+                'record' : options,
+                'engines' : parse_engines(' '.join(options.engines)),
+            }
+        elif magic == 'timeit':
+            try:
+                options = timeit_parser.parse(args)
+                if options.number is not None and options.number < 1:
+                    raise ValueError('%timeit: the number of loops must be positive')
+                if options.repeat < 1:
+                    raise ValueError('%timeit: the number of repeats must be positive')
+            except ValueError as ex:
+                return {
+                    'output' : str(ex),
+                    'outputType' : 'error'
+                }
+            return {
+                'timeit' : options,
+                'code' : code,
+                'engines' : parse_engines(' '.join(options.engines)),
+            }
+        elif magic == 'profile':
+            try:
+                options = profile_parser.parse(args)
+                if options.interval < 1:
+                    raise ValueError('%profile: the sampling interval must be positive')
+                if options.frames is not None:
+                    if options.frames < 1:
+                        raise ValueError('%profile: the number of frames must be positive')
+                    if code.strip():
+                        raise ValueError('%profile: either profile the code of the cell or a number of frames')
+            except ValueError as ex:
+                return {
+                    'output' : str(ex),
+                    'outputType' : 'error'
+                }
+            return {
+                'profile' : options,
+                'code' : code,
+                'engines' : parse_engines(' '.join(options.engines)),
+            }
+        elif magic == 'callins':
+            try:
+                options = callins_parser.parse(args)
+                if options.frames < 1:
+                    raise ValueError('%callins: the number of frames must be positive')
+            except ValueError as ex:
+                return {
+                    'output' : str(ex),
+                    'outputType' : 'error'
+                }
+            return {
+                'callins' : options,
+                'engines' : parse_engines(' '.join(options.engines)),
+            }
+        elif magic == 'expand':
+            try:
+                options = expand_parser.parse(args)
+                if options.start < 1 or options.count < 1 or options.depth < 1:
+                    raise ValueError('%expand: start, count and depth must be positive')
+            except ValueError as ex:
+                return {
+                    'output' : str(ex),
+                    'outputType' : 'error'
+                }
+            return {
+                'expand' : options,
+            }
+        elif magic == 'output':
+            try:
+                options = output_parser.parse(args)
+                if options.limit is not None:
+                    if options.limit < 0:
+                        raise ValueError('%output: the limit can\'t be negative')
+                    self.outputLimit = options.limit
+                if options.html_limit is not None:
+                    if options.html_limit < 0:
+                        raise ValueError('%output: the HTML limit can\'t be negative')
+                    self.htmlLimit = options.html_limit
+                if options.output is None:
+                    return {
+                        'output' : self.output_info(),
+                        'outputType' : 'help'
+                    }
+                if options.output not in self._kept:
+                    raise ValueError('%output: no output {} is kept'.format(options.output))
+            except ValueError as ex:
+                return {
+                    'output' : str(ex),
+                    'outputType' : 'error'
+                }
+            return {
+                'keptOutput' : options,
+            }
+        elif magic == 'watch':
+            try:
+                options = watch_parser.parse(args)
+                if options.every < 1:
+                    raise ValueError('%watch: the number of frames must be positive')
+                if options.interval < 0:
+                    raise ValueError('%watch: the interval can\'t be negative')
+            except ValueError as ex:
+                return {
+                    'output' : str(ex),
+                    'outputType' : 'error'
+                }
+            if not code.strip():
+                return {
+                    'output' : self.watch_info(),
+                    'outputType' : 'help'
+                }
+            return {
+                'watch' : options,
+                'code' : code,
+                'engines' : parse_engines(' '.join(options.engines)),
+            }
+        elif magic == 'async':
+            try:
+                options = async_parser.parse(args)
+                if options.slice <= 0 or options.yield_every < 1:
+                    raise ValueError('%async: the time slice and the calls between yields must be positive')
+            except ValueError as ex:
+                return {
+                    'output' : str(ex),
+                    'outputType' : 'error'
+                }
+            return {
+                'code' : code,
+                'engines' : parse_engines(' '.join(options.engines)),
+                'async' : options,
+            }
+        elif magic == 'unwatch':
+            if args and args.lower() != 'all':
+                try:
+                    numbers = [int(args)]
+                except ValueError:
+                    numbers = []
+                if not numbers or numbers[0] not in self._watches:
+                    return {
+                        'output' : "%unwatch: no such watch: " + args,
+                        'outputType' : 'error'
+                    }
+            else:
+                numbers = list(self._watches)
+            return {
+                'unwatch' : numbers,
+            }
+        elif magic == 'engine':
+            if args:
+                self.engines = parse_engines(args)
+            return {
+                'output' : self.engine_info(),
+                'outputType' : 'help'
+            }
+        elif magic == 'status':
+            return {
+                'output' : self.status_info(parse_engines(args)),
+                'outputType' : 'help'
+            }
+        elif magic == 'timing':
+            if args:
+                if args.lower() not in ('on', 'off'):
+                    return {
+                        'output' : "%timing: expected on or off, got " + args,
+                        'outputType' : 'error'
+                    }
+                self.showTiming = args.lower() == 'on'
+            return {
+                'output' : "Showing cell timing: " + ('on' if self.showTiming else 'off'),
+                'outputType' : 'help'
+            }
+        elif magic == 'format':
+            if args:
+                if args.lower() not in ('text', 'tree'):
+                    return {
+                        'output' : "Unknown output format: " + args,
+                        'outputType' : 'error'
+                    }
+                self.format = args.lower()
             return {
-                'show' : True # uglish
+                'output' : "Output format: " + self.format,
+                'outputType' : 'help'
             }
-        elif magic in ["luaui", "uluarules", "sluarules", "luamenu"]:
+        elif magic in STATE_MAGICS:
             self.state = magic
             return {
                 'code' : code,
+                'engines' : parse_engines(args),
             }
         else:
             return {
@@ -102,26 +568,256 @@ class SpringRTSKernel(Kernel):
                 'outputType' : 'error'
             }
 
-    def __init__(self, *args, **kwargs):
+    def output_info(self):
+        """
+        Describe the output limit and the kept outputs
+        """
+        lines = ['Output limit: {}'.format(
+            '{} characters'.format(self.outputLimit) if self.outputLimit else 'none')]
+        lines.append('HTML limit: {}'.format(
+            '{} characters'.format(self.htmlLimit) if self.htmlLimit else 'none'))
+        for number, text in self._kept.items():
+            lines.append('Output {}: {} characters'.format(number, len(text)))
+        return '\n'.join(lines)
+
+    def watch_info(self):
+        """
+        Describe the running watches
+        """
+        if not self._watches:
+            return 'No watches'
+        return '\n'.join('Watch {}: {} in {}, {} updates'.format(
+            number, shorten(watch['code'].strip(), 60), magics["%" + watch['state']][0], watch['updates'])
+            for number, watch in sorted(self._watches.items()))
+
+    def engine_info(self):
+        """
+        Describe the connected engines and the ones cells are executed on
+        """
+        names = self.sc.engineNames()
+        if self.engines is None:
+            selected = 'the first connected engine'
+        elif self.engines == 'all':
+            selected = 'all engines'
+        else:
+            selected = ', '.join(self.engines)
+        return 'Connected engines: {}\nCells are executed on: {}'.format(
+            ', '.join(names) or 'none', selected)
+
+    def status_info(self, engines=None):
+        """
+        Describe the connected engines from what they announced, without
+        asking them
+        """
+        names = self.sc.engineNames()
+        if not names:
+            return 'No engines are connected'
+        if isinstance(engines, list):
+            names = [name for name in names if name in engines]
+            if not names:
+                return 'Not connected: {}'.format(', '.join(engines))
+        lines = []
+        for name in names:
+            info = self.sc.engineInfo(name)
+            lines.append('{}: connected {:.0f} s ago, engine {}, game {}, sending {}'.format(
+                name, time.time() - info['connectedAt'], info.get('version') or 'unknown',
+                info.get('game') or 'unknown', info['codec']))
+            lines.append('  Write directory: {}'.format(info.get('writeDir') or 'unknown'))
+            for state, stateInfo in sorted((info.get('states') or {}).items()):
+                features = [feature if stateInfo.get(feature) else 'no ' + feature
+                            for feature in ('debug', 'coroutines')]
+                features.append('clock ' + (stateInfo.get('clock') or 'none'))
+                lines.append('  {}: {}'.format(magics.get('%' + str(state), [state])[0], ', '.join(features)))
+            if info.get('capabilities'):
+                lines.append('  Commands: {}'.format(', '.join(info['capabilities'])))
+        return '\n'.join(lines)
+
+    def state_lacks(self, engine, state, feature):
+        """
+        Return whether an engine announced that a state lacks a feature,
+        such as debug
+        """
+        info = self.sc.engineInfo(engine) or {}
+        return (info.get('states') or {}).get(state, {}).get(feature) is False
+
+    def targets(self, engines):
+        """
+        Return the names of the engines a request is sent to, or None for
+        the first connected engine
+          @param engines: selection parsed from the cell, overrides %engine
+        """
+        if engines is None:
+            engines = self.engines
+        if engines == 'all':
+            return self.sc.engineNames()
+        return engines
+
+    def __init__(self, *args, connector=None, **kwargs):
         """
         Initialize the object
+          @param connector (SpringConnector): the connection to Spring, a
+            new one listening on the configured port by default
         """
-        # Define logging status before calling parent constructor
-        logging.basicConfig(filename='kernlog.log',level=logging.DEBUG)
+        # Logging is set up by the kernel's launcher, see __main__
         self.logger = logging.getLogger(__name__)
         self.logger.info("Starting SpringRTS Kernel")
 
         self.state = "luaui"
+        # Format of _p output selected with %format
+        self.format = "text"
+        # Engines selected with %engine, None for the first connected one
+        self.engines = None
+        # The Spring request of the running cell, cancelled on interrupt
+        self._execution = None
+        # Engine whose output was streamed last
+        self._streamEngine = None
+        # Cached completions by (engine, state): the generation of the state
+        # they were listed in and the field names by table path
+        self._completions = {}
+        # Inspected function sources by (engine, state), keyed by function id
+        self._inspected = {}
+        # Tables kept by Spring by kernel handle: (engine, state, handle in
+        # that state), see _keep_handles
+        self._handles = collections.OrderedDict()
+        self._handleIds = {}
+        # Running watches by number, see _watch
+        self._watches = {}
+        self._lastWatch = 0
+        # Number of the last %async cell, used to cancel it in Spring
+        self._lastTask = 0
+        # Characters of output a cell shows, the rest is withheld and kept
+        self.outputLimit = OUTPUT_LIMIT
+        # Characters of output above which it's only sent as plain text
+        self.htmlLimit = config.get("htmlLimit", HTML_LIMIT)
+        self._shown = 0
+        self._withheld = []
+        self._kept = collections.OrderedDict()
+        self._lastKept = 0
+        self._lastHandle = 0
+        # Show the timing of cells under them
+        self.showTiming = False
+        # Timing of the last cell, added to its execute reply metadata
+        self._timing = None
 
         # Start base kernel
         super(SpringRTSKernel, self).__init__(*args, **kwargs)
 
-        # Start Spring connector
-        self.sc = SpringConnector()
-        self.sc.start()
+        self.sc = connector if connector is not None else SpringConnector()
+
+    def start(self):
+        super(SpringRTSKernel, self).start()
+        # Spring connects to a server running on the kernel's own event loop
+        self.io_loop.add_callback(self.sc.start)
+
+    async def _wait(self, request):
+        """
+        Wait for requests sent to Spring. The wait is cancelled if the kernel
+        is interrupted in the meantime.
+        """
+        self._execution = asyncio.ensure_future(request)
+        try:
+            return await self._execution
+        finally:
+            self._execution = None
+
+    async def _request(self, msg, engines, onEvent=None, timeout=TIMEOUT, timings=None):
+        """
+        Send a request to each of the engines, or to the first connected one
+        if engines is None, and return a list of (engine, result) pairs.
+        A result is the raised exception if that engine didn't reply.
+          @param onEvent (callable): called with (engine, event, data) for
+            events sent by Spring while the request runs
+          @param timings (dict): filled with the timing of the request to
+            each engine, see SpringConnector.executeLua
+        """
+        if engines is None:
+            result = await self._wait(self.sc.executeLua(
+                msg, timeout, onEvent=onEvent and functools.partial(onEvent, None),
+                timing=None if timings is None else timings.setdefault(None, {})))
+            return [(None, result)]
+        if not engines:
+            raise SpringError('No engines are connected')
+        return await self._wait(self.sc.executeMany(msg, engines, timeout, onEvent, timings))
+
+    def _stream(self, text, engine=None):
+        """
+        Send output to the frontend as it arrives, prefixed by the engine
+        name when it comes from a different engine than the previous output
+        """
+        if engine is not None and engine != self._streamEngine:
+            text = '[{}]\n{}'.format(engine, text)
+        self._streamEngine = engine
+        self.send_response(self.iopub_socket, 'stream', {'name' : 'stdout', 'text' : text})
 
-    def do_execute(self, code, silent, store_history=True, user_expressions=None,
+    def _cap(self, text, engine=None):
+        """
+        Return the part of output text that fits in the output limit of the
+        cell, the rest of it is withheld
+        """
+        room = self.outputLimit - self._shown
+        if not self.outputLimit or len(text) <= room:
+            self._shown += len(text)
+            return text
+        room = max(0, room)
+        self._withheld.append((engine, text[room:]))
+        self._shown += room
+        return text[:room]
+
+    def _keep_withheld(self):
+        """
+        Keep the output withheld from the cell for %output and return the
+        message telling how to show it
+        """
+        engines = set(engine for engine, _ in self._withheld)
+        parts = []
+        last = None
+        for engine, text in self._withheld:
+            if len(engines) > 1 and engine != last:
+                parts.append('[{}]\n'.format(engine))
+                last = engine
+            parts.append(text)
+        self._withheld = []
+        self._lastKept += 1
+        self._kept[self._lastKept] = ''.join(parts)
+        if len(self._kept) > MAX_KEPT_OUTPUTS:
+            self._kept.popitem(last=False)
+        return ("Output truncated after {} characters, {} more were left out. "
+                "%output {} shows them, %output {} -o FILE saves them".format(
+                    self._shown, len(self._kept[self._lastKept]), self._lastKept, self._lastKept), 'warning')
+
+    def _kept_output(self, options):
+        """
+        Show or save an output left out of a cell
+        """
+        text = self._kept[options.output]
+        if options.file:
+            try:
+                with open(options.file, 'w') as f:
+                    f.write(text)
+            except OSError as ex:
+                return self._send(data=[(str(ex), 'error')], status='error')
+            return self._send(data=[("Saved {} characters to {}".format(len(text), options.file), 'state-info')])
+        self.send_response(self.iopub_socket, 'stream', {'name' : 'stdout', 'text' : text})
+        return self._send(data=None)
+
+    def _interrupt(self):
+        if self._execution is not None:
+            self.logger.info("Interrupting the running cell")
+            self._execution.cancel()
+
+    async def interrupt_request(self, stream, ident, parent):
+        """
+        Interrupts only need to stop waiting for Spring, so they are handled
+        here instead of by signalling the kernel process.
+        This runs on the control thread, the cell runs on the shell event loop.
+        """
+        self.io_loop.add_callback(self._interrupt)
+        self.session.send(stream, 'interrupt_reply', {'status': 'ok'}, parent, ident=ident)
+
+    async def do_execute(self, code, silent, store_history=True, user_expressions=None,
                    allow_stdin=False):
+        started = time.perf_counter()
+        self._timing = None
         result = self.maybe_magic(code)
         if result is not None:
             if result.get('output'):
@@ -129,66 +825,714 @@ class SpringRTSKernel(Kernel):
                     data=[(result['output'], result.get('outputType'))],
                     status=result.get('outputType'))
             elif result.get('show'):
-                self.logger.info("Asking to show screen")
-                msg = {'command' : 'show'}
-                results = self.sc.executeLua(msg) #results are ignored
-                self.send_response(
-                    self.iopub_socket,
-                    'display_data', {
-                        'data' : {
-                            "image/png" : base64.b64encode(open(results["imgPath"], "rb").read()),
-                        }
-                    }
-                )
-                return {'status': 'ok',
-                        # The base class increments the execution count
-                        'execution_count': self.execution_count,
-                        'payload': [],
-                        'user_expressions': {},
-                       }
-                #return self._send(
-                #    data=results,
-                #    status='ok')
+                return await self._show(self.targets(result['engines']), result['show'])
+            elif result.get('record'):
+                return await self._record(self.targets(result['engines']), result['record'])
+            elif result.get('timeit'):
+                return await self._timeit(self.targets(result['engines']), result['timeit'], result['code'])
+            elif result.get('profile'):
+                return await self._profile(self.targets(result['engines']), result['profile'], result['code'])
+            elif result.get('callins'):
+                return await self._callins(self.targets(result['engines']), result['callins'])
+            elif result.get('expand'):
+                return await self._expand(result['expand'])
+            elif result.get('keptOutput'):
+                return self._kept_output(result['keptOutput'])
+            elif result.get('watch'):
+                return self._watch(self.targets(result['engines']), result['watch'], result['code'])
+            elif 'unwatch' in result:
+                return await self._unwatch(result['unwatch'])
             elif result.get('code') is None:
                 raise
             code = result['code']
+            engines = self.targets(result['engines'])
+            options = result.get('async')
+        else:
+            engines = self.targets(None)
+            options = None
 
-        exec_state = magics["%" + self.state][0]
+        state = (options.state or self.state) if options else self.state
+        exec_state = magics["%" + state][0]
+        # The cell can change any table, in any state
+        self._completions.clear()
         msg = {
             'command' : 'execute',
             'data' : {
                 'code' : code,
-                'state' : self.state,
+                'state' : state,
+                'format' : self.format,
+            },
+        }
+        # Async cells run over as many frames as they need, until they are interrupted
+        timeout = TIMEOUT
+        if options:
+            self._lastTask += 1
+            msg['data'].update({
+                'task' : self._lastTask,
+                'slice' : options.slice,
+                'yieldEvery' : options.yield_every,
+            })
+            timeout = None
+        # Progress displays of async cells, by engine
+        progress = {}
+        self.logger.info("Got Lua to execute: {}".format(shorten(code)))
+        # Engines that streamed output, the rest of their output is streamed as well
+        streamed = set()
+        self._streamEngine = None
+        self._shown = 0
+        self._withheld = []
+
+        def onEvent(engine, event, data):
+            if event == 'stream':
+                streamed.add(engine)
+                text = self._cap(data, engine)
+                if text:
+                    self._stream(text, engine)
+            elif event == 'progress':
+                self._show_progress(progress, engine, data)
+
+        timings = {}
+        try:
+            results = await self._request(msg, engines, onEvent, timeout, timings)
+        except asyncio.CancelledError:
+            if options:
+                asyncio.ensure_future(self._cancel_task(state, self._lastTask, engines))
+                return self._send(data=[("Execution interrupted, the cell is cancelled", 'warning')],
+                                  status='error')
+            return self._send(
+                data=[("Execution interrupted, Spring may still finish running the cell", 'warning')],
+                status='error')
+        except Exception as ex:
+            self.logger.warning("Exception of type {0} occurred: {1}".format(type(ex).__name__, ex))
+            return self._send(
+                data=[(str(ex) or "Timeout executing task", 'warning')],
+                status='error')
+        status = 'ok'
+        data = [(exec_state, 'state-info')]
+        for engine, result in results:
+            if engine is not None:
+                data.append((engine, 'engine-info'))
+            if isinstance(result, Exception):
+                data.append((str(result) or "Timeout executing task", 'warning'))
+                status = 'error'
+            else:
+                for output, css in result:
+                    if css == 'tree':
+                        for nodes in output:
+                            for node in nodes:
+                                self._keep_handles(node, engine, state)
+                    if css == 'output':
+                        output = self._cap(output, engine)
+                    if css == 'output' and engine in streamed:
+                        if output:
+                            self._stream(output, engine)
+                    else:
+                        data.append((output, css))
+        if self._withheld:
+            data.append(self._keep_withheld())
+        self.logger.info("Got results: {}".format(payload_summary(data)))
+        rendering = time.perf_counter()
+        reply = self._send(
+            data=data,
+            status=status)
+        self._timing = {
+            'total' : 1000 * (time.perf_counter() - started),
+            'prepare' : 1000 * (min(timing['queued'] for timing in timings.values()) - started),
+            'render' : 1000 * (time.perf_counter() - rendering),
+            'engines' : {engine or 'default' : request_timing(timing)
+                         for engine, timing in timings.items()},
+        }
+        if self.showTiming:
+            self._send(data=[(line, 'state-info') for line in timing_lines(self._timing)], silent=silent)
+        return reply
+
+    def finish_metadata(self, parent, metadata, reply_content):
+        """
+        Add the timing of the cell to the execute reply metadata
+        """
+        metadata = super(SpringRTSKernel, self).finish_metadata(parent, metadata, reply_content)
+        if self._timing is not None:
+            metadata['spring_kernel'] = {'timing' : self._timing}
+        return metadata
+
+    async def _show(self, engines, options):
+        self.logger.info("Asking to show screen")
+        # Spring saves png or jpg, other formats and qualities are encoded here
+        engineFormat = options.format
+        if engineFormat not in ('png', 'jpg') or options.quality is not None:
+            engineFormat = 'png'
+        msg = {
+            'command' : 'show',
+            'data' : {
+                'scale' : options.scale,
+                'format' : engineFormat,
+                'transfer' : 'file' if options.file else 'inband',
+            },
+        }
+        try:
+            results = await self._request(msg, engines)
+        except asyncio.CancelledError:
+            return self._send(data=[("Screenshot interrupted", 'warning')], status='error')
+        except Exception as ex:
+            return self._send(data=[(str(ex), 'warning')], status='error')
+        status = 'ok'
+        for engine, result in results:
+            if engine is not None:
+                self._send(data=[(engine, 'engine-info')])
+            try:
+                if isinstance(result, Exception):
+                    raise result
+                if result.get('error'):
+                    raise SpringError(result['error'])
+                if 'path' in result:
+                    with open(result['path'], 'rb') as f:
+                        image = f.read()
+                    os.remove(result['path'])
+                else:
+                    image = result['blobs'][0]
+                fmt = result.get('format', 'png')
+                if fmt != options.format or options.quality is not None:
+                    image = convert_image(image, options.format, options.quality)
+                    fmt = options.format
+            except Exception as ex:
+                self._send(data=[(str(ex) or "Timeout taking screenshot", 'warning')])
+                status = 'error'
+                continue
+            self.send_response(
+                self.iopub_socket,
+                'display_data', {
+                    'data' : {
+                        IMAGE_MIMETYPES[fmt] : base64.b64encode(image).decode('ascii'),
+                    },
+                    'metadata' : {
+                        IMAGE_MIMETYPES[fmt] : {
+                            'width' : result.get('width'),
+                            'height' : result.get('height'),
+                        },
+                    },
+                }
+            )
+        return self._send(data=None, status=status)
+
+    async def _record(self, engines, options):
+        """
+        Record frames from the engines. Frames are decoded in worker threads
+        as they arrive, so only the final assembly is left once the
+        recording ends.
+        """
+        self.logger.info("Asking to record the screen")
+        loop = asyncio.get_running_loop()
+        decoder = {'apng' : PngFrame, 'gif' : decode_frame}.get(options.output)
+        # Capture times and decoded frames (futures), by engine
+        captures = {}
+
+        def onEvent(engine, event, data):
+            if event != 'frame':
+                return
+            frame = data['blobs'][0]
+            if decoder is not None:
+                frame = loop.run_in_executor(None, decoder, frame)
+            captures.setdefault(engine, []).append((data['t'], frame))
+
+        msg = {
+            'command' : 'record',
+            'data' : {
+                'every' : options.every,
+                'duration' : options.duration,
+                'scale' : options.scale,
+                'maxFrames' : options.max_frames,
+            },
+        }
+        try:
+            results = await self._request(msg, engines, onEvent, options.duration + TIMEOUT)
+        except asyncio.CancelledError:
+            return self._send(data=[("Recording interrupted", 'warning')], status='error')
+        except Exception as ex:
+            return self._send(data=[(str(ex), 'warning')], status='error')
+        status = 'ok'
+        for engine, result in results:
+            if engine is not None:
+                self._send(data=[(engine, 'engine-info')])
+            frames = captures.get(engine, [])
+            try:
+                if isinstance(result, Exception):
+                    raise result
+                if result.get('error'):
+                    raise SpringError(result['error'])
+                if not frames:
+                    raise SpringError("No frames were captured")
+                times = [t for t, _ in frames]
+                if options.output == 'strip':
+                    display = {'text/html' : frame_strip([frame for _, frame in frames])}
+                else:
+                    decoded = await asyncio.gather(*[frame for _, frame in frames])
+                    if options.output == 'gif':
+                        image = await loop.run_in_executor(None, assemble_gif, decoded, times)
+                        mimetype = 'image/gif'
+                    else:
+                        image = await loop.run_in_executor(None, assemble_apng, decoded, times)
+                        mimetype = 'image/png'
+                    display = {mimetype : base64.b64encode(image).decode('ascii')}
+            except Exception as ex:
+                self._send(data=[(str(ex) or "Timeout recording", 'warning')])
+                status = 'error'
+                continue
+            self._send(data=[("{} frames in {:.1f} s, {} dropped".format(
+                result.get('frames'), result.get('duration', 0), result.get('dropped', 0)), 'state-info')])
+            self.send_response(self.iopub_socket, 'display_data', {'data' : display, 'metadata' : {}})
+        return self._send(data=None, status=status)
+
+    def _keep_handles(self, node, engine, state):
+        """
+        Replace the handles of the tables Spring kept in an output node with
+        kernel handles, which also identify the engine and state
+        """
+        if node.get('h') is not None:
+            kept = (engine, state, node['h'])
+            handle = self._handleIds.get(kept)
+            if handle is None:
+                self._lastHandle += 1
+                handle = self._lastHandle
+                self._handleIds[kept] = handle
+                self._handles[handle] = kept
+                if len(self._handles) > MAX_HANDLES:
+                    del self._handleIds[self._handles.popitem(last=False)[1]]
+            else:
+                self._handles.move_to_end(handle)
+            node['h'] = handle
+        for item in node.get('items') or ():
+            self._keep_handles(item['v'], engine, state)
+
+    async def _expand(self, options):
+        """
+        Show a page of a table kept by Spring
+        """
+        if options.handle not in self._handles:
+            return self._send(data=[("%expand: unknown table handle {}".format(options.handle), 'error')],
+                              status='error')
+        engine, state, handle = self._handles[options.handle]
+        self._handles.move_to_end(options.handle)
+        msg = {
+            'command' : 'expand',
+            'data' : {
+                'state' : state,
+                'handle' : handle,
+                'start' : options.start,
+                'count' : options.count,
+                'depth' : options.depth,
+            },
+        }
+        try:
+            result = dict(await self._wait(self.sc.executeLua(msg, COMPLETE_TIMEOUT, engine)))
+        except asyncio.CancelledError:
+            return self._send(data=[("Interrupted", 'warning')], status='error')
+        except Exception as ex:
+            return self._send(data=[(str(ex) or "Timeout expanding the table", 'warning')], status='error')
+        if 'node' not in result:
+            return self._send(data=[(result.get('error') or "Spring can't expand tables", 'error')],
+                              status='error')
+        self._keep_handles(result['node'], engine, state)
+        return self._send(data=[([[result['node']]], 'tree')])
+
+    def _watch(self, engines, options, code):
+        """
+        Start watching an expression. Spring sends the values that changed
+        as events of the watch request, which is only answered once the
+        watch stops, and the output of the cell is updated with them.
+        """
+        self._lastWatch += 1
+        number = self._lastWatch
+        state = options.state or self.state
+        watch = {
+            'code' : code,
+            'state' : state,
+            'engines' : engines,
+            'display' : uuid.uuid4().hex,
+            # (values by path, error) by engine
+            'values' : {},
+            'updates' : 0,
+            'status' : 'waiting for the first values',
+        }
+        self._watches[number] = watch
+        msg = {
+            'command' : 'watch',
+            'data' : {
+                'code' : code,
+                'state' : state,
+                'watch' : number,
+                'every' : options.every,
+                'minInterval' : options.interval,
+            },
+        }
+
+        def onEvent(engine, event, data):
+            if event != 'watch':
+                return
+            values, error = watch['values'].get(engine, ({}, None))
+            values.update(data.get('set') or {})
+            for path in data.get('removed') or ():
+                values.pop(path, None)
+            watch['values'][engine] = (values, data.get('error'))
+            watch['updates'] += 1
+            watch['status'] = 'updated {}'.format(time.strftime('%H:%M:%S'))
+            self._show_watch(number, watch, 'update_display_data')
+
+        self._show_watch(number, watch, 'display_data')
+        asyncio.ensure_future(self._run_watch(number, watch, msg, engines, onEvent))
+        return self._send(data=None)
+
+    def _show_progress(self, progress, engine, data):
+        """
+        Show the progress reported by an async cell, updating its display
+        """
+        msg_type = 'update_display_data' if engine in progress else 'display_data'
+        displayId = progress.setdefault(engine, uuid.uuid4().hex)
+        self.send_response(self.iopub_socket, msg_type, {
+            'data' : progress_msg(data.get('done'), data.get('total'), data.get('message'), engine),
+            'metadata' : {},
+            'transient' : {'display_id' : displayId},
+        })
+
+    async def _cancel_task(self, state, task, engines):
+        """
+        Cancel an interrupted async cell in Spring, it stops in the next frame
+        """
+        msg = {
+            'command' : 'cancel',
+            'data' : {
+                'state' : state,
+                'task' : task,
+            },
+        }
+        for engine in (engines or [None]):
+            try:
+                await self.sc.executeLua(msg, COMPLETE_TIMEOUT, engine)
+            except Exception as ex:
+                self.logger.warning("Failed cancelling cell {}: {}".format(task, ex))
+
+    def _show_watch(self, number, watch, msg_type):
+        title = 'Watch {} in {}, {}'.format(number, magics["%" + watch['state']][0], watch['status'])
+        if number in self._watches:
+            title += ' (%unwatch {} stops it)'.format(number)
+        self.send_response(self.iopub_socket, msg_type, {
+            'data' : watch_msg(title, watch['values']),
+            'metadata' : {},
+            'transient' : {'display_id' : watch['display']},
+        })
+
+    async def _run_watch(self, number, watch, msg, engines, onEvent):
+        """
+        Wait for the watch request to be answered, when it stops or fails
+        """
+        try:
+            if engines is None:
+                results = [(None, await self.sc.executeLua(
+                    msg, None, onEvent=functools.partial(onEvent, None)))]
+            else:
+                results = await self.sc.executeMany(msg, engines, None, onEvent)
+            errors = [str(result) if isinstance(result, Exception) else dict(result).get('error')
+                      for _, result in results]
+            errors = [error for error in errors if error]
+            watch['status'] = 'stopped' + (': ' + '; '.join(errors) if errors else '')
+        except Exception as ex:
+            watch['status'] = 'stopped: {}'.format(ex)
+        self._watches.pop(number, None)
+        self._show_watch(number, watch, 'update_display_data')
+
+    async def _unwatch(self, numbers):
+        """
+        Stop watches, Spring answers their requests
+        """
+        # Watches to stop by engine and state
+        targets = {}
+        for number in numbers:
+            watch = self._watches[number]
+            for engine in (watch['engines'] or [None]):
+                targets.setdefault((engine, watch['state']), []).append(number)
+        status = 'ok'
+        for (engine, state), stopped in targets.items():
+            msg = {
+                'command' : 'unwatch',
+                'data' : {
+                    'state' : state,
+                    'watches' : stopped,
+                },
+            }
+            try:
+                await self.sc.executeLua(msg, COMPLETE_TIMEOUT, engine)
+            except Exception as ex:
+                self._send(data=[(str(ex) or "Timeout stopping watches", 'warning')])
+                status = 'error'
+        return self._send(data=[("Stopped {} watches".format(len(numbers)), 'state-info')], status=status)
+
+    async def _timeit(self, engines, options, code):
+        """
+        Time the code in Spring, the loops are run and timed in the Lua
+        state itself
+        """
+        state = options.state or self.state
+        self.logger.info("Got Lua to time: {}".format(shorten(code)))
+        self._completions.clear()
+        msg = {
+            'command' : 'timeit',
+            'data' : {
+                'code' : code,
+                'state' : state,
+                'number' : options.number,
+                'repeat' : options.repeat,
+                'memory' : options.memory,
             },
         }
-        self.logger.info("Got Lua to execute: {}".format(code))
         try:
-            results = self.sc.executeLua(msg)
-            self.logger.info("Got results: {}".format(results))
-            data = [(exec_state, 'state-info')]
-            data.extend(results)
-            self.logger.info("Got results: {}".format(data))
+            results = await self._request(msg, engines)
+        except asyncio.CancelledError:
             return self._send(
-                data=data,
-                status='ok')
+                data=[("Timing interrupted, Spring may still finish running the cell", 'warning')],
+                status='error')
         except Exception as ex:
-            template = "Exception of type {0} occurred. Arguments:\n{1!r}"
-            message = template.format(type(ex).__name__, ex.args)
-            self.logger.warning("message")
+            return self._send(data=[(str(ex), 'warning')], status='error')
+        status = 'ok'
+        data = [(magics["%" + state][0], 'state-info')]
+        for engine, result in results:
+            if engine is not None:
+                data.append((engine, 'engine-info'))
+            if isinstance(result, Exception):
+                data.append((str(result) or "Timeout timing the cell", 'warning'))
+                status = 'error'
+                continue
+            result = dict(result)
+            if result.get('error') or not result.get('times'):
+                data.append((result.get('error') or "Spring can't time cells", 'error'))
+                status = 'error'
+                continue
+            data.extend((line, 'output') for line in timeit_lines(result))
+        return self._send(data=data, status=status)
+
+    async def _profile(self, engines, options, code):
+        """
+        Profile the code of the cell, or whatever runs in the state during
+        a number of frames. Stacks are sampled and aggregated in Spring,
+        only the sample counts of each stack are sent back.
+        """
+        state = options.state or self.state
+        if engines != [] and all(self.state_lacks(engine, state, 'debug') for engine in (engines or [None])):
+            return self._send(data=[("Cannot profile in {}, it has no debug library".format(
+                magics["%" + state][0]), 'error')], status='error')
+        frames = None if code.strip() else (options.frames or 30)
+        if frames is None:
+            self.logger.info("Got Lua to profile: {}".format(shorten(code)))
+            self._completions.clear()
+        msg = {
+            'command' : 'profile',
+            'data' : {
+                'code' : code,
+                'state' : state,
+                'frames' : frames,
+                'interval' : options.interval,
+            },
+        }
+        try:
+            # Frames pass at 10 per second at the very least
+            results = await self._request(msg, engines, timeout=TIMEOUT + (frames or 0) / 10)
+        except asyncio.CancelledError:
             return self._send(
-                data=[("Timeout executing task", 'warning')],
+                data=[("Profiling interrupted, Spring may still finish the profile", 'warning')],
                 status='error')
+        except Exception as ex:
+            return self._send(data=[(str(ex), 'warning')], status='error')
+        status = 'ok'
+        self._send(data=[(magics["%" + state][0], 'state-info')])
+        for engine, result in results:
+            data = []
+            if engine is not None:
+                data.append((engine, 'engine-info'))
+            if isinstance(result, Exception):
+                data.append((str(result) or "Timeout profiling", 'warning'))
+                status = 'error'
+                self._send(data=data)
+                continue
+            result = dict(result)
+            if 'samples' not in result:
+                data.append((result.get('error') or "Spring can't profile", 'error'))
+                status = 'error'
+                self._send(data=data)
+                continue
+            if result.get('error'):
+                data.append((result['error'], 'error'))
+                status = 'error'
+            # Empty tables are sent as lists
+            stacks = result.get('stacks') or {}
+            description = '{} samples every {} instructions in {:.1f} ms'.format(
+                result['samples'], result.get('interval'), result.get('duration') or 0)
+            if result.get('frames'):
+                description += ' over {} frames'.format(result['frames'])
+            data.append((description, 'state-info'))
+            self._send(data=data)
+            if not stacks:
+                continue
+            if options.output == 'flame':
+                display = {'image/svg+xml' : flame_graph(stacks)}
+            else:
+                display = {'text/html' : profile_table(stacks, options.sort)}
+            display['text/plain'] = folded_text(stacks)
+            self.send_response(self.iopub_socket, 'display_data', {'data' : display, 'metadata' : {}})
+        return self._send(data=None, status=status)
 
-        if not silent:
-            stream_content = {'name': 'stdout', 'text': "user_expressions: {}".format(user_expressions)}
-            self.send_response(self.iopub_socket, 'stream', stream_content)
+    async def _callins(self, engines, options):
+        """
+        Measure how long the call-ins of each addon of a state take, over a
+        number of frames
+        """
+        state = options.state or self.state
+        msg = {
+            'command' : 'callins',
+            'data' : {
+                'state' : state,
+                'frames' : options.frames,
+            },
+        }
+        try:
+            # Frames pass at 10 per second at the very least
+            results = await self._request(msg, engines, timeout=TIMEOUT + options.frames / 10)
+        except asyncio.CancelledError:
+            return self._send(
+                data=[("Interrupted, the call-ins are restored once the frames have passed", 'warning')],
+                status='error')
+        except Exception as ex:
+            return self._send(data=[(str(ex), 'warning')], status='error')
+        status = 'ok'
+        self._send(data=[(magics["%" + state][0], 'state-info')])
+        for engine, result in results:
+            data = []
+            if engine is not None:
+                data.append((engine, 'engine-info'))
+            if not isinstance(result, Exception):
+                result = dict(result)
+            if isinstance(result, Exception) or 'rows' not in result:
+                data.append(((str(result) if isinstance(result, Exception) else result.get('error'))
+                             or "Spring can't monitor call-ins", 'warning'))
+                status = 'error'
+                self._send(data=data)
+                continue
+            data.append(("{} call-ins over {} frames, timed with {}".format(
+                len(result['rows']), result['frames'], result.get('clock')), 'state-info'))
+            self._send(data=data)
+            if result['rows']:
+                table, text = callin_table(result['rows'], result['frames'], options.sort, options.rows)
+                self.send_response(self.iopub_socket, 'display_data', {
+                    'data' : {'text/html' : table, 'text/plain' : text},
+                    'metadata' : {},
+                })
+        return self._send(data=None, status=status)
 
-        return {'status': 'ok',
-                # The base class increments the execution count
-                'execution_count': self.execution_count,
-                'payload': [],
-                'user_expressions': {},
-               }
+    async def do_complete(self, code, cursor_pos):
+        """
+        Complete the field name in front of the cursor, in the state the
+        cell will be executed in. The fields of each table are only listed
+        by Spring once, later completions are looked up in the cache.
+        """
+        path, prefix = completion_path(code[:cursor_pos])
+        reply = {
+            'matches' : [],
+            'cursor_start' : cursor_pos - len(prefix),
+            'cursor_end' : cursor_pos,
+            'metadata' : {},
+            'status' : 'ok',
+        }
+        engines = self.targets(None)
+        engine = engines[0] if engines else next(iter(self.sc.engineNames()), None)
+        try:
+            keys = await self._completion_keys(engine, self.cell_state(code), path)
+        except Exception as ex:
+            self.logger.warning("Autocomplete failed: {}".format(ex))
+            return reply
+        # The keys are sorted, so the matches are a contiguous range
+        start = bisect.bisect_left(keys, prefix)
+        end = start
+        while end < len(keys) and keys[end].startswith(prefix):
+            end += 1
+        reply['matches'] = keys[start:end]
+        return reply
+
+    async def _completion_keys(self, engine, state, path):
+        """
+        Return the sorted field names of the table at path in a state of an
+        engine, from the cache or else listed by Spring
+        """
+        generation, cache = self._completions.get((engine, state), (None, {}))
+        if path in cache:
+            return cache[path]
+        msg = {
+            'command' : 'autocomplete',
+            'data' : {
+                'path' : list(path),
+                'state' : state,
+            },
+        }
+        result = dict(await self.sc.executeLua(msg, COMPLETE_TIMEOUT, engine))
+        # Cells were run in the state by someone else since the cache was filled
+        if result.get('generation') != generation:
+            cache = {}
+            self._completions[(engine, state)] = (result.get('generation'), cache)
+        cache[path] = sorted(result.get('keys') or [])
+        return cache[path]
+
+    async def do_inspect(self, code, cursor_pos, detail_level=0, omit_sections=()):
+        """
+        Show the value or source of the name under the cursor. Function
+        sources are remembered by function identity, so Spring only sends
+        the source of each function once.
+        """
+        end = cursor_pos + re.match(r'\w*', code[cursor_pos:]).end()
+        path, name = completion_path(code[:end])
+        reply = {
+            'status' : 'ok',
+            'found' : False,
+            'data' : {},
+            'metadata' : {},
+        }
+        if not name:
+            return reply
+        engines = self.targets(None)
+        engine = engines[0] if engines else next(iter(self.sc.engineNames()), None)
+        state = self.cell_state(code)
+        inspected = self._inspected.setdefault((engine, state), collections.OrderedDict())
+        msg = {
+            'command' : 'inspect',
+            'data' : {
+                'path' : list(path + (name,)),
+                'state' : state,
+                'known' : list(inspected),
+            },
+        }
+        try:
+            result = dict(await self.sc.executeLua(msg, COMPLETE_TIMEOUT, engine))
+        except Exception as ex:
+            self.logger.warning("Inspect failed: {}".format(ex))
+            return reply
+        if not result.get('found'):
+            return reply
+        if result.get('type') == 'function':
+            key = result['id']
+            if key in inspected:
+                inspected.move_to_end(key)
+            else:
+                inspected[key] = (result.get('location'), result.get('source', ''))
+                if len(inspected) > MAX_INSPECTED:
+                    inspected.popitem(last=False)
+            location, source = inspected[key]
+            text = 'function {}'.format(name)
+            if location:
+                text += '\n' + location
+            lines = source.splitlines()
+            if detail_level == 0 and len(lines) > INSPECT_PREVIEW_LINES:
+                lines = lines[:INSPECT_PREVIEW_LINES] + ['...']
+            text += '\n\n' + '\n'.join(lines)
+        else:
+            text = '{} {}\n\n{}'.format(result.get('type'), name, result.get('value'))
+        reply['found'] = True
+        reply['data'] = {'text/plain' : text}
+        return reply
 
     def _send(self, data, status='ok', silent=False):
         """
@@ -197,7 +1541,7 @@ class SpringRTSKernel(Kernel):
         # Data to send back
         if data is not None and not silent:
             # Format the data
-            data = data_msg(data)
+            data = data_msg(data, self.htmlLimit)
             # Send the data to the frontend
             self.send_response(self.iopub_socket, 'display_data', data)
 
@@ -0,0 +1,175 @@
+"""
+Rendering profiles taken with %profile and call-in costs measured with
+%callins
+
+Spring sends profiles as folded stacks: a map from the frames of a stack,
+outermost first and separated by semicolons, to how many samples were
+taken in it.
+"""
+from __future__ import absolute_import, division, print_function
+
+import html
+import zlib
+
+# Size of the flame graph in pixels
+FLAME_WIDTH = 1200
+FLAME_ROW_HEIGHT = 16
+# Frames narrower than this many pixels aren't drawn
+FLAME_MIN_WIDTH = 0.3
+# Rows shown in the table of functions
+TABLE_ROWS = 50
+
+
+def folded_text(stacks):
+    """
+    Return the stacks in the text format of flamegraph.pl and similar tools
+    """
+    return '\n'.join('{} {}'.format(stack, count)
+                     for stack, count in sorted(stacks.items(), key=lambda item: -item[1]))
+
+
+def stack_tree(stacks):
+    """
+    Merge folded stacks into a tree of [samples, {frame : child}] nodes
+    """
+    root = [0, {}]
+    for stack, count in stacks.items():
+        root[0] += count
+        node = root
+        for frame in stack.split(';'):
+            node = node[1].setdefault(frame, [0, {}])
+            node[0] += count
+    return root
+
+
+def _color(frame):
+    # Warm colors that stay the same for a function across profiles
+    h = zlib.crc32(frame.encode('utf-8'))
+    return 'rgb({},{},{})'.format(205 + h % 50, 80 + (h >> 8) % 150, (h >> 16) % 55)
+
+
+def flame_graph(stacks, width=FLAME_WIDTH, row_height=FLAME_ROW_HEIGHT):
+    """
+    Return an SVG flame graph of folded stacks, hovering a frame shows its
+    function and share of the samples
+    """
+    root = stack_tree(stacks)
+    total = root[0] or 1
+    scale = width / total
+    rects = []
+    depth = [0]
+
+    def draw(children, x, level):
+        for frame, (count, grandchildren) in sorted(children.items()):
+            w = count * scale
+            if w >= FLAME_MIN_WIDTH:
+                rects.append((frame, count, x, level, w))
+                depth[0] = max(depth[0], level + 1)
+                draw(grandchildren, x, level + 1)
+            x += w
+
+    draw(root[1], 0, 0)
+    height = depth[0] * row_height
+    parts = ['<svg xmlns="http://www.w3.org/2000/svg" width="{}" height="{}" '
+             'font-family="monospace" font-size="{}">'.format(width, height, row_height - 5)]
+    for frame, count, x, level, w in rects:
+        # Callers are drawn under their callees
+        y = height - (level + 1) * row_height
+        label = html.escape(frame)
+        parts.append('<g><title>{} ({} samples, {:.1f}%)</title>'
+                     '<rect x="{:.2f}" y="{}" width="{:.2f}" height="{}" fill="{}" stroke="white" stroke-width="0.5"/>'
+                     .format(label, count, 100 * count / total, x, y, w, row_height - 1, _color(frame)))
+        chars = int((w - 4) // ((row_height - 5) * 0.6))
+        if chars >= 3:
+            text = frame if len(frame) <= chars else frame[:chars - 2] + '..'
+            parts.append('<text x="{:.2f}" y="{}">{}</text>'.format(
+                x + 2, y + row_height - 5, html.escape(text)))
+        parts.append('</g>')
+    parts.append('</svg>')
+    return ''.join(parts)
+
+
+def function_samples(stacks):
+    """
+    Return the samples taken in each function itself and in total, with
+    the functions it called, as {frame : [self, total]}
+    """
+    functions = {}
+    for stack, count in stacks.items():
+        frames = stack.split(';')
+        for frame in set(frames):
+            functions.setdefault(frame, [0, 0])[1] += count
+        functions[frames[-1]][0] += count
+    return functions
+
+
+def profile_table(stacks, sort='self', rows=TABLE_ROWS):
+    """
+    Return an HTML table of the functions that took the most samples,
+    sorted by their own samples or by their total
+    """
+    functions = function_samples(stacks)
+    total = sum(stacks.values()) or 1
+    column = 0 if sort == 'self' else 1
+    ranked = sorted(functions.items(), key=lambda item: -item[1][column])
+    lines = ['<table><tr><th style="text-align:left">function</th>'
+             '<th>self</th><th>self %</th><th>total</th><th>total %</th></tr>']
+    for frame, (own, count) in ranked[:rows]:
+        lines.append('<tr><td style="text-align:left">{}</td><td>{}</td><td>{:.1f}</td>'
+                     '<td>{}</td><td>{:.1f}</td></tr>'.format(
+                         html.escape(frame), own, 100 * own / total, count, 100 * count / total))
+    lines.append('</table>')
+    if len(ranked) > rows:
+        lines.append('<div>{} more functions</div>'.format(len(ranked) - rows))
+    return ''.join(lines)
+
+
+# Columns of the call-in table: header, format and sort key of a row
+CALLIN_COLUMNS = (
+    ('addon', '{}', None),
+    ('call-in', '{}', None),
+    ('calls', '{}', 'calls'),
+    ('total ms', '{:.2f}', 'total'),
+    ('ms per frame', '{:.3f}', None),
+    ('mean ms', '{:.3f}', 'mean'),
+    ('max ms', '{:.3f}', 'max'),
+)
+
+
+def callin_rows(rows, frames, sort='total'):
+    """
+    Return the rows sent by Spring, (addon, call-in, calls, total ms,
+    max ms), as (addon, call-in, calls, total, per frame, mean, max) rows
+    sorted by one of calls, total, mean or max, largest first
+    """
+    rows = [(addon, callin, calls, total, total / frames, total / calls, longest)
+            for addon, callin, calls, total, longest in rows]
+    column = [key for _, _, key in CALLIN_COLUMNS].index(sort)
+    return sorted(rows, key=lambda row: -row[column])
+
+
+def callin_table(rows, frames, sort='total', limit=TABLE_ROWS):
+    """
+    Return an HTML table and a text table of the costliest call-ins
+    """
+    rows = callin_rows(rows, frames, sort)
+    shown = rows[:limit]
+    formats = [fmt for _, fmt, _ in CALLIN_COLUMNS]
+    lines = ['<table><tr>' + ''.join(
+        '<th style="text-align:left">{}</th>'.format(header) if i < 2 else '<th>{}</th>'.format(header)
+        for i, (header, _, _) in enumerate(CALLIN_COLUMNS)) + '</tr>']
+    for row in shown:
+        lines.append('<tr>' + ''.join(
+            '<td style="text-align:left">{}</td>'.format(html.escape(fmt.format(value))) if i < 2
+            else '<td>{}</td>'.format(fmt.format(value))
+            for i, (fmt, value) in enumerate(zip(formats, row))) + '</tr>')
+    lines.append('</table>')
+    if len(rows) > limit:
+        lines.append('<div>{} more call-ins</div>'.format(len(rows) - limit))
+    cells = [[header for header, _, _ in CALLIN_COLUMNS]]
+    cells.extend([fmt.format(value) for fmt, value in zip(formats, row)] for row in shown)
+    widths = [max(len(row[i]) for row in cells) for i in range(len(CALLIN_COLUMNS))]
+    text = '\n'.join('  '.join(cell.ljust(width) if i < 2 else cell.rjust(width)
+                                for i, (cell, width) in enumerate(zip(row, widths)))
+                      for row in cells)
+    return ''.join(lines), text
@@ -0,0 +1,93 @@
+"""
+Wire protocol used between the kernel and the Spring widget
+
+Every message is sent as a frame: a 4 byte big-endian unsigned length
+followed by that many bytes of payload.
+"""
+from __future__ import absolute_import, division, print_function
+
+import struct
+
+# Frame header: payload length as an unsigned 32 bit big-endian integer
+HEADER = struct.Struct('>I')
+
+# Refuse frames larger than this, they can only come from a corrupt stream
+MAX_FRAME_SIZE = 512 * 1024 * 1024
+
+# Size of the reusable chunk used to read from the socket
+RECV_CHUNK_SIZE = 256 * 1024
+
+# Consumed bytes are only discarded from the front of the buffer once there
+# are at least this many of them
+COMPACT_THRESHOLD = 1024 * 1024
+
+
+class ProtocolError(Exception):
+    """
+    The byte stream doesn't contain valid frames
+    """
+
+
+def encode_frame(payload):
+    """
+    Return the frame header for the payload followed by the payload itself
+      @param payload (bytes): the message to send
+    """
+    return HEADER.pack(len(payload)) + payload
+
+
+class FrameDecoder(object):
+    """
+    Incrementally reassemble frames from a byte stream.
+
+    Received data is appended to a single growable buffer and consumed frames
+    are discarded from its front, so large messages arriving in many pieces
+    are neither truncated nor re-copied on every read.
+    """
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.buffer = bytearray()
+        self.start = 0
+        self.max_frame_size = max_frame_size
+
+    def feed(self, data):
+        """
+        Add received bytes to the buffer
+          @param data (bytes-like): the received data
+        """
+        self.buffer += data
+
+    def next_frame(self):
+        """
+        Return the payload of the next complete frame, or None if the buffer
+        doesn't hold a whole frame yet
+        """
+        available = len(self.buffer) - self.start
+        if available < HEADER.size:
+            return None
+        size, = HEADER.unpack_from(self.buffer, self.start)
+        if size > self.max_frame_size:
+            raise ProtocolError("Frame of {} bytes exceeds the limit of {} bytes".format(
+                size, self.max_frame_size))
+        if available < HEADER.size + size:
+            return None
+        begin = self.start + HEADER.size
+        payload = bytes(self.buffer[begin:begin + size])
+        self.start = begin + size
+        if self.start == len(self.buffer):
+            del self.buffer[:]
+            self.start = 0
+        elif self.start >= COMPACT_THRESHOLD:
+            del self.buffer[:self.start]
+            self.start = 0
+        return payload
+
+    def frames(self):
+        """
+        Iterate over all complete frames currently in the buffer
+        """
+        while True:
+            payload = self.next_frame()
+            if payload is None:
+                return
+            yield payload
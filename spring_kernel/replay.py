@@ -0,0 +1,306 @@
+"""
+Play back traffic captured by SpringConnector, see capture.py
+
+    python -m spring_kernel.replay engine session.skcap [--max-speed]
+    python -m spring_kernel.replay kernel session.skcap [--max-speed]
+
+In engine mode the captured engines are replayed: the captured requests go
+through a SpringConnector in this process to replay engines, which answer
+with the captured events and replies, so a heavy session becomes a
+repeatable load for the connector, the codecs and the rendering of output.
+
+In kernel mode the kernel is replayed: like the kernel, it waits for Spring
+(or the fake engine) to connect and sends it the captured requests, to see
+how the engine answers them now.
+
+Requests are sent at their captured times, or with --max-speed as soon as
+every request answered before them in the capture is answered again, so
+the replay keeps the order of the session. The latency of each command is
+compared with the capture, along with the throughput of the whole replay.
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import time
+
+from . import codec
+from .capture import load_session, MESSAGE, REQUEST
+from .protocol import encode_frame, FrameDecoder, RECV_CHUNK_SIZE
+from .spring_connector import SpringConnector, SpringError, PORT, TIMEOUT
+from .utils import data_msg
+
+
+# Seconds the event loop can't reliably sleep less than
+SLEEP_RESOLUTION = 0.001
+
+
+class ByteCounter(object):
+    """
+    Stands in for the connector's capture writer, counting the bytes Spring sends
+    """
+
+    def __init__(self):
+        self.received = 0
+
+    def record(self, t, kind, connection, payload):
+        if kind != REQUEST:
+            self.received += len(payload)
+
+
+def with_id(payload, msgId):
+    """
+    Re-encode a captured message with the id of the replayed request
+    """
+    msg = codec.decode_message(payload)
+    msg['id'] = msgId
+    if codec.is_msgpack(payload):
+        return codec.pack(msg)
+    return json.dumps(msg).encode('utf-8')
+
+
+class ReplayEngine(object):
+    """
+    Answers replayed requests with the frames captured for them, after the
+    captured delays unless replaying at maximum speed
+    """
+
+    def __init__(self, host, port, hello, maxSpeed):
+        self.host = host
+        self.port = port
+        self.hello = hello
+        self.maxSpeed = maxSpeed
+        # Captured requests by the id they are sent with, with their frames
+        self.requests = {}
+        self.reader = None
+        self.writer = None
+
+    def expect(self, msgId, request):
+        self.requests[msgId] = (request, [(t, kind, with_id(payload, msgId) if kind == MESSAGE else payload)
+                                          for t, kind, payload in request.frames])
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.writer.write(encode_frame(self.hello))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    async def run(self):
+        decoder = FrameDecoder()
+        while True:
+            data = await self.reader.read(RECV_CHUNK_SIZE)
+            if not data:
+                return
+            decoder.feed(data)
+            for payload in decoder.frames():
+                msg = json.loads(payload.decode('utf-8'))
+                if msg.get('id') in self.requests:
+                    asyncio.ensure_future(self.answer(*self.requests.pop(msg['id'])))
+
+    async def answer(self, request, frames):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        for t, _, payload in frames:
+            delay = t - request.sent - (loop.time() - start)
+            # Waits shorter than the event loop can time are left out
+            if not self.maxSpeed and delay > SLEEP_RESOLUTION:
+                await asyncio.sleep(delay)
+            self.writer.write(encode_frame(payload))
+        await self.writer.drain()
+
+
+async def replay(connector, requests, engineFor, maxSpeed, engines=None):
+    """
+    Send the captured requests through the connector and return the latency
+    of each answered one by request, the time rendering execute replies
+    took and the duration of the replay
+      @param engineFor (callable): the engine name to send a request to
+      @param engines (dict): replay engines by name, told which request
+        comes with which id before it's sent
+    """
+    loop = asyncio.get_running_loop()
+    latencies = {}
+    answered = {request : loop.create_future() for request in requests}
+    rendering = [0.0]
+    # The connector gives out ids in the order requests are sent, so the
+    # replay engines can be told them in advance
+    connector.ids = itertools.count(1)
+    ids = itertools.count(1)
+
+    async def issue(request):
+        msg = {'command' : request.command, 'data' : request.msg.get('data')}
+        engine = engineFor(request)
+        if engines is not None:
+            engines[engine].expect(next(ids), request)
+        timeout = TIMEOUT + 2 * (request.latency or 0)
+        sent = loop.time()
+        try:
+            result = await connector.executeLua(msg, timeout, engine)
+        except SpringError:
+            return
+        finally:
+            answered[request].set_result(None)
+        latencies[request] = loop.time() - sent
+        if request.command == 'execute' and isinstance(result, list):
+            start = time.perf_counter()
+            data_msg([tuple(entry) for entry in result])
+            rendering[0] += time.perf_counter() - start
+
+    byReply = sorted((request for request in requests if request.replied is not None),
+                     key=lambda request: request.replied)
+    waited = 0
+    tasks = []
+    start = loop.time()
+    first = requests[0].sent
+    for request in requests:
+        if maxSpeed:
+            while waited < len(byReply) and byReply[waited].replied <= request.sent:
+                await answered[byReply[waited]]
+                waited += 1
+        else:
+            await asyncio.sleep(max(0, request.sent - first - (loop.time() - start)))
+        tasks.append(asyncio.ensure_future(issue(request)))
+    # Requests never answered in the capture, like running watches, aren't waited for
+    await asyncio.gather(*[task for task, request in zip(tasks, requests) if request.replied is not None])
+    duration = loop.time() - start
+    for task in tasks:
+        task.cancel()
+    return latencies, rendering[0], duration
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def _delta(before, after):
+    return '{:+.0f}%'.format(100 * (after - before) / before) if before else ''
+
+
+def report(requests, latencies, rendering, duration, received):
+    """
+    Print the latency of each command in the capture and in the replay, and
+    the throughput of both
+    """
+    print('{:<14} {:>6} {:>11} {:>11} {:>7} {:>11} {:>11} {:>7}'.format(
+        'command', 'count', 'p50 ms', 'replay p50', 'delta', 'p90 ms', 'replay p90', 'delta'))
+    byCommand = collections.OrderedDict()
+    for request in requests:
+        if request.latency is not None and request in latencies:
+            byCommand.setdefault(request.command, []).append(request)
+    for command, answered in byCommand.items():
+        captured = [request.latency * 1000 for request in answered]
+        replayed = [latencies[request] * 1000 for request in answered]
+        row = []
+        for fraction in (0.5, 0.9):
+            before, after = _percentile(captured, fraction), _percentile(replayed, fraction)
+            row.extend([before, after, _delta(before, after)])
+        print('{:<14} {:>6} {:>11.2f} {:>11.2f} {:>7} {:>11.2f} {:>11.2f} {:>7}'.format(
+            command, len(answered), *row))
+    lost = sum(1 for request in requests if request.replied is not None and request not in latencies)
+    if lost:
+        print('{} requests answered in the capture were not answered in the replay'.format(lost))
+    capturedDuration = max(request.replied or request.sent for request in requests) - requests[0].sent
+    capturedBytes = sum(request.received() for request in requests)
+    print()
+    print('{:<10} {:>10} {:>12} {:>10} {:>12}'.format('', 'seconds', 'requests/s', 'MB', 'MB/s'))
+    for name, seconds, size in (('capture', capturedDuration, capturedBytes), ('replay', duration, received)):
+        print('{:<10} {:>10.2f} {:>12.1f} {:>10.2f} {:>12.2f}'.format(
+            name, seconds, len(requests) / seconds if seconds else 0, size / 1e6,
+            size / 1e6 / seconds if seconds else 0))
+    print('Rendering execute replies took {:.1f} ms'.format(1000 * rendering))
+
+
+async def replay_engine(hellos, requests, maxSpeed):
+    counter = ByteCounter()
+    connector = SpringConnector('127.0.0.1', 0, capture=None)
+    connector.capture = counter
+    await connector.start()
+    engines = {}
+    names = {}
+    try:
+        for connection in sorted(set(request.connection for request in requests)):
+            hello = hellos.get(connection) or json.dumps(
+                {'event' : 'hello', 'data' : {'name' : 'replay-{}'.format(connection)}}).encode('utf-8')
+            engine = ReplayEngine('127.0.0.1', connector.port, hello, maxSpeed)
+            known = set(connector.engineNames())
+            await engine.connect()
+            asyncio.ensure_future(engine.run())
+            while set(connector.engineNames()) == known:
+                await asyncio.sleep(0.01)
+            name, = set(connector.engineNames()) - known
+            engines[name] = engine
+            names[connection] = name
+        counter.received = 0
+        latencies, rendering, duration = await replay(
+            connector, requests, lambda request: names[request.connection], maxSpeed, engines)
+    finally:
+        for engine in engines.values():
+            engine.close()
+        connector.server.close()
+    report(requests, latencies, rendering, duration, counter.received)
+
+
+async def replay_kernel(hellos, requests, maxSpeed, host, port, wait):
+    counter = ByteCounter()
+    connector = SpringConnector(host, port, capture=None)
+    connector.capture = counter
+    await connector.start()
+    connections = sorted(set(request.connection for request in requests))
+    wanted = {}
+    for connection in connections:
+        try:
+            wanted[connection] = codec.decode_message(hellos[connection])['data']['name']
+        except (KeyError, TypeError, ValueError):
+            wanted[connection] = None
+    try:
+        print('Waiting for {} engines on port {}'.format(len(connections), connector.port))
+        deadline = time.perf_counter() + wait
+        while len(connector.engineNames()) < len(connections) and time.perf_counter() < deadline:
+            await asyncio.sleep(0.1)
+        if not connector.engineNames():
+            print('No engine connected')
+            return
+
+        def engineFor(request):
+            # The engine of the same name when it's there, else the first one
+            name = wanted.get(request.connection)
+            return name if name in connector.engines else None
+
+        counter.received = 0
+        latencies, rendering, duration = await replay(connector, requests, engineFor, maxSpeed)
+    finally:
+        connector.server.close()
+    report(requests, latencies, rendering, duration, counter.received)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m spring_kernel.replay',
+                                     description='Play back traffic captured between the kernel and Spring')
+    parser.add_argument('mode', choices=['engine', 'kernel'],
+                        help='replay the engines to an in-process connector, or the kernel to running engines')
+    parser.add_argument('capture', help='capture file written by the kernel')
+    parser.add_argument('--max-speed', action='store_true',
+                        help="don't wait for the captured times, only for the requests answered before")
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on in kernel mode')
+    parser.add_argument('--port', type=int, default=PORT, help='port to listen on in kernel mode')
+    parser.add_argument('-w', '--wait', type=float, default=60,
+                        help='seconds to wait for the engines to connect in kernel mode')
+    args = parser.parse_args()
+    hellos, requests = load_session(args.capture)
+    if not requests:
+        parser.exit(1, 'No requests in {}\n'.format(args.capture))
+    if args.mode == 'engine':
+        asyncio.run(replay_engine(hellos, requests, args.max_speed))
+    else:
+        asyncio.run(replay_kernel(hellos, requests, args.max_speed, args.host, args.port, args.wait))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,16 @@
-from __future__ import print_function
-import socket
+import asyncio
+import functools
+import itertools
 import json
-import os
 import logging
-import threading
-import Queue
+import os
+import random
+import struct
+import time
+
+from .capture import CaptureWriter, REQUEST, MESSAGE, BLOB
+from .codec import choose_codec, decode_message
+from .protocol import encode_frame, FrameDecoder, RECV_CHUNK_SIZE
 
 CONFIG_FILE = "kernel-config.json"
 CONFIG_FILE_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), CONFIG_FILE)
@@ -12,67 +18,295 @@ config = json.load(open(CONFIG_FILE_PATH, "r"))
 
 HOST = config["host"]              # Symbolic name meaning all available interfaces
 PORT = config["port"]              # Arbitrary non-privileged port
+# File the traffic with Spring is appended to, see capture.py. Off unless set
+# in the config or the environment.
+CAPTURE = os.environ.get("SPRING_KERNEL_CAPTURE") or config.get("capture")
+
+# Seconds to wait for Spring to answer a request
+TIMEOUT = 60
+# Request ids of a kernel start at a random multiple of this, so a reply Spring sends after its
+# kernel is gone can't be taken for the answer to a request of the next one. Ids stay below 2^40,
+# which Spring's JSON encoder writes exactly.
+SESSION_IDS = 1 << 20
+
+
+class SpringError(Exception):
+    """
+    A request couldn't be completed by Spring
+    """
+
+
+class SpringProtocol(asyncio.BufferedProtocol):
+    """
+    A single connection from Spring. Data is read straight into a reusable
+    chunk and reassembled into frames, which are handed to the connector.
+    """
+
+    def __init__(self, connector):
+        self.connector = connector
+        self.logger = connector.logger
+        self.transport = None
+        # Identifies the connection in captures
+        self.number = next(connector.connectionNumbers)
+        # Reported by Spring in its hello message
+        self.name = None
+        # The rest of the hello message: engine version, write directory,
+        # capabilities and the Lua states by name, see SpringConnector.engineInfo
+        self.info = {}
+        self.connectedAt = None
+        # Codec Spring was told to encode its messages with
+        self.codec = 'json'
+        # Message still waiting for its binary blobs, with their count
+        self.partial = None
+        # Seconds spent decoding the last message
+        self.decodeTime = 0
+        self.chunk = bytearray(RECV_CHUNK_SIZE)
+        self.decoder = FrameDecoder()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.logger.info('Connected by {}'.format(transport.get_extra_info('peername')))
 
-class SpringConnector(threading.Thread):
-    def executeLua(self, msg):
-        self.logger.info('Asked to execute code')
-        # Add the task
-        self.tasks.put(msg)
-        self.logger.info('Waiting on results')
-        # Wait until results are ready
-        return self.results.get(True, 60)
-
-    def _handleTasks(self):
-        self.logger.info('Waiting on code')
-        # Wait until there are tasks to do
-        task = self.tasks.get(True)
-        self.logger.info('Send code for execution')
-        jsonData = None
-        data = None
+    def get_buffer(self, sizehint):
+        return self.chunk
+
+    def buffer_updated(self, nbytes):
+        self.decoder.feed(memoryview(self.chunk)[:nbytes])
         try:
-            self.conn.sendall(json.dumps(task))
-            data = self.conn.recv(20971520)
-            jsonData = json.loads(data)
-            self.logger.info('Received data: {0}'.format(jsonData))
-        except ValueError as ex:
-            self.logger.error("Failed parsing spring data as json: {}".format(ex))
-            self.logger.error("data: {}\njsonData: {}".format(data, jsonData))
-            self.results.put({})
-            return
+            for payload in self.decoder.frames():
+                self.connector._handleFrame(self, payload)
         except Exception as ex:
-            template = "An exception of type {0} occurred. Arguments:\n{1!r}"
-            message = template.format(type(ex).__name__, ex.args)
-            self.logger.error(message)
-            self.results.put({})
-            raise ex
-        if not jsonData:
-            self.results.put({})
-            raise
-        else:
-            # Give the results back
-            self.results.put(jsonData)
+            self.logger.error('Dropping connection after invalid data: {}'.format(ex))
+            self.transport.close()
+
+    def connection_lost(self, exc):
+        self.logger.info('Connection closed')
+        self.connector._connectionLost(self)
+
+    def send(self, msg):
+        payload = json.dumps(msg).encode('utf-8')
+        if self.connector.capture is not None:
+            self.connector.capture.record(time.time(), REQUEST, self.number, payload)
+        self.transport.write(encode_frame(payload))
 
-    def run(self):
+
+class SpringConnector(object):
+    """
+    Server that Spring instances connect to, running on the kernel's event loop.
+
+    Each engine announces itself with a hello message carrying its name and
+    is kept in a registry under that name, so requests can target any of the
+    connected engines. The rest of the hello message, and the state messages
+    the LuaRules gadget sends once it's reached, describe the engine and are
+    kept for engineInfo.
+
+    Every request is tagged with an id which Spring copies into its reply, so
+    any number of requests can be in flight over each connection and their
+    replies can arrive in any order. Replies to requests nobody waits for
+    anymore (e.g. after a timeout or an interrupt) are dropped.
+    """
+
+    def __init__(self, host=HOST, port=PORT, capture=CAPTURE):
         self.logger = logging.getLogger(__name__)
+        self.host = host
+        self.port = port
+        self.server = None
+        self.connectionNumbers = itertools.count(1)
+        # Writer of the capture file, when traffic is captured
+        self.capture = None
+        if capture:
+            self.capture = CaptureWriter(capture)
+            self.logger.info('Capturing traffic to {}'.format(capture))
+        # Connected engines by name, in the order they connected
+        self.engines = {}
+        self.connected = None
+        self.pending = {}
+        self.ids = itertools.count(random.randrange(SESSION_IDS) * SESSION_IDS + 1)
 
+    async def start(self):
+        """
+        Start listening for Spring on the running event loop
+        """
         self.logger.info('Starting SpringConnector server')
+        self.connected = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        self.server = await loop.create_server(
+            lambda: SpringProtocol(self), self.host, self.port, reuse_address=True)
+        # The port actually listened on, when port 0 picked a free one
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    def engineNames(self):
+        """
+        Return the names of the connected engines, in connection order
+        """
+        return list(self.engines)
 
-        self.tasks = Queue.Queue(1)
-        self.results = Queue.Queue(1)
-
-        self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.s.bind((HOST, PORT))
-        self.s.listen(1)
-        while True:
-            self.conn, addr = self.s.accept()
-            self.logger.info('Connected by {}')
-            self.logger.info('Connected by {}'.format(addr))
-            while True:
-                try:
-                    self._handleTasks()
-                except Exception as e:
-                    self.logger.warning(e)
-                    break
-            self.conn.close()
-            self.logger.info('Connection closed')
+    def engineInfo(self, engine=None):
+        """
+        Return what an engine, by default the first connected one, announced
+        about itself: version, game, writeDir, capabilities, the Lua states
+        it reached by name (each with whether debug is available) and
+        connectedAt (time.time), or None if it isn't connected
+        """
+        if engine is None:
+            connection = next(iter(self.engines.values()), None)
+        else:
+            connection = self.engines.get(engine)
+        if connection is None:
+            return None
+        return dict(connection.info, name=connection.name, codec=connection.codec,
+                    connectedAt=connection.connectedAt)
+
+    async def _connection(self, engine, timeout):
+        if self.connected is None:
+            raise SpringError('SpringConnector is not started')
+        if engine is not None:
+            connection = self.engines.get(engine)
+            if connection is None:
+                raise SpringError('Engine {} is not connected'.format(engine))
+            return connection
+        try:
+            await asyncio.wait_for(self.connected.wait(), timeout)
+        except asyncio.TimeoutError:
+            raise SpringError('Spring is not connected')
+        return next(iter(self.engines.values()))
+
+    async def executeLua(self, msg, timeout=TIMEOUT, engine=None, onEvent=None, timing=None):
+        """
+        Send a request to Spring and wait for its reply
+          @param msg (dict): the request, with 'command' and 'data' fields
+          @param timeout (float): seconds to wait for the reply
+          @param engine (str): name of the engine to send to, by default the
+            first connected one
+          @param onEvent (callable): called with (event, data) for every
+            event Spring sends for the request before its reply, such as
+            streamed output
+          @param timing (dict): filled with when the request was queued,
+            sent and answered (time.perf_counter), how long decoding the
+            reply took and the durations of the stages Spring reported
+        Return the result of the reply.
+        """
+        if timing is not None:
+            timing['queued'] = time.perf_counter()
+        connection = await self._connection(engine, timeout)
+        msgId = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[msgId] = (future, connection, onEvent, timing)
+        try:
+            self.logger.info('Sending request {} to {}'.format(msgId, connection.name))
+            connection.send(dict(msg, id=msgId))
+            if timing is not None:
+                timing['sent'] = time.perf_counter()
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise SpringError('Timeout waiting for request {}'.format(msgId))
+        finally:
+            self.pending.pop(msgId, None)
+
+    async def executeMany(self, msg, engines, timeout=TIMEOUT, onEvent=None, timings=None):
+        """
+        Send the same request to several engines at once and wait for all
+        the replies
+          @param engines (list): names of the engines
+          @param onEvent (callable): called with (engine, event, data) for
+            every event sent for the request
+          @param timings (dict): filled with the timing of each engine's
+            request, by engine, see executeLua
+        Return a list of (engine, result) pairs, where result is the raised
+        exception if the engine didn't reply.
+        """
+        results = await asyncio.gather(
+            *[self.executeLua(msg, timeout, engine,
+                              onEvent and functools.partial(onEvent, engine),
+                              None if timings is None else timings.setdefault(engine, {}))
+              for engine in engines],
+            return_exceptions=True)
+        return list(zip(engines, results))
+
+    def _register(self, connection, hello):
+        # Engines that offer codecs are told which one to use
+        if 'codecs' in hello:
+            connection.codec = choose_codec(hello['codecs'])
+            connection.send({'event' : 'hello', 'data' : {'codec' : connection.codec}})
+        name = str(hello.get('name') or 'spring')
+        unique, suffix = name, 2
+        while unique in self.engines:
+            unique = '{}-{}'.format(name, suffix)
+            suffix += 1
+        connection.name = unique
+        connection.info = dict(hello, states=dict(hello.get('states') or {}))
+        connection.connectedAt = time.time()
+        self.engines[unique] = connection
+        self.connected.set()
+        self.logger.info('Engine {} connected, sending {}'.format(unique, connection.codec))
+
+    def _connectionLost(self, connection):
+        if self.engines.get(connection.name) is not connection:
+            return
+        del self.engines[connection.name]
+        if not self.engines:
+            self.connected.clear()
+        for future, owner, _, _ in self.pending.values():
+            if owner is connection and not future.done():
+                future.set_exception(SpringError('Connection to {} closed'.format(connection.name)))
+
+    def _handleFrame(self, connection, payload):
+        if self.capture is not None:
+            self.capture.record(time.time(), MESSAGE if connection.partial is None else BLOB,
+                                connection.number, payload)
+        if connection.partial is not None:
+            jsonData, count = connection.partial
+            jsonData['blobs'].append(payload)
+            if len(jsonData['blobs']) == count:
+                connection.partial = None
+                self._dispatch(connection, jsonData)
+            return
+        start = time.perf_counter()
+        try:
+            jsonData = decode_message(payload)
+            connection.decodeTime = time.perf_counter() - start
+        except (ValueError, IndexError, struct.error) as ex:
+            self.logger.error("Failed decoding spring data: {}".format(ex))
+            self.logger.error("data: {!r}... ({} bytes)".format(bytes(payload[:200]), len(payload)))
+            return
+        # A message can be followed by raw frames carrying binary data
+        count = jsonData.get('blobs')
+        if count:
+            jsonData['blobs'] = []
+            connection.partial = (jsonData, count)
+            return
+        self._dispatch(connection, jsonData)
+
+    def _dispatch(self, connection, jsonData):
+        if jsonData.get('event') == 'hello':
+            self._register(connection, jsonData.get('data') or {})
+            return
+        if jsonData.get('event') == 'state':
+            state = jsonData.get('data') or {}
+            connection.info.setdefault('states', {})[state.get('state')] = state
+            self.logger.info('Engine {} reached state {}'.format(connection.name, state.get('state')))
+            return
+        msgId = jsonData.get('id')
+        future, owner, onEvent, timing = self.pending.get(msgId, (None, None, None, None))
+        if future is None or future.done() or owner is not connection:
+            self.logger.warning('Dropping stale message for request {}'.format(msgId))
+            return
+        event = jsonData.get('event')
+        key = 'result' if event is None else 'data'
+        value = jsonData.get(key)
+        # Binary blobs are handed over with the result or event data
+        if 'blobs' in jsonData and isinstance(value, dict):
+            value['blobs'] = jsonData['blobs']
+        if event == 'timing':
+            if timing is not None:
+                timing['engine'] = value
+            return
+        if event is not None:
+            if onEvent is not None:
+                onEvent(event, value)
+            return
+        if timing is not None:
+            timing['received'] = time.perf_counter()
+            timing['decode'] = connection.decodeTime
+        self.logger.info('Received reply to request {}'.format(msgId))
+        future.set_result(value)
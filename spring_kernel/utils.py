@@ -3,8 +3,14 @@ Miscellaneous utility functions
 """
 from __future__ import absolute_import, division, print_function
 
+import io
 import logging
 
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
 # A logger for this file
 LOG = None
 
@@ -16,10 +22,23 @@ classMapping = {
     'warning' : 'bg-warning',
     'help'  : 'bg-info',
     'state-info' : 'text-muted',
+    'engine-info' : 'text-info',
 # <div class="output"> gets converted to <pre>
 }
 
 
+# Output longer than this many characters is only sent as plain text, 0 for no limit
+HTML_LIMIT = 256 * 1024
+
+
+# Mimetypes of the image formats %show can produce
+IMAGE_MIMETYPES = {
+    'png' : 'image/png',
+    'jpg' : 'image/jpeg',
+    'webp' : 'image/webp',
+}
+
+
 # ----------------------------------------------------------------
 
 def getLogger():
@@ -43,6 +62,26 @@ def is_collection(v):
 
 
 
+# ----------------------------------------------------------------------
+
+def convert_image(data, fmt, quality=None):
+    """
+    Re-encode image data in another format. Needs Pillow.
+      @param data (bytes): the encoded image
+      @param fmt (str): target format, one of IMAGE_MIMETYPES
+      @param quality (int): encoder quality for lossy formats
+    """
+    if Image is None:
+        raise RuntimeError('Converting images to {} requires Pillow (pip install pillow)'.format(fmt))
+    image = Image.open(io.BytesIO(data))
+    if fmt == 'jpg' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    options = {} if quality is None else {'quality' : quality}
+    out = io.BytesIO()
+    image.save(out, format={'jpg' : 'JPEG'}.get(fmt, fmt.upper()), **options)
+    return out.getvalue()
+
+
 # ----------------------------------------------------------------------
 
 def escape( x, lb=False ):
@@ -88,10 +127,243 @@ def div( txt, *args, **kwargs ):
     return (u'<' + tag + ' class="{}">{!s}</' + tag + '>').format( css, txt )
 
 
-def data_msg(msglist):
+# ----------------------------------------------------------------------
+
+def _scalar_text(node):
+    """
+    Text of a non-table node, as Lua would print it (strings are quoted)
+    """
+    t = node.get('t')
+    if t == 'nil':
+        return 'nil'
+    v = node.get('v')
+    if t == 'boolean':
+        return 'true' if v else 'false'
+    if t == 'string':
+        return '"{}"'.format(v)
+    return '{}'.format(v)
+
+
+def _expand_hint(node, start=None):
+    """
+    The %expand magic that shows more of a table node, from the entry at
+    start, if Spring kept the table
+    """
+    if node.get('h') is None:
+        return None
+    if start is None or start == 1:
+        return '%expand {}'.format(node['h'])
+    return '%expand {} -s {}'.format(node['h'], start)
+
+
+def _items(node):
+    """
+    Iterate over (key text, value node) pairs of a table node, with a None
+    value where entries were skipped
+    """
+    items = node.get('items') or []
+    skipAt = node.get('skipAt')
+    offset = node.get('offset', 0)
+    for i, item in enumerate(items):
+        if i == skipAt:
+            yield None, None
+        if node.get('array'):
+            index = offset + i + 1 if skipAt is None or i < skipAt else i + 1 + node.get('skipped', 0)
+            yield str(index), item['v']
+        elif item['k'].get('t') == 'string':
+            yield item['k'].get('v'), item['v']
+        else:
+            yield _scalar_text(item['k']), item['v']
+
+
+def _page(node):
+    """
+    Return the entries before and after the ones of a node showing a page
+    of a table, with the hint to show the next page
+    """
+    before = node.get('offset', 0)
+    after = node.get('n', 0) - before - len(node.get('items') or [])
+    return before, after, _expand_hint(node, before + len(node.get('items') or []) + 1)
+
+
+def _tree_text(node, out):
+    if node.get('t') != 'table':
+        out.append(_scalar_text(node))
+        return
+    if node.get('truncated'):
+        hint = _expand_hint(node)
+        out.append('{ ... (' + hint + ') }' if hint else '{ ... }')
+        return
+    out.append('{')
+    first = True
+    if 'offset' in node and node['offset']:
+        out.append('... ')
+    for key, value in _items(node):
+        if value is None:
+            hint = _expand_hint(node, node.get('skipAt', 0) + 1)
+            out.append(' ... (' + hint + ') ' if hint else ' ... ')
+            first = True
+            continue
+        if not first:
+            out.append(', ')
+        first = False
+        if not node.get('array'):
+            out.append(key)
+            out.append('=')
+        _tree_text(value, out)
+    if 'offset' in node:
+        _, after, hint = _page(node)
+        if after > 0:
+            out.append(' ... (' + hint + ')' if hint else ' ...')
+    out.append('}')
+
+
+def _tree_html(node, out):
+    if node.get('t') != 'table':
+        out.append(u'<span class="sk-{}">{}</span>'.format(
+            node.get('t'), escape(_scalar_text(node))))
+        return
+    if node.get('truncated'):
+        hint = _expand_hint(node)
+        out.append(u'{ ... }' + (u' <code>{}</code>'.format(hint) if hint else u''))
+        return
+    n = node.get('n', 0)
+    if n == 0:
+        out.append(u'{}')
+        return
+    summary = u'{} {} {}'.format('array' if node.get('array') else 'table', n, 'item' if n == 1 else 'items')
+    if 'offset' in node:
+        before, after, hint = _page(node)
+        if before or after:
+            summary += u', entries {} to {}'.format(before + 1, n - after)
+    out.append(u'<details{}><summary>{}</summary><ul style="list-style:none;margin:0;padding-left:1.5em">'.format(
+        ' open' if 'offset' in node else '', summary))
+    for key, value in _items(node):
+        if value is None:
+            hint = _expand_hint(node, node.get('skipAt', 0) + 1)
+            out.append(u'<li>&hellip; {} more &hellip;{}</li>'.format(
+                node.get('skipped', 0), u' <code>{}</code>'.format(hint) if hint else u''))
+            continue
+        out.append(u'<li>')
+        out.append(u'[{}] = '.format(key) if node.get('array') else escape(key) + u' = ')
+        _tree_html(value, out)
+        out.append(u'</li>')
+    if 'offset' in node and after > 0:
+        out.append(u'<li>&hellip; {} more &hellip;{}</li>'.format(
+            after, u' <code>{}</code>'.format(hint) if hint else u''))
+    out.append(u'</ul></details>')
+
+
+def tree_msg(lines):
+    """
+    Render structured output: a list of lines (one per _p call), each a list
+    of typed nodes. Tables become collapsible trees in HTML.
+    Return a pair (html, text).
+    """
+    html, txt = [], []
+    for nodes in lines:
+        html.append(u'<div>')
+        for i, node in enumerate(nodes):
+            if i:
+                html.append(u', ')
+                txt.append(u', ')
+            _tree_html(node, html)
+            _tree_text(node, txt)
+        html.append(u'</div>')
+        txt.append(u'\n')
+    return u''.join(html), u''.join(txt)
+
+
+# ----------------------------------------------------------------------
+
+def _watch_value(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, str):
+        return '"{}"'.format(value)
+    return '{}'.format(value)
+
+
+def progress_msg(done, total, message=None, engine=None):
+    """
+    Render the progress reported by an async cell as a progress bar
+    Return the data of a display_data message.
+    """
+    if isinstance(done, (int, float)) and isinstance(total, (int, float)) and total > 0:
+        text = '{:g}/{:g} ({:.0%})'.format(done, total, min(1, done / total))
+        bar = u'<progress value="{}" max="{}"></progress> '.format(done, total)
+    else:
+        text = '{}'.format('' if done is None else done)
+        bar = u''
+    if message:
+        text = u'{} {}'.format(text, message).strip()
+    if engine is not None:
+        text = u'[{}] {}'.format(engine, text)
+    return {'text/html' : div(bar + escape(text)),
+            'text/plain' : text}
+
+
+def watch_msg(title, engines):
+    """
+    Render the values of a watched expression as a table of scalars by
+    path, for each engine.
+      @param engines (dict): {engine : (values by path, error or None)}
+    Return the data of a display_data message.
+    """
+    html = [u'<div class="text-muted">{}</div>'.format(escape(title))]
+    txt = [title]
+    for engine, (values, error) in sorted(engines.items(), key=lambda item: str(item[0])):
+        if engine is not None:
+            html.append(div(escape(engine), css='engine-info'))
+            txt.append(u'[{}]'.format(engine))
+        if error:
+            html.append(div(escape(error), css='error'))
+            txt.append(error)
+        html.append(u'<table>')
+        for path in sorted(values):
+            value = _watch_value(values[path])
+            html.append(u'<tr><td style="text-align:left">{}</td><td style="text-align:left">{}</td></tr>'.format(
+                escape(path or u'(value)'), escape(value)))
+            txt.append(u'{} = {}'.format(path or u'(value)', value))
+        html.append(u'</table>')
+    return {'text/html' : div(u''.join(html)),
+            'text/plain' : u'\n'.join(txt)}
+
+
+# ----------------------------------------------------------------------
+
+def shorten(text, size=200):
+    """
+    Return text, or its start and its length if it's longer than size,
+    e.g. to log payloads
+    """
+    if len(text) <= size:
+        return text
+    return u'{}... ({} characters)'.format(text[:size], len(text))
+
+
+def payload_summary(msglist):
+    """
+    Summarize messages as passed to data_msg, with the size of each
+    instead of its contents
+    """
+    parts = []
+    for msg, css in msglist:
+        if css == 'tree':
+            parts.append(u'tree ({} lines)'.format(len(msg)))
+        elif isinstance(msg, str):
+            parts.append(u'{} ({} characters)'.format(css, len(msg)))
+        else:
+            parts.append(u'{} ({})'.format(css, type(msg).__name__))
+    return u', '.join(parts) or u'nothing'
+
+
+def data_msg(msglist, html_limit=HTML_LIMIT):
     """
     Return a Jupyter display_data message, in both HTML & text formats, by
-    joining together all passed messages.
+    joining together all passed messages. When they are longer than
+    html_limit characters (unless it's 0) only the text format is sent,
+    rendering it takes the frontend far less time.
 
       @param msglist (iterable): an iterable containing a list of tuples
         (message, css_style)
@@ -99,14 +371,25 @@ def data_msg(msglist):
     Each message is either a text string, or a list. In the latter case it is
     assumed to be a format string + parameters.
     """
-    txt = html = u''
-    getLogger().debug( "msglist: %r", msglist )
+    getLogger().debug(u"msglist: %s", payload_summary(msglist))
+    msglist = [(msg[0].format(*msg[1:]) if css != 'tree' and is_collection(msg) else msg, css)
+               for msg, css in msglist]
+    size = sum(len(msg) for msg, css in msglist if css != 'tree')
+    txt = []
+    html = [] if not html_limit or size <= html_limit else None
     for msg, css in msglist:
-        if is_collection(msg):
-            msg = msg[0].format(*msg[1:])
-        msg = escape(msg).replace('\n','<br/>')
-        html += div(msg, css=css or 'msg' )
-        txt += msg + "\n"
-    return { 'data': {'text/html' : div(html),
-                      'text/plain' : txt },
-             'metadata' : {} }
+        if css == 'tree':
+            tree_html, tree_txt = tree_msg(msg)
+            if html is not None:
+                html.append(div(tree_html, css='spring-tree'))
+            txt.append(tree_txt)
+            continue
+        if html is not None:
+            html.append(div(escape(msg).replace('\n', '<br/>'), css=css or 'msg'))
+        txt.append(msg)
+        txt.append(u'\n')
+    data = {'text/plain' : u''.join(txt)}
+    if html is not None:
+        data['text/html'] = div(u''.join(html))
+    return {'data' : data,
+            'metadata' : {}}